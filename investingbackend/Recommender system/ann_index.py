@@ -0,0 +1,235 @@
+import argparse
+import time
+import numpy as np
+
+class IVFIndex:
+    """
+    Approximate nearest-neighbor index for cosine similarity over unit-length vectors.
+
+    Vectors are grouped into n_lists clusters by spherical k-means (the coarse
+    quantizer). A query only scores the vectors in its n_probe closest clusters,
+    so n_probe trades recall (higher) against latency (lower).
+    """
+    def __init__(self, n_lists=None, n_probe=8, n_iter=20, seed=42):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.n_iter = n_iter
+        self.seed = seed
+        self.centroids = None
+        # Inverted lists in CSR form: ids of list i are list_ids[list_offsets[i]:list_offsets[i+1]]
+        self.list_offsets = None
+        self.list_ids = None
+
+    def fit(self, vectors, block_size=4096):
+        """
+        Cluster the vectors and build the inverted lists.
+
+        Parameters:
+        vectors (np.ndarray): (N x d) unit-length vectors to index
+        block_size (int): Vectors assigned per block, bounding memory to block_size x n_lists
+
+        Returns:
+        IVFIndex: The fitted index
+        """
+        num_vectors = len(vectors)
+        if self.n_lists is None:
+            self.n_lists = max(1, int(np.sqrt(num_vectors)))
+        n_lists = min(self.n_lists, num_vectors)
+        rng = np.random.default_rng(self.seed)
+
+        centroids = vectors[rng.choice(num_vectors, n_lists, replace=False)].copy()
+        for _ in range(self.n_iter):
+            assignments = self._assign(vectors, centroids, block_size)
+
+            # New centroid = normalized mean direction of its members
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, vectors)
+            counts = np.bincount(assignments, minlength=n_lists)
+
+            # Re-seed empty clusters with random vectors
+            empty = np.flatnonzero(counts == 0)
+            if len(empty):
+                sums[empty] = vectors[rng.choice(num_vectors, len(empty), replace=False)]
+
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            new_centroids = sums / norms
+            if np.allclose(new_centroids, centroids):
+                centroids = new_centroids
+                break
+            centroids = new_centroids
+
+        assignments = self._assign(vectors, centroids, block_size)
+        self.centroids = centroids
+        self.list_ids = np.argsort(assignments, kind='stable').astype(np.int32)
+        self.list_offsets = np.concatenate(
+            ([0], np.cumsum(np.bincount(assignments, minlength=n_lists)))
+        ).astype(np.int64)
+        return self
+
+    def update(self, vectors, changed_ids=(), id_map=None, block_size=4096):
+        """
+        Keep the inverted lists in step with added, changed or removed vectors.
+
+        Centroids stay fixed: ids that id_map sends to -1 leave their lists, and
+        changed or newly added ids are re-assigned to their closest centroid.
+
+        Parameters:
+        vectors (np.ndarray): The current (N x d) unit-length vectors
+        changed_ids (array-like): Ids (in the current numbering) whose vectors changed or are new
+        id_map (np.ndarray): Old id -> current id (-1 for removed), or None if no ids moved
+        block_size (int): Vectors assigned per block
+        """
+        n_lists = len(self.centroids)
+        lists = np.repeat(np.arange(n_lists), np.diff(self.list_offsets))
+        list_ids = self.list_ids.astype(np.int64)
+        if id_map is not None:
+            list_ids = id_map[list_ids]
+
+        assignments = np.full(len(vectors), -1, dtype=np.int64)
+        kept = list_ids >= 0
+        assignments[list_ids[kept]] = lists[kept]
+        changed_ids = np.asarray(changed_ids, dtype=np.int64)
+        if len(changed_ids):
+            assignments[changed_ids] = self._assign(vectors[changed_ids], self.centroids, block_size)
+
+        self.list_ids = np.argsort(assignments, kind='stable').astype(np.int32)
+        self.list_offsets = np.concatenate(
+            ([0], np.cumsum(np.bincount(assignments, minlength=n_lists)))
+        ).astype(np.int64)
+
+    @staticmethod
+    def _assign(vectors, centroids, block_size):
+        """Closest centroid (by cosine) for every vector."""
+        assignments = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), block_size):
+            scores = vectors[start:start + block_size] @ centroids.T
+            assignments[start:start + block_size] = scores.argmax(axis=1)
+        return assignments
+
+    def candidates(self, query, n_probe=None):
+        """
+        Ids of all vectors in the n_probe clusters closest to the query.
+
+        Parameters:
+        query (np.ndarray): Query vector (need not be unit length)
+        n_probe (int): Clusters to visit (defaults to self.n_probe)
+
+        Returns:
+        np.ndarray: Candidate vector ids
+        """
+        n_probe = min(n_probe or self.n_probe, len(self.centroids))
+        centroid_scores = self.centroids @ query
+        probes = np.argpartition(-centroid_scores, n_probe - 1)[:n_probe]
+        return np.concatenate([
+            self.list_ids[self.list_offsets[probe]:self.list_offsets[probe + 1]]
+            for probe in probes
+        ])
+
+    def search(self, query, vectors, n, n_probe=None, exclude_ids=None):
+        """
+        Approximate top-N vectors by cosine similarity to the query.
+
+        Parameters:
+        query (np.ndarray): Query vector
+        vectors (np.ndarray): The unit-length vectors the index was fitted on
+        n (int): Number of results
+        n_probe (int): Clusters to visit (defaults to self.n_probe)
+        exclude_ids (array-like): Vector ids to leave out of the results
+
+        Returns:
+        tuple: (ids, scores) of the best candidates, best first
+        """
+        norm = np.linalg.norm(query)
+        query = query / norm if norm > 0 else query
+
+        ids = self.candidates(query, n_probe)
+        if exclude_ids is not None and len(exclude_ids):
+            ids = ids[~np.isin(ids, exclude_ids)]
+
+        scores = vectors[ids] @ query
+        n = min(n, len(ids))
+        if n <= 0:
+            return ids[:0], scores[:0]
+        top = np.argpartition(-scores, n - 1)[:n]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return ids[top], scores[top]
+
+def benchmark_recall(index, vectors, queries, n=10, n_probe_values=(1, 2, 4, 8, 16)):
+    """
+    Measure recall@N and latency of the index against exact brute-force search.
+
+    Parameters:
+    index (IVFIndex): Fitted index
+    vectors (np.ndarray): The unit-length vectors the index was fitted on
+    queries (np.ndarray): (queries x d) query vectors
+    n (int): Result list length to compare
+    n_probe_values (iterable): n_probe settings to evaluate
+
+    Returns:
+    list: One dict per n_probe with recall, mean candidates and latency
+    """
+    norms = np.linalg.norm(queries, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    queries = queries / norms
+
+    # Exact answers, timed one query at a time like the ANN path
+    exact_top = []
+    exact_start = time.perf_counter()
+    for query in queries:
+        exact_scores = vectors @ query
+        exact_top.append(np.argpartition(-exact_scores, n - 1)[:n])
+    exact_ms = (time.perf_counter() - exact_start) * 1000 / len(queries)
+
+    results = []
+    for n_probe in n_probe_values:
+        hits, candidate_count = 0, 0
+        start = time.perf_counter()
+        for query, expected in zip(queries, exact_top):
+            ids, _ = index.search(query, vectors, n, n_probe=n_probe)
+            hits += len(np.intersect1d(ids, expected))
+        elapsed_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        for query in queries:
+            candidate_count += len(index.candidates(query, n_probe))
+
+        results.append({
+            'n_probe': n_probe,
+            'recall_at_n': hits / (n * len(queries)),
+            'mean_candidates': candidate_count / len(queries),
+            'ann_ms_per_query': elapsed_ms,
+            'exact_ms_per_query': exact_ms
+        })
+    return results
+
+def main():
+    from improved_recommender import ImprovedStockRecommender
+
+    parser = argparse.ArgumentParser(description='Benchmark the ANN index against exact search over user profiles')
+    parser.add_argument('--model', type=str, default='improved_stock_recommender', help='Trained model to load')
+    parser.add_argument('--n', type=int, default=10, help='Recommendations per query (the N in recall@N)')
+    parser.add_argument('--n-lists', type=int, default=None, help='Number of clusters (default sqrt of universe size)')
+    parser.add_argument('--n-probe', type=int, nargs='+', default=[1, 2, 4, 8, 16], help='n_probe values to evaluate')
+    parser.add_argument('--queries', type=int, default=1000, help='Number of user profiles to query with')
+    parser.add_argument('--save', action='store_true', help='Store the index in the model using the last n_probe value')
+    args = parser.parse_args()
+
+    recommender = ImprovedStockRecommender()
+    recommender.load_model(args.model)
+    recommender.build_ann_index(n_lists=args.n_lists, n_probe=args.n_probe[-1])
+
+    queries = recommender.create_user_profiles(list(recommender.portfolio_store.user_ids[:args.queries]))
+    results = benchmark_recall(recommender.ann_index, recommender.normalized_features,
+                               queries, n=args.n, n_probe_values=args.n_probe)
+
+    print(f"{len(recommender.normalized_features)} stocks, {recommender.ann_index.n_lists} lists, {len(queries)} queries")
+    print(f"{'n_probe':>8} {'recall@' + str(args.n):>10} {'candidates':>11} {'ann ms':>8} {'exact ms':>9}")
+    for row in results:
+        print(f"{row['n_probe']:>8} {row['recall_at_n']:>10.3f} {row['mean_candidates']:>11.1f} "
+              f"{row['ann_ms_per_query']:>8.3f} {row['exact_ms_per_query']:>9.3f}")
+
+    if args.save:
+        recommender.save_model(args.model)
+        print(f"Saved ANN index to {args.model}")
+
+if __name__ == "__main__":
+    main()
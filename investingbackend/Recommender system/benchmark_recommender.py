@@ -0,0 +1,299 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+# Stocks x users scenarios run by default: small, medium and large deployments
+DEFAULT_SIZES = ['500x5000', '5000x100000', '50000x1000000']
+
+STEPS = ['load_data', 'load_unique_portfolios', 'prepare_features', 'save_model', 'load_model']
+QUERIES = ['generate_recommendations', 'analyze_portfolio_risks', 'generate_diversification_recommendations']
+
+def parse_size(size):
+    """Split a 'STOCKSxUSERS' scenario string into (num_stocks, num_users)."""
+    try:
+        num_stocks, num_users = (int(part) for part in size.lower().split('x'))
+    except ValueError:
+        raise ValueError(f"Scenario size must look like 500x5000, got {size!r}")
+    return num_stocks, num_users
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / 1024
+
+def build_dataset(num_stocks, num_users, data_dir, seed=42):
+    """
+    Generate a synthetic universe with data.py and write it in the recommender's input formats.
+
+    Datasets are reused when the directory already holds one, since generating
+    the large scenarios takes much longer than benchmarking them.
+
+    Parameters:
+    num_stocks (int): Stocks in the universe
+    num_users (int): User portfolios
+    data_dir (str): Directory for the generated CSV files
+    seed (int): Seed for the generator's random number streams
+
+    Returns:
+    tuple: (stocks_data_path, unique_portfolios_path)
+    """
+    from data import generate_dataset
+
+    stocks_data_path = os.path.join(data_dir, 'stocks_data.csv')
+    unique_portfolios_path = os.path.join(data_dir, 'users_unique_portfolio.csv')
+    if os.path.exists(stocks_data_path) and os.path.exists(unique_portfolios_path):
+        return stocks_data_path, unique_portfolios_path
+
+    paths = generate_dataset(num_stocks=num_stocks, num_users=num_users, output_dir=data_dir, seed=seed,
+                             interactions=False)
+    return paths['stocks_data'], paths['unique_portfolios']
+
+def latency_summary(latencies):
+    """Latency percentiles (ms) and throughput for a list of per-query durations in seconds."""
+    latencies = np.asarray(latencies, dtype=np.float64)
+    total = float(latencies.sum())
+    return {
+        'count': len(latencies),
+        'mean_ms': float(latencies.mean() * 1000),
+        'p50_ms': float(np.percentile(latencies, 50) * 1000),
+        'p90_ms': float(np.percentile(latencies, 90) * 1000),
+        'p99_ms': float(np.percentile(latencies, 99) * 1000),
+        'max_ms': float(latencies.max() * 1000),
+        'throughput_qps': len(latencies) / total if total > 0 else 0.0
+    }
+
+def run_scenario(num_stocks, num_users, data_dir, num_queries=200, repeats=3, seed=42):
+    """
+    Time the recommender's build, persistence and query paths on one synthetic universe.
+
+    Runs in its own process (see run_benchmarks), so peak RSS reflects this
+    scenario alone and not the data generation.
+
+    Parameters:
+    num_stocks (int): Stocks in the universe
+    num_users (int): User portfolios
+    data_dir (str): Directory holding the scenario's dataset from build_dataset
+    num_queries (int): Users sampled for the per-query latency measurements
+    repeats (int): Runs of each build step; the fastest is reported
+    seed (int): Seed for the query sample
+
+    Returns:
+    dict: Step timings, query latency summaries and peak RSS
+    """
+    from improved_recommender import ImprovedStockRecommender
+
+    stocks_data_path = os.path.join(data_dir, 'stocks_data.csv')
+    unique_portfolios_path = os.path.join(data_dir, 'users_unique_portfolio.csv')
+
+    # Parse the CSV every run, not an .npz left behind by a previous one
+    npz_path = os.path.splitext(unique_portfolios_path)[0] + '.npz'
+    if os.path.exists(npz_path):
+        os.remove(npz_path)
+    model_path = os.path.join(data_dir, 'benchmark_model')
+
+    # Each build step keeps its best of `repeats` runs, which is far less noisy than one run
+    timings = {name: [] for name in STEPS}
+    def timed(name, function, *args):
+        start = time.perf_counter()
+        function(*args)
+        timings[name].append(time.perf_counter() - start)
+
+    for _ in range(repeats):
+        recommender = ImprovedStockRecommender()
+        timed('load_data', recommender.load_data, stocks_data_path)
+        timed('load_unique_portfolios', recommender.load_unique_portfolios, unique_portfolios_path)
+        timed('prepare_features', recommender.prepare_features)
+        timed('save_model', recommender.save_model, model_path)
+        recommender = ImprovedStockRecommender()
+        timed('load_model', recommender.load_model, model_path)
+    steps = {name: {'seconds': min(runs), 'runs': runs} for name, runs in timings.items()}
+
+    rng = np.random.default_rng(seed)
+    user_ids = recommender.portfolio_store.user_ids
+    sample = user_ids[rng.choice(len(user_ids), min(num_queries, len(user_ids)), replace=False)]
+
+    queries = {}
+    for name in QUERIES:
+        query = getattr(recommender, name)
+        latencies = []
+        # The first pass warms caches and memory-mapped pages; the second is timed
+        for timed_pass in (False, True):
+            for user_id in sample:
+                start = time.perf_counter()
+                try:
+                    query(user_id)
+                except ValueError:
+                    # Users whose holdings all fell outside the universe; still a timed request
+                    pass
+                if timed_pass:
+                    latencies.append(time.perf_counter() - start)
+        queries[name] = latency_summary(latencies)
+
+    shutil.rmtree(model_path, ignore_errors=True)
+    return {
+        'stocks': num_stocks,
+        'users': num_users,
+        'steps': steps,
+        'queries': queries,
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+def run_benchmarks(sizes, data_root, num_queries=200, repeats=3, seed=42):
+    """
+    Run every scenario, each in a fresh process.
+
+    Parameters:
+    sizes (list): Scenario strings like '500x5000' (stocks x users)
+    data_root (str): Directory for the generated datasets
+    num_queries (int): Users sampled per query type
+    repeats (int): Runs of each build step; the fastest is reported
+    seed (int): Seed for data generation and query sampling
+
+    Returns:
+    dict: Environment details and one result per scenario
+    """
+    results = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'num_queries': num_queries,
+        'repeats': repeats,
+        'seed': seed,
+        'scenarios': []
+    }
+
+    context = multiprocessing.get_context('spawn')
+    for size in sizes:
+        num_stocks, num_users = parse_size(size)
+        data_dir = os.path.join(data_root, f'{num_stocks}x{num_users}')
+        print(f"Running {num_stocks} stocks x {num_users} users...", flush=True)
+        # Generation and measurement each get a fresh process
+        with ProcessPoolExecutor(max_workers=1, mp_context=context, max_tasks_per_child=1) as pool:
+            generate_start = time.perf_counter()
+            pool.submit(build_dataset, num_stocks, num_users, data_dir, seed).result()
+            generate_seconds = time.perf_counter() - generate_start
+            scenario = pool.submit(run_scenario, num_stocks, num_users, data_dir, num_queries, repeats, seed).result()
+        scenario['generate_seconds'] = generate_seconds
+        results['scenarios'].append(scenario)
+        print_scenario(scenario)
+    return results
+
+def print_scenario(scenario):
+    print(f"\n{scenario['stocks']} stocks x {scenario['users']} users "
+          f"(peak RSS {scenario['peak_rss_mb']:.0f} MB)")
+    for name, step in scenario['steps'].items():
+        print(f"  {name:<42} {step['seconds'] * 1000:>10.1f} ms")
+    for name, summary in scenario['queries'].items():
+        print(f"  {name:<42} p50 {summary['p50_ms']:>8.3f} ms  p99 {summary['p99_ms']:>8.3f} ms  "
+              f"{summary['throughput_qps']:>9.0f} q/s")
+
+def scenario_metrics(scenario):
+    """Flatten a scenario result to metric name -> value, where lower is better."""
+    metrics = {f"{name}.seconds": step['seconds'] for name, step in scenario['steps'].items()}
+    for name, summary in scenario['queries'].items():
+        metrics[f"{name}.p50_ms"] = summary['p50_ms']
+        metrics[f"{name}.p99_ms"] = summary['p99_ms']
+    metrics['peak_rss_mb'] = scenario['peak_rss_mb']
+    return metrics
+
+def compare_results(baseline, current, threshold=0.10):
+    """
+    Compare two benchmark runs scenario by scenario.
+
+    Parameters:
+    baseline (dict): Earlier results from run_benchmarks
+    current (dict): New results from run_benchmarks
+    threshold (float): Relative slowdown (or memory growth) that counts as a regression
+
+    Returns:
+    list: One dict per shared metric with both values, the relative change and a regression flag
+    """
+    baseline_scenarios = {(s['stocks'], s['users']): s for s in baseline['scenarios']}
+    rows = []
+    for scenario in current['scenarios']:
+        key = (scenario['stocks'], scenario['users'])
+        if key not in baseline_scenarios:
+            continue
+        old_metrics = scenario_metrics(baseline_scenarios[key])
+        for metric, new_value in scenario_metrics(scenario).items():
+            old_value = old_metrics.get(metric)
+            if old_value is None:
+                continue
+            change = (new_value - old_value) / old_value if old_value > 0 else 0.0
+            rows.append({
+                'scenario': f"{key[0]}x{key[1]}",
+                'metric': metric,
+                'baseline': old_value,
+                'current': new_value,
+                'change': change,
+                'regression': change > threshold
+            })
+    return rows
+
+def print_comparison(rows, threshold):
+    print(f"{'scenario':<16} {'metric':<58} {'baseline':>11} {'current':>11} {'change':>8}")
+    for row in rows:
+        flag = '  REGRESSION' if row['regression'] else ''
+        print(f"{row['scenario']:<16} {row['metric']:<58} {row['baseline']:>11.3f} {row['current']:>11.3f} "
+              f"{row['change'] * 100:>7.1f}%{flag}")
+    regressions = sum(row['regression'] for row in rows)
+    print(f"\n{regressions} regression(s) beyond {threshold * 100:.0f}% across {len(rows)} metrics")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the recommender hot paths on synthetic universes')
+    subparsers = parser.add_subparsers(dest='command', required=True, help='Command to run')
+
+    run_parser = subparsers.add_parser('run', help='Run the benchmark scenarios and save the results as JSON')
+    run_parser.add_argument('--sizes', nargs='+', default=DEFAULT_SIZES, help='Scenarios as STOCKSxUSERS')
+    run_parser.add_argument('--queries', type=int, default=200, help='Users sampled per query type')
+    run_parser.add_argument('--repeats', type=int, default=3, help='Runs of each build step (the fastest is kept)')
+    run_parser.add_argument('--data-dir', type=str, default='benchmark_data', help='Where generated datasets are kept')
+    run_parser.add_argument('--seed', type=int, default=42, help='Seed for data generation and query sampling')
+    run_parser.add_argument('--output', '-o', type=str, default='benchmark_results.json', help='Results file')
+    run_parser.add_argument('--baseline', type=str, default=None, help='Earlier results to compare against')
+    run_parser.add_argument('--threshold', type=float, default=0.10, help='Relative slowdown flagged as a regression')
+
+    compare_parser = subparsers.add_parser('compare', help='Flag regressions between two saved runs')
+    compare_parser.add_argument('baseline', type=str, help='Earlier results file')
+    compare_parser.add_argument('current', type=str, help='New results file')
+    compare_parser.add_argument('--threshold', type=float, default=0.10, help='Relative slowdown flagged as a regression')
+
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        current = run_benchmarks(args.sizes, args.data_dir, num_queries=args.queries,
+                                 repeats=args.repeats, seed=args.seed)
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=2)
+        print(f"\nSaved results to {args.output}")
+        if not args.baseline:
+            return
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+
+    rows = compare_results(baseline, current, args.threshold)
+    print()
+    print_comparison(rows, args.threshold)
+    if any(row['regression'] for row in rows):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
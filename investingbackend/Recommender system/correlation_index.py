@@ -0,0 +1,89 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+def standardized_returns(returns, min_days=None, block_size=16384):
+    """
+    Scale return columns so the dot product of two columns is their correlation.
+
+    Each stock's returns are demeaned and divided by their norm. Missing days
+    are set to zero after demeaning, i.e. treated as an average day, which
+    keeps correlations a single matrix product at the cost of slightly
+    shrinking them for stocks with gaps.
+
+    Parameters:
+    returns (np.ndarray): (days x stocks) daily log returns, NaN where missing
+    min_days (int): Returns a stock needs to be correlated (defaults to half the days)
+    block_size (int): Stocks processed at a time
+
+    Returns:
+    np.ndarray: float32 (days x stocks); all-zero columns for stocks with too little (or constant) history
+    """
+    num_days, num_stocks = returns.shape
+    if min_days is None:
+        min_days = max(num_days // 2, 2)
+    standardized = np.zeros((num_days, num_stocks), dtype=np.float32)
+
+    for start in range(0, num_stocks, block_size):
+        values = np.asarray(returns[:, start:start + block_size], dtype=np.float64)
+        valid = ~np.isnan(values)
+        counts = valid.sum(axis=0)
+        means = np.where(valid, values, 0.0).sum(axis=0) / np.maximum(counts, 1)
+        centered = np.where(valid, values - means, 0.0)
+        norms = np.sqrt((centered ** 2).sum(axis=0))
+        usable = (counts >= min_days) & (norms > 0)
+        standardized[:, start:start + block_size] = centered / np.where(usable, norms, np.inf)
+    return standardized
+
+def correlation_neighbors(standardized, k=50, block_size=None, workers=None):
+    """
+    The k most correlated stocks of every stock.
+
+    Blocks of stocks are correlated against the whole universe with one
+    float32 matrix product each and only every row's top k are kept, so
+    memory stays at the standardized returns plus about block_size x stocks
+    scores per worker instead of the full stocks x stocks matrix. Blocks run
+    on a thread pool; NumPy releases the GIL in the product and the partition.
+
+    Parameters:
+    standardized (np.ndarray): (days x stocks) output of standardized_returns
+    k (int): Neighbors to keep per stock
+    block_size (int): Stocks correlated per block (defaults to a ~64 MB block)
+    workers (int): Threads (defaults to the CPU count)
+
+    Returns:
+    tuple: (neighbor ids int32 (stocks x k), correlations float32 (stocks x k)), most
+        correlated first; rows of stocks without history are padded with -1 / -inf
+    """
+    num_stocks = standardized.shape[1]
+    k = max(min(k, num_stocks - 1), 0)
+    neighbor_ids = np.full((num_stocks, k), -1, dtype=np.int32)
+    neighbor_scores = np.full((num_stocks, k), -np.inf, dtype=np.float32)
+
+    # Only stocks with history take part, as rows and as candidates
+    candidates = np.flatnonzero(np.asarray(standardized).any(axis=0))
+    width = min(k, len(candidates) - 1)
+    if width <= 0:
+        return neighbor_ids, neighbor_scores
+    matrix = np.ascontiguousarray(standardized[:, candidates], dtype=np.float32)
+    if block_size is None:
+        block_size = max(1, (64 << 20) // (12 * len(candidates)))
+
+    def correlate(start):
+        stop = min(start + block_size, len(candidates))
+        scores = matrix[:, start:stop].T @ matrix
+        # A stock is not its own neighbor
+        scores[np.arange(stop - start), np.arange(start, stop)] = -np.inf
+
+        top = np.argpartition(-scores, width - 1, axis=1)[:, :width]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind='stable')
+        rows = candidates[start:stop]
+        neighbor_ids[rows, :width] = candidates[np.take_along_axis(top, order, axis=1)]
+        neighbor_scores[rows, :width] = np.take_along_axis(top_scores, order, axis=1)
+
+    workers = workers or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # list() surfaces exceptions raised in the workers
+        list(pool.map(correlate, range(0, len(candidates), block_size)))
+    return neighbor_ids, neighbor_scores
@@ -1,619 +1,774 @@
-import pandas as pd
-import numpy as np
-import random
-from datetime import datetime, timedelta
+import argparse
 import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+# Stock tickers - a mix of real tickers, topped up with generated ones
+REAL_TICKERS = [
+    # Technology
+    'AAPL', 'MSFT', 'GOOG', 'GOOGL', 'AMZN', 'META', 'NVDA', 'INTC', 'CSCO', 'ADBE', 'CRM', 'ORCL', 'IBM', 'AMD', 'TSM',
+    # Financial
+    'JPM', 'BAC', 'GS', 'V', 'MA', 'BRK.B', 'C', 'MS', 'AXP', 'BLK', 'WFC', 'PNC', 'TFC', 'USB', 'COF',
+    # Healthcare
+    'JNJ', 'PFE', 'MRK', 'UNH', 'ABT', 'TMO', 'BMY', 'ABBV', 'LLY', 'AMGN', 'MDT', 'ISRG', 'CVS', 'GILD', 'BIIB',
+    # Consumer
+    'PG', 'KO', 'PEP', 'WMT', 'COST', 'MCD', 'NKE', 'SBUX', 'HD', 'TGT', 'LOW', 'DIS', 'NFLX', 'AMZN', 'EBAY',
+    # Industrial
+    'BA', 'GE', 'CAT', 'MMM', 'HON', 'UPS', 'LMT', 'RTX', 'DE', 'FDX', 'UNP', 'EMR', 'ETN', 'ITW', 'CMI',
+    # Energy
+    'XOM', 'CVX', 'COP', 'SLB', 'EOG', 'PSX', 'MPC', 'OXY', 'KMI', 'VLO',
+    # Utilities
+    'NEE', 'DUK', 'SO', 'D', 'AEP', 'EXC', 'XEL', 'WEC', 'ES', 'PEG',
+    # Communication Services
+    'CMCSA', 'VZ', 'T', 'CHTR', 'TMUS', 'ATVI', 'EA', 'TTWO', 'OMC', 'IPG',
+    # Real Estate
+    'AMT', 'PLD', 'CCI', 'EQIX', 'PSA', 'O', 'AVB', 'ESS', 'DLR', 'SPG',
+    # Materials
+    'LIN', 'APD', 'ECL', 'SHW', 'NUE', 'FCX', 'NEM', 'DOW', 'DD', 'PPG'
+]
+
+# Comprehensive sectors and industries with accurate groupings
+SECTORS_INDUSTRIES = {
+    'Technology': [
+        'Software', 'Hardware', 'Semiconductors', 'Internet', 'IT Services',
+        'Cloud Computing', 'Consumer Electronics', 'Enterprise Software', 'Cybersecurity'
+    ],
+    'Financial Services': [
+        'Banks', 'Insurance', 'Asset Management', 'Payment Processing', 'Investment Banking',
+        'Wealth Management', 'Consumer Finance', 'Mortgage Finance', 'Financial Data', 'Exchanges'
+    ],
+    'Healthcare': [
+        'Pharmaceuticals', 'Medical Devices', 'Biotechnology', 'Healthcare Services', 'Health Insurance',
+        'Life Sciences Tools', 'Hospitals', 'Managed Healthcare', 'Healthcare Technology', 'Medical Distribution'
+    ],
+    'Consumer Cyclical': [
+        'Retail', 'Apparel', 'Restaurants', 'Entertainment', 'Automotive',
+        'Homebuilding', 'Hotels', 'Luxury Goods', 'E-Commerce', 'Travel'
+    ],
+    'Consumer Defensive': [
+        'Consumer Packaged Goods', 'Food & Beverage', 'Discount Stores', 'Grocery', 'Household Products',
+        'Tobacco', 'Personal Products', 'Drug Stores', 'Agricultural Products', 'Food Distribution'
+    ],
+    'Industrial': [
+        'Aerospace & Defense', 'Machinery', 'Transportation', 'Building Products', 'Electrical Equipment',
+        'Industrial Distribution', 'Waste Management', 'Construction', 'Business Services', 'Engineering'
+    ],
+    'Energy': [
+        'Oil & Gas E&P', 'Oil & Gas Integrated', 'Oil & Gas Refining', 'Oil & Gas Midstream', 'Oil & Gas Services',
+        'Renewable Energy', 'Coal', 'Gas Utilities', 'Alternative Energy', 'Energy Equipment'
+    ],
+    'Utilities': [
+        'Electric Utilities', 'Multi-Utilities', 'Water Utilities', 'Independent Power Producers', 'Renewable Utilities'
+    ],
+    'Communication Services': [
+        'Telecom', 'Media', 'Entertainment', 'Social Media', 'Advertising',
+        'Publishing', 'Broadcasting', 'Gaming', 'Wireless Communication', 'Cable & Satellite'
+    ],
+    'Real Estate': [
+        'REITs', 'Property Management', 'Real Estate Development', 'Real Estate Services', 'Storage REITs',
+        'Residential REITs', 'Office REITs', 'Industrial REITs', 'Retail REITs', 'Healthcare REITs'
+    ],
+    'Materials': [
+        'Chemicals', 'Metals & Mining', 'Construction Materials', 'Containers & Packaging', 'Paper & Forest Products',
+        'Steel', 'Specialty Chemicals', 'Gold', 'Agricultural Chemicals', 'Diversified Metals'
+    ]
+}
+
+# Realistic sector distribution - based on market cap weighting
+SECTOR_WEIGHTS = {
+    'Technology': 0.25,
+    'Financial Services': 0.15,
+    'Healthcare': 0.15,
+    'Consumer Cyclical': 0.10,
+    'Consumer Defensive': 0.08,
+    'Industrial': 0.08,
+    'Energy': 0.05,
+    'Utilities': 0.03,
+    'Communication Services': 0.04,
+    'Real Estate': 0.03,
+    'Materials': 0.04
+}
+
+# Price and market cap are correlated with sector: each stock draws its multiplier from its sector's range
+SECTOR_MULTIPLIER_RANGES = {
+    'Technology': (1.2, 2.0),
+    'Financial Services': (0.8, 1.2),
+    'Healthcare': (1.0, 1.5),
+    'Consumer Cyclical': (0.7, 1.3),
+    'Consumer Defensive': (0.9, 1.2),
+    'Industrial': (0.8, 1.1),
+    'Energy': (0.6, 1.0),
+    'Utilities': (0.5, 0.9),
+    'Communication Services': (0.7, 1.2),
+    'Real Estate': (0.6, 1.0),
+    'Materials': (0.5, 0.9)
+}
+
+COMPANY_SUFFIXES = ['Inc.', 'Corp.', 'Group', 'Technologies', 'Holdings', 'Pharmaceuticals', 'Energy', 'Solutions', 'Systems', 'Brands']
+
+# Different user investment strategies
+STRATEGIES = [
+    'diversified',       # Holds stocks across many sectors
+    'sector_focused',    # Focuses on 1-2 sectors
+    'large_cap_biased',  # Prefers large caps
+    'small_cap_biased',  # Prefers small caps
+    'dividend_focused',  # Focuses on dividend stocks
+    'growth_focused',    # Focuses on growth stocks
+    'random'             # Random selection
+]
+ENGAGEMENT_TYPES = np.array(['view', 'research', 'watchlist', 'comparison'])
+MAX_VIEWS = 15
+
+# Pools at most this large are sampled exactly with random sort keys; larger ones by rejection
+_SMALL_POOL = 512
 
-# Set random seed for reproducibility
-np.random.seed(42)
+def generate_tickers(num_stocks, rng):
+    """Real tickers first, then unique random 3-5 letter tickers up to num_stocks."""
+    if num_stocks <= len(REAL_TICKERS):
+        return REAL_TICKERS[:num_stocks]
+        
+    tickers = dict.fromkeys(REAL_TICKERS)
+    target = num_stocks - len(REAL_TICKERS) + len(tickers)
+    while len(tickers) < target:
+        count = int((target - len(tickers)) * 1.1) + 16
+        letters = rng.integers(ord('A'), ord('Z') + 1, size=(count, 5), dtype=np.uint8).view('S5').ravel()
+        lengths = rng.integers(3, 6, size=count)
+        for code, length in zip(letters.tolist(), lengths.tolist()):
+            tickers.setdefault(code[:length].decode())
+            if len(tickers) == target:
+                break
+    return REAL_TICKERS + list(tickers)[len(set(REAL_TICKERS)):]
 
-def generate_comprehensive_stock_data(num_stocks=500, output_dir="stock_recommender_data"):
+def generate_stocks(num_stocks, rng):
     """
-    Generate a comprehensive stock dataset for training a recommendation system
+    Generate the stock universe with realistic correlations between metrics.
+    
+    Every per-stock formula is evaluated for all stocks at once.
     
     Parameters:
     num_stocks (int): Number of stocks to generate
-    output_dir (str): Directory to save the generated data
+    rng (np.random.Generator): Random number source
     
     Returns:
-    tuple: Paths to the generated CSV files
+    pd.DataFrame: One row per stock, in stocks_data.csv column order
     """
-    # Create output directory if it doesn't exist
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-        
-    # Define stock tickers - using a mix of real tickers and generated ones
-    real_tickers = [
-        # Technology
-        'AAPL', 'MSFT', 'GOOG', 'GOOGL', 'AMZN', 'META', 'NVDA', 'INTC', 'CSCO', 'ADBE', 'CRM', 'ORCL', 'IBM', 'AMD', 'TSM',
-        # Financial
-        'JPM', 'BAC', 'GS', 'V', 'MA', 'BRK.B', 'C', 'MS', 'AXP', 'BLK', 'WFC', 'PNC', 'TFC', 'USB', 'COF',
-        # Healthcare
-        'JNJ', 'PFE', 'MRK', 'UNH', 'ABT', 'TMO', 'BMY', 'ABBV', 'LLY', 'AMGN', 'MDT', 'ISRG', 'CVS', 'GILD', 'BIIB',
-        # Consumer
-        'PG', 'KO', 'PEP', 'WMT', 'COST', 'MCD', 'NKE', 'SBUX', 'HD', 'TGT', 'LOW', 'DIS', 'NFLX', 'AMZN', 'EBAY',
-        # Industrial
-        'BA', 'GE', 'CAT', 'MMM', 'HON', 'UPS', 'LMT', 'RTX', 'DE', 'FDX', 'UNP', 'EMR', 'ETN', 'ITW', 'CMI',
-        # Energy
-        'XOM', 'CVX', 'COP', 'SLB', 'EOG', 'PSX', 'MPC', 'OXY', 'KMI', 'VLO',
-        # Utilities
-        'NEE', 'DUK', 'SO', 'D', 'AEP', 'EXC', 'XEL', 'WEC', 'ES', 'PEG',
-        # Communication Services
-        'CMCSA', 'VZ', 'T', 'CHTR', 'TMUS', 'ATVI', 'EA', 'TTWO', 'OMC', 'IPG',
-        # Real Estate
-        'AMT', 'PLD', 'CCI', 'EQIX', 'PSA', 'O', 'AVB', 'ESS', 'DLR', 'SPG',
-        # Materials
-        'LIN', 'APD', 'ECL', 'SHW', 'NUE', 'FCX', 'NEM', 'DOW', 'DD', 'PPG'
-    ]
+    tickers = np.array(generate_tickers(num_stocks, rng), dtype=object)
+    sector_names = list(SECTOR_WEIGHTS)
     
-    # Generate additional tickers if needed
-    if num_stocks > len(real_tickers):
-        letters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
-        additional_tickers = []
-        
-        while len(real_tickers) + len(additional_tickers) < num_stocks:
-            new_ticker = ''.join(random.choices(letters, k=random.randint(3, 5)))
-            if new_ticker not in real_tickers and new_ticker not in additional_tickers:
-                additional_tickers.append(new_ticker)
-        
-        tickers = real_tickers + additional_tickers
-        # Limit to the requested number of stocks
-        tickers = tickers[:num_stocks]
-    else:
-        tickers = real_tickers[:num_stocks]
-    
-    # Define comprehensive sectors and industries with accurate groupings
-    sectors_industries = {
-        'Technology': [
-            'Software', 'Hardware', 'Semiconductors', 'Internet', 'IT Services', 
-            'Cloud Computing', 'Consumer Electronics', 'Enterprise Software', 'Cybersecurity'
-        ],
-        'Financial Services': [
-            'Banks', 'Insurance', 'Asset Management', 'Payment Processing', 'Investment Banking',
-            'Wealth Management', 'Consumer Finance', 'Mortgage Finance', 'Financial Data', 'Exchanges'
-        ],
-        'Healthcare': [
-            'Pharmaceuticals', 'Medical Devices', 'Biotechnology', 'Healthcare Services', 'Health Insurance',
-            'Life Sciences Tools', 'Hospitals', 'Managed Healthcare', 'Healthcare Technology', 'Medical Distribution'
-        ],
-        'Consumer Cyclical': [
-            'Retail', 'Apparel', 'Restaurants', 'Entertainment', 'Automotive',
-            'Homebuilding', 'Hotels', 'Luxury Goods', 'E-Commerce', 'Travel'
-        ],
-        'Consumer Defensive': [
-            'Consumer Packaged Goods', 'Food & Beverage', 'Discount Stores', 'Grocery', 'Household Products',
-            'Tobacco', 'Personal Products', 'Drug Stores', 'Agricultural Products', 'Food Distribution'
-        ],
-        'Industrial': [
-            'Aerospace & Defense', 'Machinery', 'Transportation', 'Building Products', 'Electrical Equipment',
-            'Industrial Distribution', 'Waste Management', 'Construction', 'Business Services', 'Engineering'
-        ],
-        'Energy': [
-            'Oil & Gas E&P', 'Oil & Gas Integrated', 'Oil & Gas Refining', 'Oil & Gas Midstream', 'Oil & Gas Services',
-            'Renewable Energy', 'Coal', 'Gas Utilities', 'Alternative Energy', 'Energy Equipment'
-        ],
-        'Utilities': [
-            'Electric Utilities', 'Multi-Utilities', 'Water Utilities', 'Independent Power Producers', 'Renewable Utilities'
-        ],
-        'Communication Services': [
-            'Telecom', 'Media', 'Entertainment', 'Social Media', 'Advertising',
-            'Publishing', 'Broadcasting', 'Gaming', 'Wireless Communication', 'Cable & Satellite'
-        ],
-        'Real Estate': [
-            'REITs', 'Property Management', 'Real Estate Development', 'Real Estate Services', 'Storage REITs',
-            'Residential REITs', 'Office REITs', 'Industrial REITs', 'Retail REITs', 'Healthcare REITs'
-        ],
-        'Materials': [
-            'Chemicals', 'Metals & Mining', 'Construction Materials', 'Containers & Packaging', 'Paper & Forest Products',
-            'Steel', 'Specialty Chemicals', 'Gold', 'Agricultural Chemicals', 'Diversified Metals'
-        ]
-    }
+    # Sector assignments based on weights, topped up at random for rounding errors, then shuffled
+    counts = [int(weight * num_stocks) for weight in SECTOR_WEIGHTS.values()]
+    sector_codes = np.repeat(np.arange(len(sector_names)), counts)
+    sector_codes = np.concatenate((sector_codes, rng.integers(0, len(sector_names), num_stocks - len(sector_codes))))
+    rng.shuffle(sector_codes)
+    sectors = np.array(sector_names, dtype=object)[sector_codes]
+    
+    def in_sectors(*names):
+        return np.isin(sector_codes, [sector_names.index(name) for name in names])
+        
+    def uniform(low, high):
+        return rng.uniform(low, high, num_stocks)
+        
+    # Industry: a random one of the stock's sector
+    industry_counts = np.array([len(SECTORS_INDUSTRIES[name]) for name in sector_names])
+    industry_offsets = np.concatenate(([0], np.cumsum(industry_counts)))
+    all_industries = np.array([industry for name in sector_names for industry in SECTORS_INDUSTRIES[name]], dtype=object)
+    industries = all_industries[industry_offsets[sector_codes]
+                                + (rng.random(num_stocks) * industry_counts[sector_codes]).astype(np.int64)]
+                                
+    low, high = np.array([SECTOR_MULTIPLIER_RANGES[name] for name in sector_names]).T
+    sector_multiplier = low[sector_codes] + rng.random(num_stocks) * (high - low)[sector_codes]
+    
+    # Base financial variables with realistic constraints
+    base_growth = uniform(-5, 25) * sector_multiplier
+    base_profitability = uniform(5, 30) * sector_multiplier
+    
+    price = np.round(uniform(20, 500) * sector_multiplier, 2)
+    
+    # PE ratio depends on growth: negative growth often leads to high or negative P/E, high growth to higher P/E
+    pe_ratio = np.round(np.select(
+        [base_growth < 0, base_growth > 15],
+        [np.where(rng.random(num_stocks) > 0.3, uniform(20, 50), uniform(-50, -10)), uniform(25, 100)],
+        uniform(10, 40)
+    ), 2)
+    # Some stocks might not have P/E (startups, biotech, etc.)
+    no_pe = (rng.random(num_stocks) < 0.05) | ((industries == 'Biotechnology') & in_sectors('Healthcare')
+                                               & (rng.random(num_stocks) < 0.5))
+    pe_ratio[no_pe] = np.nan
+    
+    # Market cap is based on price and sector; shares outstanding between 100M and 10B
+    base_shares = rng.integers(100, 10001, num_stocks) * 1000000
+    shares_outstanding = (base_shares * sector_multiplier).astype(np.int64)
+    market_cap = price * shares_outstanding / 1000000000  # In billions
+    
+    # Dividend yield: fast-growing companies often pay none, stable sectors like utilities pay more
+    dividend_yield = np.round(np.select(
+        [in_sectors('Utilities', 'Consumer Defensive', 'Energy', 'Real Estate') | (base_growth < 5),
+         in_sectors('Financial Services', 'Materials', 'Industrial') & (base_growth < 10),
+         rng.random(num_stocks) < 0.3],
+        [uniform(1, 5), uniform(0.5, 3), uniform(0.1, 2)],
+        0.0
+    ), 2)
+    
+    # Beta (volatility) - related to sector, then adjusted for company size
+    beta = np.round(np.select(
+        [in_sectors('Technology', 'Consumer Cyclical', 'Energy'),
+         in_sectors('Healthcare', 'Financial Services', 'Communication Services')],
+        [uniform(1.0, 2.5), uniform(0.8, 1.8)],
+        uniform(0.5, 1.2)
+    ), 2)
+    beta *= np.select([market_cap < 2, market_cap > 100], [uniform(1.1, 1.3), uniform(0.8, 0.95)], 1.0)
+    
+    # Growth metrics
+    earnings_growth_3yr = np.round(base_growth + uniform(-5, 5), 2)
+    revenue_growth_3yr = np.round(earnings_growth_3yr + uniform(-3, 3), 2)
+    
+    # PEG ratio - Price/Earnings to Growth; very high PEG usually indicates overvaluation or error, cap it
+    has_peg = ~np.isnan(pe_ratio) & (earnings_growth_3yr > 0)
+    peg_ratio = np.full(num_stocks, np.nan)
+    peg_ratio[has_peg] = np.minimum(5.0, np.round(pe_ratio[has_peg] / earnings_growth_3yr[has_peg], 2))
+    
+    # Profitability metrics - related to sector and growth; many biotech companies are pre-profit
+    profit_margin = np.round(base_profitability + uniform(-5, 5), 2)
+    operating_margin = np.round(profit_margin + uniform(-3, 8), 2)
+    pre_profit = np.isin(industries, ['Biotechnology', 'Pharmaceuticals']) & (rng.random(num_stocks) < 0.4)
+    profit_margin = np.where(pre_profit, np.round(uniform(-50, 0), 2), profit_margin)
+    operating_margin = np.where(pre_profit, np.round(uniform(-60, -10), 2), operating_margin)
+    
+    # Return metrics based on profitability
+    roa = np.round(profit_margin * uniform(0.2, 0.6), 2)
+    roe = np.round(profit_margin * uniform(1.0, 2.5), 2)
+    
+    # Valuation metrics
+    pb_ratio = np.round(uniform(1, 8) * (1 + earnings_growth_3yr / 100), 2)
+    ps_ratio = np.round(uniform(1, 10) * (1 + revenue_growth_3yr / 100), 2)
+    ev_to_ebitda = np.round(uniform(5, 25) * (1 + earnings_growth_3yr / 200), 2)
+    
+    # Debt metrics - related to sector stability; tech and healthcare often have better liquidity
+    debt_to_equity = np.round(np.where(in_sectors('Utilities', 'Real Estate', 'Financial Services'),
+                                       uniform(1.0, 3.0), uniform(0.1, 1.5)), 2)
+    current_ratio = np.round(np.where(in_sectors('Technology', 'Healthcare') & (profit_margin > 15),
+                                      uniform(1.5, 4.0), uniform(0.8, 2.5)), 2)
+                                      
+    # Stock returns are correlated with growth and overall market
+    market_performance = uniform(-5, 20)
+    stock_alpha = (earnings_growth_3yr - 10) / 5
+    avg_return_1yr = np.round(market_performance + stock_alpha + uniform(-15, 15), 2)
+    
+    # Volatility is related to beta and size
+    volatility_1yr = np.round(15 * beta * (1 + uniform(-0.3, 0.3)), 2)
+    
+    # Risk-adjusted metrics, assuming a 2% risk-free rate
+    risk_free_rate = 2.0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sharpe_ratio = np.where(volatility_1yr > 0, np.round((avg_return_1yr - risk_free_rate) / volatility_1yr, 2), 0.0)
+    max_drawdown = np.round(-1 * (volatility_1yr * uniform(1.5, 3.0)), 2)
+    
+    # ESG metrics - some sectors score better than others
+    esg_base = np.select(
+        [in_sectors('Technology', 'Healthcare', 'Utilities'),
+         in_sectors('Financial Services', 'Consumer Defensive', 'Communication Services')],
+        [uniform(60, 90), uniform(50, 80)],
+        uniform(30, 70)
+    )
+    esg_score = np.clip(np.round(esg_base + uniform(-10, 10), 2), 0, 100)
+    
+    market_type = np.select([market_cap > 50, market_cap > 10], ['Large Cap', 'Mid Cap'], 'Small Cap').astype(object)
+    exchange = np.where(rng.random(num_stocks) < 0.6, 'NYSE', 'NASDAQ').astype(object)  # 60% on NYSE
+    
+    # Company name - related to ticker
+    suffixes = np.array(COMPANY_SUFFIXES, dtype=object)[rng.integers(0, len(COMPANY_SUFFIXES), num_stocks)]
+    company_name = tickers + ' ' + suffixes
+    
+    return pd.DataFrame({
+        'ticker': tickers,
+        'company_name': company_name,
+        'sector': sectors,
+        'industry': industries,
+        'market_type': market_type,
+        'exchange': exchange,
+        'price': price,
+        'market_cap': market_cap,
+        'pe_ratio': pe_ratio,
+        'peg_ratio': peg_ratio,
+        'pb_ratio': pb_ratio,
+        'ps_ratio': ps_ratio,
+        'dividend_yield': dividend_yield,
+        'beta': beta,
+        'profit_margin': profit_margin,
+        'operating_margin': operating_margin,
+        'roa': roa,
+        'roe': roe,
+        'ev_to_ebitda': ev_to_ebitda,
+        'debt_to_equity': debt_to_equity,
+        'current_ratio': current_ratio,
+        'revenue_growth_3yr': revenue_growth_3yr,
+        'earnings_growth_3yr': earnings_growth_3yr,
+        'shares_outstanding': shares_outstanding,
+        'avg_return_1yr': avg_return_1yr,
+        'volatility_1yr': volatility_1yr,
+        'sharpe_ratio': sharpe_ratio,
+        'max_drawdown': max_drawdown,
+        'esg_score': esg_score
+    })
+
+def generate_market_returns(num_days, rng):
+    """
+    Daily returns of the market factor every stock shares.
+    
+    Parameters:
+    num_days (int): Trading days to simulate
+    rng (np.random.Generator): Random number source
+    
+    Returns:
+    np.ndarray: (num_days,) daily returns
+    """
+    market_trend = 0.0001  # Slight upward bias in market
+    market_returns = rng.normal(market_trend, 0.01, num_days)
     
-    # Create realistic sector distribution - based on market cap weighting
-    sector_weights = {
-        'Technology': 0.25,
-        'Financial Services': 0.15, 
-        'Healthcare': 0.15,
-        'Consumer Cyclical': 0.10,
-        'Consumer Defensive': 0.08,
-        'Industrial': 0.08,
-        'Energy': 0.05,
-        'Utilities': 0.03,
-        'Communication Services': 0.04,
-        'Real Estate': 0.03,
-        'Materials': 0.04
+    # Add seasonality and some market cycles (simplified)
+    t = np.arange(num_days)
+    # Add a slow cycle (approx 1 year)
+    market_returns += 0.0002 * np.sin(2 * np.pi * t / 252)
+    # Add a faster cycle (approx 1 quarter)
+    market_returns += 0.0001 * np.sin(2 * np.pi * t / 63)
+    return market_returns
+
+def simulate_price_paths(current_prices, volatility, beta, growth, market_returns, rng):
+    """
+    Simulate daily price paths for a block of stocks that end at their current prices.
+    
+    Each stock's daily return is beta * market + a stock-specific draw. Prices are
+    walked backwards from today's price with a reverse cumulative sum of log returns,
+    so the whole block costs O(days x stocks).
+    
+    Parameters:
+    current_prices (np.ndarray): Latest price of each stock
+    volatility (np.ndarray): Annual volatility of each stock, in percent
+    beta (np.ndarray): Beta of each stock
+    growth (np.ndarray): Annual revenue growth of each stock, in percent (sets the drift)
+    market_returns (np.ndarray): (days,) market factor from generate_market_returns
+    rng (np.random.Generator): Random number source
+    
+    Returns:
+    np.ndarray: (days x stocks) prices, the last row equal to current_prices
+    """
+    daily_volatility = volatility / 100 / np.sqrt(252)
+    stock_specific_vol = daily_volatility * (1 - 0.6)  # Assuming 60% of volatility is market-related
+    growth_trend = growth / 100 / 252  # Daily growth factor
+    
+    returns = rng.standard_normal((len(market_returns), len(current_prices)))
+    returns *= stock_specific_vol
+    returns += growth_trend
+    returns += np.multiply.outer(market_returns, beta)
+    
+    # Log growth still to come after each day: total minus the running sum
+    log_returns = np.log1p(np.maximum(returns, -0.99), out=returns)
+    remaining = np.cumsum(log_returns, axis=0)
+    np.subtract(remaining[-1], remaining, out=remaining)
+    return current_prices * np.exp(-remaining, out=remaining)
+
+def write_historical_prices(stocks_df, path, rng, days=252*2, end_date=None, block_size=2000):
+    """
+    Simulate price history for every stock and write historical_prices.csv in one pass.
+    
+    All stocks share one market factor. Stocks are simulated a block at a time
+    so memory stays bounded by days x block_size, and each block is written as
+    soon as it is simulated.
+    
+    Parameters:
+    stocks_df (pd.DataFrame): Stocks from generate_stocks
+    path (str): CSV file to write
+    rng (np.random.Generator): Random number source
+    days (int): Trading days of history per stock
+    end_date (date): Last trading day (defaults to today)
+    block_size (int): Stocks simulated at a time
+    
+    Returns:
+    int: Number of stocks written
+    """
+    if not end_date:
+        end_date = datetime.now().date()
+    dates = pd.bdate_range(end=end_date, periods=days).strftime('%Y-%m-%d').tolist()
+    market_returns = generate_market_returns(days, rng)
+    
+    columns = {name: stocks_df[name].to_numpy(dtype=np.float64)
+               for name in ('price', 'volatility_1yr', 'beta', 'revenue_growth_3yr')}
+    tickers = stocks_df['ticker'].to_numpy(dtype=object)
+    with open(path, 'w') as f:
+        f.write("date,ticker,price\n")
+        for start in range(0, len(stocks_df), block_size):
+            block = slice(start, start + block_size)
+            prices = simulate_price_paths(columns['price'][block], columns['volatility_1yr'][block],
+                                          columns['beta'][block], columns['revenue_growth_3yr'][block],
+                                          market_returns, rng)
+            # One stock's dates after another, as the rows were always laid out
+            for ticker, column in zip(tickers[block].tolist(), prices.T.tolist()):
+                f.write(''.join(map(f"{{}},{ticker},{{:.4f}}\n".format, dates, column)))
+    return len(stocks_df)
+
+def build_universe(stocks_df):
+    """
+    The stock arrays user generation needs, small enough to ship to every worker once.
+    
+    Parameters:
+    stocks_df (pd.DataFrame): Stocks from generate_stocks
+    
+    Returns:
+    dict: Tickers, sector layout and the stock pools the biased strategies draw from
+    """
+    sector_codes, sector_names = pd.factorize(stocks_df['sector'])
+    sector_counts = np.bincount(sector_codes, minlength=len(sector_names))
+    return {
+        'tickers': stocks_df['ticker'].to_numpy(dtype=object),
+        'sector_counts': sector_counts,
+        'sector_offsets': np.concatenate(([0], np.cumsum(sector_counts)))[:-1],
+        # Stock rows grouped by sector, so a sector's stocks are one contiguous slice
+        'sector_order': np.argsort(sector_codes, kind='stable'),
+        'pools': {
+            'large_cap_biased': (np.flatnonzero(stocks_df['market_type'] == 'Large Cap'), 0.7),
+            'small_cap_biased': (np.flatnonzero(stocks_df['market_type'] == 'Small Cap'), 0.7),
+            'dividend_focused': (np.flatnonzero(stocks_df['dividend_yield'] > 0), 0.8),
+            'growth_focused': (np.flatnonzero(stocks_df['earnings_growth_3yr'] > 10), 0.7)
+        }
     }
+
+def _fill_distinct(rng, ids, filled, total, sizes):
+    """
+    Fill ids[i, filled[i]:total[i]] with values in [0, sizes[i]) that are distinct within each row.
     
-    # Create assignments based on weights
-    sectors = []
-    for sector, weight in sector_weights.items():
-        count = int(weight * num_stocks)
-        sectors.extend([sector] * count)
-    
-    # Adjust for any rounding errors
-    while len(sectors) < num_stocks:
-        sectors.append(random.choice(list(sector_weights.keys())))
-    
-    # Shuffle sectors
-    random.shuffle(sectors)
-    
-    # Assign sector and industry to each ticker
-    ticker_sectors = {}
-    ticker_industries = {}
-    
-    for i, ticker in enumerate(tickers):
-        sector = sectors[i]
-        industry = random.choice(sectors_industries[sector])
-        ticker_sectors[ticker] = sector
-        ticker_industries[ticker] = industry
-    
-    # Generate realistic financial data with correlations between metrics
-    data = []
-    for ticker in tickers:
-        # Basic info
-        sector = ticker_sectors[ticker]
-        industry = ticker_industries[ticker]
-        
-        # Base metrics with realistic relationships
-        # Price and market cap are correlated with sector
-        sector_multiplier = {
-            'Technology': random.uniform(1.2, 2.0),
-            'Financial Services': random.uniform(0.8, 1.2),
-            'Healthcare': random.uniform(1.0, 1.5),
-            'Consumer Cyclical': random.uniform(0.7, 1.3),
-            'Consumer Defensive': random.uniform(0.9, 1.2),
-            'Industrial': random.uniform(0.8, 1.1),
-            'Energy': random.uniform(0.6, 1.0),
-            'Utilities': random.uniform(0.5, 0.9),
-            'Communication Services': random.uniform(0.7, 1.2),
-            'Real Estate': random.uniform(0.6, 1.0),
-            'Materials': random.uniform(0.5, 0.9)
-        }[sector]
-        
-        # Base financial variables with realistic constraints
-        base_growth = random.uniform(-5, 25) * sector_multiplier
-        base_profitability = random.uniform(5, 30) * sector_multiplier
-        base_risk = random.uniform(0.5, 2.0)
-        
-        # Financial metrics
-        price = round(random.uniform(20, 500) * sector_multiplier, 2)
-        
-        # PE ratio depends on growth and sector
-        if base_growth < 0:  # Negative growth often leads to high or negative P/E
-            pe_ratio = round(random.uniform(20, 50) if random.random() > 0.3 else random.uniform(-50, -10), 2)
-        elif base_growth > 15:  # High growth tends to have higher P/E
-            pe_ratio = round(random.uniform(25, 100), 2)
-        else:  # Moderate growth
-            pe_ratio = round(random.uniform(10, 40), 2)
-        
-        # Some stocks might not have P/E (startups, biotech, etc.)
-        if random.random() < 0.05 or sector == 'Healthcare' and industry == 'Biotechnology' and random.random() < 0.5:
-            pe_ratio = float('nan')
-        
-        # Market cap is based on price and sector
-        # More established sectors tend to have higher market caps
-        base_shares = random.randint(100, 10000) * 1000000  # Base shares outstanding between 100M and 10B
-        shares_outstanding = int(base_shares * sector_multiplier)
-        market_cap = price * shares_outstanding / 1000000000  # In billions
-        
-        # Dividend yield based on sector and growth
-        # Fast-growing companies often have low or no dividends
-        # Stable sectors like utilities often have higher dividends
-        if sector in ['Utilities', 'Consumer Defensive', 'Energy', 'Real Estate'] or base_growth < 5:
-            dividend_yield = round(random.uniform(1, 5), 2)
-        elif sector in ['Financial Services', 'Materials', 'Industrial'] and base_growth < 10:
-            dividend_yield = round(random.uniform(0.5, 3), 2)
-        elif random.random() < 0.3:  # Some companies in any sector might pay dividends
-            dividend_yield = round(random.uniform(0.1, 2), 2)
-        else:
-            dividend_yield = 0
-        
-        # Beta (volatility) - related to sector
-        if sector in ['Technology', 'Consumer Cyclical', 'Energy']:
-            beta = round(random.uniform(1.0, 2.5), 2)
-        elif sector in ['Healthcare', 'Financial Services', 'Communication Services']:
-            beta = round(random.uniform(0.8, 1.8), 2)
-        else:
-            beta = round(random.uniform(0.5, 1.2), 2)
-        
-        # Risk adjustment based on company size
-        if market_cap < 2:  # Small cap adjustment
-            beta *= random.uniform(1.1, 1.3)
-        elif market_cap > 100:  # Very large cap adjustment
-            beta *= random.uniform(0.8, 0.95)
-        
-        # Growth metrics - PEG relates PE to growth rate
-        earnings_growth_3yr = round(base_growth + random.uniform(-5, 5), 2)
-        revenue_growth_3yr = round(earnings_growth_3yr + random.uniform(-3, 3), 2)
-        
-        # PEG ratio - Price/Earnings to Growth
-        if not pd.isna(pe_ratio) and earnings_growth_3yr > 0:
-            peg_ratio = round(pe_ratio / earnings_growth_3yr, 2)
-            # Very high PEG usually indicates overvaluation or error, cap it
-            peg_ratio = min(5.0, peg_ratio)
-        else:
-            peg_ratio = float('nan')
-        
-        # Profitability metrics - related to sector and growth
-        profit_margin = round(base_profitability + random.uniform(-5, 5), 2)
-        operating_margin = round(profit_margin + random.uniform(-3, 8), 2)
-        
-        # Adjust profitability for specific industries
-        if industry in ['Biotechnology', 'Pharmaceuticals'] and random.random() < 0.4:
-            # Many biotech companies are pre-profit
-            profit_margin = round(random.uniform(-50, 0), 2)
-            operating_margin = round(random.uniform(-60, -10), 2)
-        
-        # Return metrics based on profitability
-        roa = round(profit_margin * random.uniform(0.2, 0.6), 2)  # ROA is usually lower than profit margin
-        roe = round(profit_margin * random.uniform(1.0, 2.5), 2)  # ROE is usually higher than profit margin
-        
-        # Valuation metrics
-        pb_ratio = round(random.uniform(1, 8) * (1 + (earnings_growth_3yr/100)), 2)
-        ps_ratio = round(random.uniform(1, 10) * (1 + (revenue_growth_3yr/100)), 2)
-        ev_to_ebitda = round(random.uniform(5, 25) * (1 + (earnings_growth_3yr/200)), 2)
-        
-        # Debt metrics - related to sector stability
-        if sector in ['Utilities', 'Real Estate', 'Financial Services']:
-            debt_to_equity = round(random.uniform(1.0, 3.0), 2)
-        else:
-            debt_to_equity = round(random.uniform(0.1, 1.5), 2)
-        
-        # Current ratio (liquidity)
-        if sector in ['Technology', 'Healthcare'] and profit_margin > 15:
-            current_ratio = round(random.uniform(1.5, 4.0), 2)  # Tech often has better liquidity
-        else:
-            current_ratio = round(random.uniform(0.8, 2.5), 2)
-        
-        # Historical performance
-        # Stock returns are correlated with growth and overall market
-        market_performance = random.uniform(-5, 20)  # General market performance
-        stock_alpha = (earnings_growth_3yr - 10) / 5  # Company-specific performance
-        avg_return_1yr = round(market_performance + stock_alpha + random.uniform(-15, 15), 2)
-        
-        # Volatility is related to beta and size
-        volatility_1yr = round(15 * beta * (1 + random.uniform(-0.3, 0.3)), 2)
-        
-        # Risk-adjusted metrics
-        risk_free_rate = 2.0  # Assume 2% risk-free rate
-        if volatility_1yr > 0:
-            sharpe_ratio = round((avg_return_1yr - risk_free_rate) / volatility_1yr, 2)
-        else:
-            sharpe_ratio = 0
-        
-        max_drawdown = round(-1 * (volatility_1yr * random.uniform(1.5, 3.0)), 2)
-        
-        # ESG metrics - some sectors score better than others
-        if sector in ['Technology', 'Healthcare', 'Utilities']:
-            esg_base = random.uniform(60, 90)
-        elif sector in ['Financial Services', 'Consumer Defensive', 'Communication Services']:
-            esg_base = random.uniform(50, 80)
-        else:
-            esg_base = random.uniform(30, 70)
-        
-        esg_score = round(esg_base + random.uniform(-10, 10), 2)
-        esg_score = max(min(esg_score, 100), 0)  # Clamp between 0 and 100
-        
-        # Market type based on market cap
-        if market_cap > 50:
-            market_type = 'Large Cap'
-        elif market_cap > 10:
-            market_type = 'Mid Cap'
-        else:
-            market_type = 'Small Cap'
-        
-        # Exchange distribution
-        if random.random() < 0.6:  # 60% on NYSE
-            exchange = 'NYSE'
-        else:
-            exchange = 'NASDAQ'
-        
-        # Create company name - often related to ticker
-        company_name = f"{ticker} {random.choice(['Inc.', 'Corp.', 'Group', 'Technologies', 'Holdings', 'Pharmaceuticals', 'Energy', 'Solutions', 'Systems', 'Brands'])}"
-        
-        data.append({
-            'ticker': ticker,
-            'company_name': company_name,
-            'sector': sector,
-            'industry': industry,
-            'market_type': market_type,
-            'exchange': exchange,
-            'price': price,
-            'market_cap': market_cap,
-            'pe_ratio': pe_ratio,
-            'peg_ratio': peg_ratio,
-            'pb_ratio': pb_ratio,
-            'ps_ratio': ps_ratio,
-            'dividend_yield': dividend_yield,
-            'beta': beta,
-            'profit_margin': profit_margin,
-            'operating_margin': operating_margin,
-            'roa': roa,
-            'roe': roe,
-            'ev_to_ebitda': ev_to_ebitda,
-            'debt_to_equity': debt_to_equity,
-            'current_ratio': current_ratio,
-            'revenue_growth_3yr': revenue_growth_3yr,
-            'earnings_growth_3yr': earnings_growth_3yr,
-            'shares_outstanding': shares_outstanding,
-            'avg_return_1yr': avg_return_1yr,
-            'volatility_1yr': volatility_1yr,
-            'sharpe_ratio': sharpe_ratio,
-            'max_drawdown': max_drawdown,
-            'esg_score': esg_score
-        })
-    
-    # Create DataFrame
-    stocks_df = pd.DataFrame(data)
-    
-    # ---- Generate historical price data ----
-    def generate_historical_prices(ticker_data, days=252*2, end_date=None):
-        """Generate 2 years of historical price data with realistic patterns"""
-        ticker = ticker_data['ticker']
-        current_price = ticker_data['price']
-        volatility = ticker_data['volatility_1yr'] / 100
-        beta = ticker_data['beta']
-        growth_trend = ticker_data['revenue_growth_3yr'] / 100 / 252  # Daily growth factor
-        
-        # Adjusting for market trend
-        market_trend = 0.0001  # Slight upward bias in market
-        
-        # Base parameters
-        daily_volatility = volatility / np.sqrt(252)
-        
-        if not end_date:
-            end_date = datetime.now().date()
-        
-        start_date = end_date - timedelta(days=days)
-        
-        # Generate dates (trading days only)
-        all_dates = []
-        current_date = start_date
-        while current_date <= end_date:
-            if current_date.weekday() < 5:  # Monday to Friday
-                all_dates.append(current_date)
-            current_date += timedelta(days=1)
-        
-        # Generate market returns (common factor)
-        market_returns = np.random.normal(market_trend, 0.01, len(all_dates))
-        
-        # Add seasonality and some market cycles (simplified)
-        t = np.arange(len(all_dates))
-        # Add a slow cycle (approx 1 year)
-        market_cycle = 0.0002 * np.sin(2 * np.pi * t / 252)
-        # Add a faster cycle (approx 1 quarter)
-        market_cycle += 0.0001 * np.sin(2 * np.pi * t / 63)
-        market_returns += market_cycle
-        
-        # Generate stock-specific returns
-        stock_specific_vol = daily_volatility * (1 - 0.6)  # Assuming 60% of volatility is market-related
-        stock_specific = np.random.normal(growth_trend, stock_specific_vol, len(all_dates))
-        
-        # Combine returns (beta * market + stock specific)
-        total_returns = (beta * market_returns) + stock_specific
-        
-        # Convert returns to prices
-        prices = [current_price / (1 + sum(total_returns[i:]) + 0.0001) for i in range(len(total_returns))]
-        prices.reverse()  # Since we calculated backward from current price
-        
-        # Create DataFrame
-        price_data = pd.DataFrame({
-            'date': all_dates,
-            'ticker': ticker,
-            'price': prices
-        })
-        
-        return price_data
+    The existing ids[i, :filled[i]] must already be distinct and count as taken.
+    Rows drawing from at most _SMALL_POOL values are sampled exactly by sorting
+    random keys; larger ones draw with replacement and redraw rows that collided.
+    """
+    columns = np.arange(ids.shape[1])
+    need = (columns >= filled[:, None]) & (columns < total[:, None])
+    small = sizes <= _SMALL_POOL
     
-    # Generate prices for all stocks (this can be time-consuming for many stocks)
-    # To save time, let's generate for a subset of stocks
-    price_sample_size = min(50, num_stocks)  # Generate for at most 50 stocks
-    historical_prices = pd.DataFrame()
+    rows = np.flatnonzero(small & need.any(axis=1))
+    for start in range(0, len(rows), 4096):
+        block = rows[start:start + 4096]
+        keys = rng.random((len(block), int(sizes[block].max())))
+        keys[np.arange(keys.shape[1]) >= sizes[block][:, None]] = np.inf
+        taken = columns < filled[block][:, None]
+        keys[np.nonzero(taken)[0], ids[block][taken]] = np.inf
+        order = np.argsort(keys, axis=1)
+        block_need = need[block]
+        picks = order[np.nonzero(block_need)[0], (columns - filled[block][:, None])[block_need]]
+        block_ids = ids[block]
+        block_ids[block_need] = picks
+        ids[block] = block_ids
+        
+    rows = np.flatnonzero(~small & need.any(axis=1))
+    while len(rows):
+        row_need = need[rows]
+        row_ids = ids[rows]
+        row_ids[row_need] = (rng.random(int(row_need.sum())) * np.repeat(sizes[rows], row_need.sum(axis=1))).astype(np.int64)
+        ids[rows] = row_ids
+        
+        # Rows with a repeated value among their valid entries draw again
+        valid = columns < total[rows][:, None]
+        ordered = np.sort(np.where(valid, row_ids, -1 - columns), axis=1)
+        rows = rows[(ordered[:, 1:] == ordered[:, :-1]).any(axis=1)]
+
+def generate_user_chunk(universe, first_user, num_users, rng):
+    """
+    Generate portfolios and interactions for users first_user .. first_user + num_users - 1.
     
-    for i, row in stocks_df.head(price_sample_size).iterrows():
-        ticker_prices = generate_historical_prices(row)
-        historical_prices = pd.concat([historical_prices, ticker_prices])
+    Parameters:
+    universe (dict): Stock arrays from build_universe
+    first_user (int): Number of the first user in the chunk (user_<n>)
+    num_users (int): Users in the chunk
+    rng (np.random.Generator): The chunk's own random number source
     
-    # ---- Generate user portfolios ----
-    def generate_user_portfolios(stocks_df, num_users=1000):
-        tickers = stocks_df['ticker'].tolist()
-        sectors = {ticker: sector for ticker, sector in zip(stocks_df['ticker'], stocks_df['sector'])}
-        
-        user_data = []
-        for user_id in range(1, num_users+1):
-            # Different user investment strategies
-            strategy = random.choice([
-                'diversified',       # Holds stocks across many sectors
-                'sector_focused',    # Focuses on 1-2 sectors
-                'large_cap_biased',  # Prefers large caps
-                'small_cap_biased',  # Prefers small caps
-                'dividend_focused',  # Focuses on dividend stocks
-                'growth_focused',    # Focuses on growth stocks
-                'random'             # Random selection
-            ])
-            
-            # Different portfolio sizes based on strategy
-            if strategy == 'diversified':
-                portfolio_size = random.randint(8, 20)
-            elif strategy == 'sector_focused':
-                portfolio_size = random.randint(5, 12)
-            else:
-                portfolio_size = random.randint(3, 15)
-                
-            # Select stocks based on strategy
-            if strategy == 'sector_focused':
-                # Choose 1-2 sectors to focus on
-                focus_sectors = random.sample(list(set(sectors.values())), random.randint(1, 2))
-                candidate_tickers = [t for t, s in sectors.items() if s in focus_sectors]
-                # Ensure we have enough stocks
-                if len(candidate_tickers) < portfolio_size:
-                    # Add some stocks from other sectors
-                    other_tickers = [t for t in tickers if t not in candidate_tickers]
-                    candidate_tickers.extend(random.sample(other_tickers, portfolio_size - len(candidate_tickers)))
-                selected_tickers = random.sample(candidate_tickers, min(portfolio_size, len(candidate_tickers)))
-            
-            elif strategy == 'large_cap_biased':
-                # Prefer stocks with larger market caps
-                large_caps = stocks_df[stocks_df['market_type'] == 'Large Cap']['ticker'].tolist()
-                if len(large_caps) >= portfolio_size * 0.7:
-                    primary = random.sample(large_caps, int(portfolio_size * 0.7))
-                    secondary = random.sample([t for t in tickers if t not in primary], portfolio_size - len(primary))
-                    selected_tickers = primary + secondary
-                else:
-                    selected_tickers = random.sample(tickers, portfolio_size)
-            
-            elif strategy == 'small_cap_biased':
-                # Prefer stocks with smaller market caps
-                small_caps = stocks_df[stocks_df['market_type'] == 'Small Cap']['ticker'].tolist()
-                if len(small_caps) >= portfolio_size * 0.7:
-                    primary = random.sample(small_caps, int(portfolio_size * 0.7))
-                    secondary = random.sample([t for t in tickers if t not in primary], portfolio_size - len(primary))
-                    selected_tickers = primary + secondary
-                else:
-                    selected_tickers = random.sample(tickers, portfolio_size)
-            
-            elif strategy == 'dividend_focused':
-                # Prefer stocks with dividends
-                dividend_stocks = stocks_df[stocks_df['dividend_yield'] > 0]['ticker'].tolist()
-                if len(dividend_stocks) >= portfolio_size * 0.8:
-                    primary = random.sample(dividend_stocks, int(portfolio_size * 0.8))
-                    secondary = random.sample([t for t in tickers if t not in primary], portfolio_size - len(primary))
-                    selected_tickers = primary + secondary
-                else:
-                    selected_tickers = random.sample(tickers, portfolio_size)
-            
-            elif strategy == 'growth_focused':
-                # Prefer growth stocks
-                growth_stocks = stocks_df[stocks_df['earnings_growth_3yr'] > 10]['ticker'].tolist()
-                if len(growth_stocks) >= portfolio_size * 0.7:
-                    primary = random.sample(growth_stocks, int(portfolio_size * 0.7))
-                    secondary = random.sample([t for t in tickers if t not in primary], portfolio_size - len(primary))
-                    selected_tickers = primary + secondary
-                else:
-                    selected_tickers = random.sample(tickers, portfolio_size)
-            
-            else:  # diversified or random
-                selected_tickers = random.sample(tickers, portfolio_size)
-            
-            # Generate portfolio weights that sum to 1
-            # Use a Dirichlet distribution for more realistic allocations
-            alpha = [1.0] * len(selected_tickers)  # Equal concentration parameter
-            
-            # Some investors heavily weight certain positions
-            if random.random() < 0.3:  # 30% of users have concentrated positions
-                # Randomly boost 1-3 positions
-                for _ in range(random.randint(1, 3)):
-                    idx = random.randint(0, len(alpha)-1)
-                    alpha[idx] = random.uniform(3.0, 10.0)  # Higher alpha = higher weight
-            
-            weights = np.random.dirichlet(alpha)
-            weights = weights / weights.sum()  # Normalize to ensure sum = 1
-            
-            # Record user portfolio
-            for i, ticker in enumerate(selected_tickers):
-                user_data.append({
-                    'user_id': f'user_{user_id}',
-                    'ticker': ticker,
-                    'weight': round(weights[i], 4)
-                })
-                
-            # Add some user interactions/views (for collaborative filtering)
-            # Users often view stocks similar to what they own
-            viewed_tickers = set()
-            
-            # First add some views of owned stocks (users research what they own)
-            for ticker in selected_tickers:
-                if random.random() < 0.7:  # 70% chance they've viewed each owned stock
-                    viewed_tickers.add(ticker)
-            
-            # Then add other viewed stocks
-            candidate_tickers = [t for t in tickers if t not in viewed_tickers]
-            # Calculate how many additional views we can add
-            remaining_views = min(15 - len(viewed_tickers), len(candidate_tickers))
-            if remaining_views > 0:
-                additional_views = random.sample(candidate_tickers, remaining_views)
-                viewed_tickers.update(additional_views)
-            
-            # Create view interactions with different engagement levels
-            for ticker in viewed_tickers:
-                engagement = random.choice(['view', 'research', 'watchlist', 'comparison'])
-                frequency = random.randint(1, 10)  # How many times they interacted
-                
-                user_data.append({
-                    'user_id': f'user_{user_id}',
-                    'ticker': ticker,
-                    'interaction_type': engagement,
-                    'interaction_count': frequency
-                })
-        
-        return pd.DataFrame(user_data)
+    Returns:
+    dict: CSR arrays - holdings (offsets, stock ids, weights) and views (offsets, stock ids, types, counts)
+    """
+    num_stocks = len(universe['tickers'])
+    strategies = rng.integers(0, len(STRATEGIES), num_users)
+    strategy_names = np.array(STRATEGIES)[strategies]
     
-    # Generate user portfolios with a meaningful number of users
-    num_users = min(5000, num_stocks * 10)  # Scale users with stock count
-    user_data = generate_user_portfolios(stocks_df, num_users)
+    # Portfolio sizes based on strategy
+    sizes = np.select(
+        [strategy_names == 'diversified', strategy_names == 'sector_focused'],
+        [rng.integers(8, 21, num_users), rng.integers(5, 13, num_users)],
+        rng.integers(3, 16, num_users)
+    )
+    sizes = np.minimum(sizes, num_stocks)
+    width = int(sizes.max()) if num_users else 0
     
-    # Split user data into portfolios and interactions
-    user_portfolios = user_data[user_data['weight'].notna()].copy()
-    user_interactions = user_data[user_data['interaction_type'].notna()].copy()
+    # Each user takes num_primary stocks from a strategy pool (positions into it), the rest from anywhere
+    holdings = np.zeros((num_users, width), dtype=np.int64)
+    num_primary = np.zeros(num_users, dtype=np.int64)
+    pool_sizes = np.zeros(num_users, dtype=np.int64)
     
-    # Save datasets
-    stocks_data_path = os.path.join(output_dir, 'stocks_data.csv')
-    stocks_df.to_csv(stocks_data_path, index=False)
+    # Sector focused: the 1-2 focus sectors' stocks, topped up from other sectors if there are too few
+    sector_counts = universe['sector_counts']
+    focused = np.flatnonzero(strategy_names == 'sector_focused')
+    first_sector = rng.integers(0, len(sector_counts), len(focused))
+    second_sector = (first_sector + 1 + rng.integers(0, max(len(sector_counts) - 1, 1), len(focused))) % len(sector_counts)
+    two_sectors = (rng.integers(1, 3, len(focused)) == 2) & (len(sector_counts) > 1)
+    first_count = sector_counts[first_sector]
+    pool_sizes[focused] = first_count + np.where(two_sectors, sector_counts[second_sector], 0)
+    num_primary[focused] = np.minimum(sizes[focused], pool_sizes[focused])
     
-    historical_prices_path = os.path.join(output_dir, 'historical_prices.csv')
-    historical_prices.to_csv(historical_prices_path, index=False)
+    # Biased strategies: 70-80% from their pool when it is big enough, otherwise all at random
+    for name, (pool, share) in universe['pools'].items():
+        users = np.flatnonzero(strategy_names == name)
+        enough = len(pool) >= sizes[users] * share
+        pool_sizes[users] = len(pool)
+        num_primary[users] = np.where(enough, (sizes[users] * share).astype(np.int64), 0)
+        
+    _fill_distinct(rng, holdings, np.zeros(num_users, dtype=np.int64), num_primary, np.maximum(pool_sizes, 1))
     
-    user_portfolios_path = os.path.join(output_dir, 'user_portfolios.csv')
-    user_portfolios.to_csv(user_portfolios_path, index=False)
+    # Map pool positions to stock rows
+    columns = np.arange(width)
+    primary = columns < num_primary[:, None]
+    focused_primary = primary[focused]
+    positions = holdings[focused][focused_primary]
+    in_first = positions < np.repeat(first_count, focused_primary.sum(axis=1))
+    sector = np.where(in_first, np.repeat(first_sector, focused_primary.sum(axis=1)),
+                      np.repeat(second_sector, focused_primary.sum(axis=1)))
+    offset = np.where(in_first, positions, positions - np.repeat(first_count, focused_primary.sum(axis=1)))
+    focused_holdings = holdings[focused]
+    focused_holdings[focused_primary] = universe['sector_order'][universe['sector_offsets'][sector] + offset]
+    holdings[focused] = focused_holdings
+    for name, (pool, share) in universe['pools'].items():
+        users = np.flatnonzero(strategy_names == name)
+        user_primary = primary[users]
+        user_holdings = holdings[users]
+        user_holdings[user_primary] = pool[user_holdings[user_primary]]
+        holdings[users] = user_holdings
+        
+    _fill_distinct(rng, holdings, num_primary, sizes, np.full(num_users, num_stocks))
     
-    user_interactions_path = os.path.join(output_dir, 'user_interactions.csv')
-    user_interactions.to_csv(user_interactions_path, index=False)
+    # Portfolio weights that sum to 1, from a Dirichlet distribution for realistic allocations;
+    # 30% of users have 1-3 concentrated positions (higher alpha = higher weight)
+    held = columns < sizes[:, None]
+    alpha = np.ones((num_users, width))
+    concentrated = np.flatnonzero(rng.random(num_users) < 0.3)
+    boosts = rng.integers(1, 4, len(concentrated))
+    for boost in range(3):
+        users = concentrated[boosts > boost]
+        alpha[users, (rng.random(len(users)) * sizes[users]).astype(np.int64)] = rng.uniform(3.0, 10.0, len(users))
+    gammas = np.where(held, rng.gamma(alpha), 0.0)
+    weights = np.round(gammas / gammas.sum(axis=1, keepdims=True), 4)
     
-    print(f"Generated {len(stocks_df)} stocks")
-    print(f"Generated {historical_prices['ticker'].nunique()} stocks with historical price data")
-    print(f"Generated {user_portfolios['user_id'].nunique()} user portfolios")
-    print(f"Generated {len(user_interactions)} user interactions")
+    # Views: users research most of what they own (70% chance each), then browse other stocks up to MAX_VIEWS
+    views = np.full((num_users, max(width, MAX_VIEWS)), -1, dtype=np.int64)
+    viewed_owned = held & (rng.random((num_users, width)) < 0.7)
+    num_viewed = viewed_owned.sum(axis=1)
+    order = np.argsort(~viewed_owned, axis=1, kind='stable')
+    views[:, :width] = np.where(columns < num_viewed[:, None], np.take_along_axis(holdings, order, axis=1), -1)
+    num_views = np.maximum(num_viewed, np.minimum(MAX_VIEWS, num_stocks))
+    _fill_distinct(rng, views, num_viewed, num_views, np.full(num_users, num_stocks))
     
-    return stocks_data_path, historical_prices_path, user_portfolios_path, user_interactions_path
+    view_columns = np.arange(views.shape[1])
+    viewed = view_columns < num_views[:, None]
+    return {
+        'first_user': first_user,
+        'holding_offsets': np.concatenate(([0], np.cumsum(sizes))),
+        'holding_ids': holdings[held],
+        'holding_weights': weights[held],
+        'view_offsets': np.concatenate(([0], np.cumsum(num_views))),
+        'view_ids': views[viewed],
+        'view_types': rng.integers(0, len(ENGAGEMENT_TYPES), int(num_views.sum())),
+        'view_counts': rng.integers(1, 11, int(num_views.sum()))
+    }
 
-# Generate datasets
-print("Starting data generation...")
-generate_comprehensive_stock_data(num_stocks=500, output_dir="stock_recommender_data")
+def format_user_chunk(chunk, tickers, interactions=True):
+    """
+    Render a chunk as CSV text for user_portfolios.csv, users_unique_portfolio.csv and user_interactions.csv.
+    
+    Parameters:
+    chunk (dict): Arrays from generate_user_chunk
+    tickers (np.ndarray): Ticker of each stock row
+    interactions (bool): Whether to render the interactions file too
+    
+    Returns:
+    tuple: (portfolio rows, unique portfolio rows, interaction rows or None) as str
+    """
+    offsets = chunk['holding_offsets']
+    num_users = len(offsets) - 1
+    user_ids = [f"user_{user}" for user in range(chunk['first_user'], chunk['first_user'] + num_users)]
+    holding_users = np.repeat(np.array(user_ids, dtype=object), np.diff(offsets))
+    holding_tickers = tickers[chunk['holding_ids']]
+    weights = [repr(weight) for weight in chunk['holding_weights'].tolist()]
+    
+    portfolios = ''.join(f"{user},{ticker},{weight},,\n"
+                         for user, ticker, weight in zip(holding_users, holding_tickers, weights))
+                         
+    # One row per user with list cells, like the groupby of user_portfolios the recommender reads
+    quoted = [f"'{ticker}'" for ticker in holding_tickers]
+    unique_rows = []
+    for user, start, stop in zip(user_ids, offsets[:-1].tolist(), offsets[1:].tolist()):
+        nans = ', '.join(['nan'] * (stop - start))
+        unique_rows.append(f"{user},\"[{', '.join(quoted[start:stop])}]\",\"[{', '.join(weights[start:stop])}]\","
+                           f"\"[{nans}]\",\"[{nans}]\"\n")
+    unique = ''.join(unique_rows)
+    
+    if not interactions:
+        return portfolios, unique, None
+    view_users = np.repeat(np.array(user_ids, dtype=object), np.diff(chunk['view_offsets']))
+    interaction_rows = ''.join(
+        f"{user},{ticker},,{engagement},{count}.0\n"
+        for user, ticker, engagement, count in zip(view_users, tickers[chunk['view_ids']],
+                                                   ENGAGEMENT_TYPES[chunk['view_types']],
+                                                   chunk['view_counts'].tolist())
+    )
+    return portfolios, unique, interaction_rows
 
-# Print samples to verify
-print("\nTrying to read generated files...")
-try:
-    print("\nReading stocks data...")
-    stocks_df = pd.read_csv("stock_recommender_data/stocks_data.csv")
-    print("Successfully read stocks data")
-    print("\nSample stock data:")
-    print(stocks_df.head())
+# The universe each pool worker received in _init_worker
+_worker_universe = None
 
-    print("\nReading historical price data...")
-    historical_prices = pd.read_csv("stock_recommender_data/historical_prices.csv")
-    print("Successfully read historical prices")
-    print("\nSample historical price data:")
-    print(historical_prices.head())
+def _init_worker(universe):
+    global _worker_universe
+    _worker_universe = universe
 
-    print("\nReading user portfolios...")
-    user_portfolios = pd.read_csv("stock_recommender_data/user_portfolios.csv")
-    print("Successfully read user portfolios")
-    print("\nSample user portfolios:")
-    print(user_portfolios.head())
+def _user_chunk_rows(first_user, num_users, seed, interactions):
+    """Generate and render one chunk in a worker, with the chunk's own seeded generator."""
+    rng = np.random.default_rng(seed)
+    chunk = generate_user_chunk(_worker_universe, first_user, num_users, rng)
+    return format_user_chunk(chunk, _worker_universe['tickers'], interactions) + (num_users,)
 
-    print("\nReading user interactions...")
-    user_interactions = pd.read_csv("stock_recommender_data/user_interactions.csv")
-    print("Successfully read user interactions")
-    print("\nSample user interactions:")
-    print(user_interactions.head())
+def generate_dataset(num_stocks=500, num_users=None, output_dir="stock_recommender_data", seed=42,
+                     workers=None, chunk_size=50000, interactions=True, price_history_stocks=None,
+                     price_days=252*2):
+    """
+    Generate a synthetic stock universe and user base and write it to output_dir.
+    
+    Users are generated in chunks, each with its own generator seeded from seed,
+    so the output is the same for any number of workers. Chunks are spread over
+    a process pool and streamed to disk in order, so memory stays bounded by a
+    few chunks regardless of the number of users.
+    
+    Parameters:
+    num_stocks (int): Number of stocks to generate
+    num_users (int): Number of user portfolios (defaults to 10 per stock, at most 5000)
+    output_dir (str): Directory to save the generated data
+    seed (int): Seed for every random number stream
+    workers (int): Worker processes for user generation (defaults to the CPU count; 1 runs inline)
+    chunk_size (int): Users per chunk
+    interactions (bool): Whether to write user_interactions.csv
+    price_history_stocks (int): Stocks that get historical price data (defaults to all of them)
+    price_days (int): Trading days of price history per stock
+    
+    Returns:
+    dict: Paths of the generated CSV files by dataset name
+    """
+    if num_users is None:
+        num_users = min(5000, num_stocks * 10)  # Scale users with stock count
+    os.makedirs(output_dir, exist_ok=True)
+    
+    stock_seed, price_seed, user_seed = np.random.SeedSequence(seed).spawn(3)
+    stocks_df = generate_stocks(num_stocks, np.random.default_rng(stock_seed))
+    
+    paths = {
+        'stocks_data': os.path.join(output_dir, 'stocks_data.csv'),
+        'historical_prices': os.path.join(output_dir, 'historical_prices.csv'),
+        'user_portfolios': os.path.join(output_dir, 'user_portfolios.csv'),
+        'unique_portfolios': os.path.join(output_dir, 'users_unique_portfolio.csv'),
+        'user_interactions': os.path.join(output_dir, 'user_interactions.csv')
+    }
+    stocks_df.to_csv(paths['stocks_data'], index=False)
+    
+    # Historical prices for the whole universe (or its first price_history_stocks stocks)
+    price_stocks = stocks_df if price_history_stocks is None else stocks_df.head(price_history_stocks)
+    num_priced = write_historical_prices(price_stocks, paths['historical_prices'], np.random.default_rng(price_seed),
+                                         days=price_days)
+    
+    # ---- Generate user portfolios, streamed to disk chunk by chunk ----
+    universe = build_universe(stocks_df)
+    starts = list(range(1, num_users + 1, chunk_size))
+    chunk_seeds = user_seed.spawn(len(starts))
+    tasks = [(start, min(chunk_size, num_users + 1 - start), chunk_seed, interactions)
+             for start, chunk_seed in zip(starts, chunk_seeds)]
+             
+    header = "user_id,ticker,weight,interaction_type,interaction_count\n"
+    files = [open(paths['user_portfolios'], 'w'), open(paths['unique_portfolios'], 'w')]
+    if interactions:
+        files.append(open(paths['user_interactions'], 'w'))
+    else:
+        del paths['user_interactions']
+        
+    try:
+        for f in files:
+            f.write(header)
+            
+        done = 0
+        def write(rows):
+            nonlocal done
+            for f, text in zip(files, rows):
+                f.write(text)
+            done += rows[-1]
+            print(f"Generated {done}/{num_users} user portfolios", flush=True)
+            
+        if workers == 1:
+            _init_worker(universe)
+            for task in tasks:
+                write(_user_chunk_rows(*task))
+        else:
+            # Keep a bounded number of chunks in flight so finished chunks are written as they arrive
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(universe,)) as pool:
+                in_flight = deque()
+                window = 2 * (workers or os.cpu_count() or 1)
+                for task in tasks:
+                    in_flight.append(pool.submit(_user_chunk_rows, *task))
+                    if len(in_flight) >= window:
+                        write(in_flight.popleft().result())
+                while in_flight:
+                    write(in_flight.popleft().result())
+    finally:
+        for f in files:
+            f.close()
+            
+    print(f"Generated {len(stocks_df)} stocks")
+    print(f"Generated {num_priced} stocks with historical price data")
+    print(f"Generated {num_users} user portfolios")
+    
+    return paths
 
-    # Now let's verify the size of our datasets
-    print("\nDataset sizes:")
-    print(f"Stocks: {len(stocks_df)} records")
-    print(f"Historical prices: {len(historical_prices)} records")
-    print(f"User portfolios: {len(user_portfolios)} records")
-    print(f"User interactions: {len(user_interactions)} records")
-except Exception as e:
-    print(f"Error reading files: {str(e)}")
+def generate_comprehensive_stock_data(num_stocks=500, output_dir="stock_recommender_data", num_users=None, seed=42):
+    """
+    Generate a comprehensive stock dataset for training a recommendation system
+    
+    Parameters:
+    num_stocks (int): Number of stocks to generate
+    output_dir (str): Directory to save the generated data
+    num_users (int): Number of user portfolios (defaults to 10 per stock, at most 5000)
+    seed (int): Seed for every random number stream
+    
+    Returns:
+    tuple: Paths to the generated CSV files
+    """
+    paths = generate_dataset(num_stocks=num_stocks, num_users=num_users, output_dir=output_dir, seed=seed)
+    return paths['stocks_data'], paths['historical_prices'], paths['user_portfolios'], paths['user_interactions']
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic stock and portfolio data for training and load testing')
+    parser.add_argument('--stocks', type=int, default=500, help='Number of stocks')
+    parser.add_argument('--users', type=int, default=None, help='Number of users (default: 10 per stock, at most 5000)')
+    parser.add_argument('--output-dir', '-o', type=str, default='stock_recommender_data', help='Directory for the CSV files')
+    parser.add_argument('--seed', type=int, default=42, help='Seed for every random number stream')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: CPU count)')
+    parser.add_argument('--chunk-size', type=int, default=50000, help='Users generated per chunk')
+    parser.add_argument('--no-interactions', action='store_true', help='Skip user_interactions.csv')
+    parser.add_argument('--price-history-stocks', type=int, default=None, help='Stocks that get historical prices (default: all)')
+    parser.add_argument('--price-days', type=int, default=252*2, help='Trading days of price history')
+    args = parser.parse_args()
+    
+    print("Starting data generation...")
+    start = time.perf_counter()
+    paths = generate_dataset(num_stocks=args.stocks, num_users=args.users, output_dir=args.output_dir,
+                             seed=args.seed, workers=args.workers, chunk_size=args.chunk_size,
+                             interactions=not args.no_interactions, price_history_stocks=args.price_history_stocks,
+                             price_days=args.price_days)
+    print(f"\nData generation complete in {time.perf_counter() - start:.1f}s:")
+    for name, path in paths.items():
+        print(f"  {name}: {path} ({os.path.getsize(path) / (1 << 20):.1f} MB)")
 
-print("\nData generation complete. You can now use these files to train your stock recommendation system.")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
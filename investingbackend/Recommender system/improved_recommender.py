@@ -1,17 +1,26 @@
 import pandas as pd
 import numpy as np
-import ast
 from sklearn.preprocessing import StandardScaler
-from sklearn.metrics.pairwise import cosine_similarity
+from scipy import sparse
 import joblib
 import os
+import uuid
+from model_artifact import is_artifact, read_artifact, write_artifact
+from ann_index import IVFIndex
+from portfolio_store import PortfolioStore
+from correlation_index import correlation_neighbors, standardized_returns
+from price_features import MIN_FEATURE_COVERAGE, feature_coverage, price_features, units_mismatch
+from price_history import open_price_history
+from risk_model import estimate_risk_model, estimated_stocks, portfolio_risk_batch, volatility_variance
+from recommender_runtime import SIMILARITY_MODES, RecommenderRuntime, explanation_mode
 
-class ImprovedStockRecommender:
+class ImprovedStockRecommender(RecommenderRuntime):
     def __init__(self):
+        super().__init__()
         self.stocks_data = None
         self.user_portfolios = None
-        self.unique_portfolios = None
-        self.stock_features = None
+        # Sparse (users x stocks) weight matrix view of the portfolio store
+        self.portfolio_matrix = None
         self.feature_columns = [
             'price', 'market_cap', 'pe_ratio', 'peg_ratio', 'pb_ratio', 'ps_ratio',
             'dividend_yield', 'beta', 'profit_margin', 'operating_margin', 'roa', 'roe',
@@ -20,11 +29,13 @@ class ImprovedStockRecommender:
             'max_drawdown', 'esg_score'
         ]
         self.scaler = StandardScaler()
-        # Define sector diversification thresholds
-        self.sector_concentration_threshold = 0.5  # Alert if a sector is over 50%
-        self.sector_count_min = 3  # Recommend having at least 3 sectors
+        # Memory-mapped (dates x tickers) prices, when price history was loaded
+        self.price_history = None
+        # The most recent update_stocks change, for save_delta
+        self.last_delta = None
         
-    def load_data(self, stocks_data_path, user_portfolios_path=None, unique_portfolios_path=None):
+    def load_data(self, stocks_data_path, user_portfolios_path=None, unique_portfolios_path=None,
+                  price_history_path=None):
         """
         Load stock data and user portfolios
         
@@ -32,10 +43,13 @@ class ImprovedStockRecommender:
         stocks_data_path (str): Path to the CSV file containing stock features
         user_portfolios_path (str): Path to the CSV file containing standard user portfolios
         unique_portfolios_path (str): Path to the CSV file containing unique user portfolios format
+        price_history_path (str): Price history directory or historical_prices.csv
         """
         # Load stock features
         self.stocks_data = pd.read_csv(stocks_data_path)
         self.stocks_data.set_index('ticker', inplace=True)
+        self._build_stock_columns()
+        self._build_ticker_index()
         
         # Load user portfolios if provided (standard format)
         if user_portfolios_path and os.path.exists(user_portfolios_path):
@@ -46,21 +60,133 @@ class ImprovedStockRecommender:
         # Load unique portfolios if provided
         if unique_portfolios_path and os.path.exists(unique_portfolios_path):
             self.load_unique_portfolios(unique_portfolios_path)
+        
+        if price_history_path and os.path.exists(price_history_path):
+            self.load_price_history(price_history_path)
     
     def load_unique_portfolios(self, file_path):
-        """Load and parse the unique portfolios format."""
-        df = pd.read_csv(file_path)
+        """
+        Load and parse the unique portfolios format.
+        
+        Reads a .npz file from portfolio_store.convert_portfolio_csv when given one,
+        or when an up-to-date .npz sits next to the CSV; otherwise the CSV is
+        parsed with the streaming reader.
+        """
+        if self.stocks_data is None:
+            raise ValueError("Stock data must be loaded before unique portfolios")
+        
+        npz_path = os.path.splitext(file_path)[0] + '.npz'
+        if file_path.endswith('.npz'):
+            self.portfolio_store = PortfolioStore.from_npz(file_path, self.ticker_index)
+        elif os.path.exists(npz_path) and os.path.getmtime(npz_path) >= os.path.getmtime(file_path):
+            self.portfolio_store = PortfolioStore.from_npz(npz_path, self.ticker_index)
+        else:
+            self.portfolio_store = PortfolioStore.from_csv(file_path, self.ticker_index)
+        self._build_portfolio_matrix()
+    
+    def load_price_history(self, path):
+        """
+        Open memory-mapped price history.
+        
+        A historical_prices.csv path is converted to a price history directory
+        next to it on first use, which is reused while it is newer than the CSV.
+        """
+        self.price_history = open_price_history(path)
+        return self.price_history
+    
+    def _build_stock_columns(self):
+        """
+        Materialize stock metadata as typed arrays aligned with stocks_data rows.
+        
+        Sectors are stored as integer codes into sector_names, so sector grouping
+        and masking are plain array operations.
+        """
+        self.tickers = self.stocks_data.index.to_numpy(dtype=object)
+        self.company_names = self.stocks_data['company_name'].fillna("Unknown").astype(str).to_numpy(dtype=object)
+        
+        sector_codes, sector_names = pd.factorize(self.stocks_data['sector'].fillna("Unknown").astype(str), sort=True)
+        self.sector_codes = sector_codes.astype(np.int32)
+        self.sector_names = list(sector_names)
+        
+        self.prices = self.stocks_data['price'].to_numpy(dtype=np.float64)
+        self.market_caps = self.stocks_data['market_cap'].to_numpy(dtype=np.float64)
+        self.esg_scores = self.stocks_data['esg_score'].to_numpy(dtype=np.float64)
+        self.betas = self.stocks_data['beta'].to_numpy(dtype=np.float64)
+        self._build_explanation_fragments()
+    
+    def _build_portfolio_matrix(self):
+        """Wrap the portfolio store as a sparse (users x stocks) weight matrix."""
+        self.portfolio_matrix = self.portfolio_store.to_matrix(len(self.stocks_data))
+    
+    def portfolio_weights(self, user_portfolio):
+        """
+        Convert a portfolio DataFrame to a sparse (1 x stocks) weight row.
+        
+        Parameters:
+        user_portfolio (pd.DataFrame): Portfolio with 'ticker' and 'weight' columns
+        
+        Returns:
+        sparse.csr_matrix: Weights indexed by stock row, unknown tickers dropped
+        """
+        stock_ids = user_portfolio['ticker'].map(self.ticker_index)
+        known = stock_ids.notna().to_numpy()
+        cols = stock_ids[known].to_numpy(dtype=np.int64)
+        weights = user_portfolio['weight'].to_numpy(dtype=np.float64)[known]
+        
+        return sparse.csr_matrix(
+            (weights, (np.zeros(len(cols), dtype=np.int64), cols)),
+            shape=(1, len(self.stocks_data))
+        )
+    
+    def _profiles_from_weights(self, weights):
+        """Weighted average of stock features for each row of a sparse weight matrix."""
+        profiles = np.asarray(weights @ self.stock_features)
+        total_weights = np.asarray(weights.sum(axis=1)).ravel()
+        
+        has_weight = total_weights > 0
+        profiles[has_weight] /= total_weights[has_weight, None]
+        return profiles
+    
+    def create_user_profiles(self, user_ids=None):
+        """
+        Create profiles for many unique-portfolio users with one sparse matmul.
+        
+        Parameters:
+        user_ids (list): User IDs to profile, or None for every user
+        
+        Returns:
+        np.ndarray: (users x features) matrix of user profile vectors
+        """
+        if self.portfolio_store is None:
+            raise ValueError("No unique portfolios data loaded")
         
-        # Convert string representations of lists to actual lists
-        df['ticker_list'] = df['ticker'].apply(ast.literal_eval)
-        df['weight_list'] = df['weight'].apply(ast.literal_eval)
+        if user_ids is None:
+            weights = self.portfolio_matrix
+        else:
+            weights = self.portfolio_matrix[self._portfolio_rows(user_ids)]
         
-        self.unique_portfolios = df
+        return self._profiles_from_weights(weights)
     
     def prepare_features(self):
         """
         Prepare and normalize stock features for similarity calculations.
+        
+        When price history is loaded, return and risk columns are first
+        recomputed from it with apply_price_features. If it covers at least
+        MIN_FEATURE_COVERAGE of the stocks with a year of prices, a covariance
+        model is estimated with build_risk_model and return-correlation
+        neighbors are indexed with build_correlation_index. With a sparser
+        history the covariance model would treat most stocks as uncorrelated
+        and most stocks would have no correlation neighbors, so both are left
+        to explicit calls.
+        
+        Returns:
+        dict: Share of stocks with each price column (see apply_price_features), or None without price history
         """
+        coverage = None
+        if self.price_history is not None:
+            coverage = self.apply_price_features()
+        
         # Select numeric features
         features_df = self.stocks_data[self.feature_columns].copy()
         
@@ -70,8 +196,240 @@ class ImprovedStockRecommender:
         # Normalize features
         self.stock_features = self.scaler.fit_transform(features_df)
         
-        # Create similarity matrix
-        self.similarity_matrix = cosine_similarity(self.stock_features)
+        # Index each stock's most similar neighbors instead of a dense N x N matrix
+        self._build_normalized_features()
+        self.build_neighbor_index()
+        
+        if coverage is not None and coverage['volatility_1yr'] >= MIN_FEATURE_COVERAGE:
+            self.build_risk_model()
+            self.build_correlation_index()
+        return coverage
+    
+    def apply_price_features(self, min_coverage=MIN_FEATURE_COVERAGE):
+        """
+        Recompute return and risk columns of stocks_data from price history.
+        
+        avg_return_1yr, volatility_1yr, sharpe_ratio and max_drawdown are
+        overwritten for every stock with enough price history (others keep their
+        values), after checking the derived values use the units and sign
+        convention of stocks_data (percent, drawdowns negative). The 3m/6m
+        return and volatility columns are only added to the feature columns when
+        at least min_coverage of the stocks have them, so a history covering a
+        few stocks doesn't add features that are mostly imputed means. All
+        stocks are computed together with array operations.
+        
+        Parameters:
+        min_coverage (float): Share of stocks a new column needs values for
+        
+        Returns:
+        dict: Column name -> share of stocks with a value from price history
+        """
+        if self.price_history is None:
+            raise ValueError("No price history loaded")
+        
+        features = price_features(self.price_history, self.tickers.tolist())
+        coverage = feature_coverage(features)
+        # Check every column before overwriting any
+        for column, values in features.items():
+            if column in self.stocks_data.columns and units_mismatch(
+                    values, self.stocks_data[column].to_numpy(dtype=np.float64),
+                    check_sign=column.startswith(('volatility_', 'max_drawdown'))):
+                raise ValueError(f"{column} derived from price history doesn't match the units of stocks_data; "
+                                 "expected percent returns and volatility and negative drawdowns")
+        
+        for column, values in features.items():
+            if column in self.stocks_data.columns:
+                reported = self.stocks_data[column].to_numpy(dtype=np.float64)
+                self.stocks_data[column] = np.where(np.isnan(values), reported, values)
+            elif coverage[column] >= min_coverage:
+                self.stocks_data[column] = values
+                if column not in self.feature_columns:
+                    self.feature_columns.append(column)
+        return coverage
+    
+    def apply_rolling_stats(self, stats, drift_threshold=None):
+        """
+        Refresh return and risk columns from incrementally updated statistics.
+        
+        The stocks tracked by stats (see rolling_stats.py) are upserted through
+        update_stocks, so their feature rows are rescaled with the fitted scaler
+        and the neighbor index is patched.
+        
+        Parameters:
+        stats (RollingStats): Statistics as of the latest close
+        drift_threshold (float): Passed to update_stocks
+        
+        Returns:
+        dict: The update_stocks result
+        """
+        upserts = stats.frame()
+        upserts = upserts[upserts.index.isin(self.ticker_index)]
+        return self.update_stocks(upserts=upserts[upserts.columns.intersection(self.feature_columns)],
+                                  drift_threshold=drift_threshold)
+    
+    def build_risk_model(self, rank=32, days=252):
+        """
+        Estimate the covariance model used for portfolio volatility.
+        
+        Daily log returns of every stock over the last `days` trading days give
+        a shrinkage covariance matrix stored as rank factors plus a specific
+        variance per stock (see risk_model.estimate_risk_model). Stocks without
+        enough price history are treated as uncorrelated, with the variance
+        implied by their volatility_1yr.
+        
+        Parameters:
+        rank (int): Number of factors kept
+        days (int): Trading days of returns used
+        
+        Returns:
+        dict: Description of the model (shrinkage, rank, days and coverage, the share of stocks
+            estimated from history), also stored in the artifact
+        """
+        if self.price_history is None:
+            raise ValueError("No price history loaded")
+        
+        _, returns = self.price_history.log_returns(days=days + 1, tickers=self.tickers.tolist())
+        self.risk_factors, self.specific_variance, shrinkage = estimate_risk_model(
+            returns, self._fallback_variance(np.arange(len(self.stocks_data))), rank=rank
+        )
+        self.risk_model = {'shrinkage': shrinkage, 'rank': int(self.risk_factors.shape[1]), 'days': len(returns),
+                           'coverage': float(estimated_stocks(self.risk_factors).mean())}
+        self._new_model_version()
+        return self.risk_model
+    
+    def _fallback_variance(self, row_ids):
+        """Daily variance implied by volatility_1yr, for stocks the covariance model has no history for."""
+        volatility = self.stocks_data['volatility_1yr'].to_numpy(dtype=np.float64)
+        fallback = np.nan_to_num(volatility, nan=np.nanmedian(volatility) if len(volatility) else 0.0)
+        return volatility_variance(fallback[row_ids])
+    
+    def portfolio_risk_batch(self, user_ids=None, block_size=100000):
+        """
+        Covariance-model volatility of many unique-portfolio users at once.
+        
+        Evaluates w^T Sigma w for a block of users with sparse products of the
+        portfolio matrix and the risk factors, never forming Sigma. Users with
+        less than risk_coverage_threshold of their weight in stocks with price
+        history get NaN volatility and no top contributor.
+        
+        Parameters:
+        user_ids (list): User IDs to evaluate, or None for every user
+        block_size (int): Users per block
+        
+        Returns:
+        pd.DataFrame: user_id, risk_model_coverage, portfolio_volatility (annualized %),
+            top_risk_ticker and top_risk_share
+        """
+        if self.portfolio_store is None:
+            raise ValueError("No unique portfolios data loaded")
+        if self.risk_factors is None:
+            raise ValueError("No covariance model; train with price history first")
+        
+        if user_ids is None:
+            user_ids = self.portfolio_store.user_ids
+        rows = self._portfolio_rows(user_ids)
+        total_weights = self.portfolio_store.total_weights[rows]
+        scale = np.divide(1.0, total_weights, out=np.zeros(len(rows)), where=total_weights > 0)
+        weights = sparse.diags(scale) @ self.portfolio_matrix[rows]
+        
+        volatility, top_stock, top_share = portfolio_risk_batch(weights, self.risk_factors, self.specific_variance,
+                                                                block_size)
+        coverage = weights @ estimated_stocks(self.risk_factors).astype(np.float64)
+        covered = coverage >= self.risk_coverage_threshold
+        top_tickers = np.where(covered & (top_stock >= 0), self.tickers[np.maximum(top_stock, 0)], None)
+        return pd.DataFrame({
+            'user_id': np.asarray(user_ids, dtype=object),
+            'risk_model_coverage': coverage,
+            'portfolio_volatility': np.where(covered, volatility, np.nan),
+            'top_risk_ticker': top_tickers,
+            'top_risk_share': np.where(covered, top_share, np.nan)
+        })
+    
+    def build_correlation_index(self, k=None, days=252, block_size=None, workers=None):
+        """
+        Index the top-K most return-correlated stocks of every stock.
+        
+        Correlations of daily log returns over the last `days` trading days are
+        computed blockwise in float32 (see correlation_index.py), so memory stays
+        at one block of scores per worker. Stocks without enough price history
+        get no correlation neighbors.
+        
+        Parameters:
+        k (int): Neighbors to keep per stock (defaults to self.neighbor_k)
+        days (int): Trading days of returns used
+        block_size (int): Stocks correlated per block (defaults to a ~64 MB block)
+        workers (int): Threads (defaults to the CPU count)
+        
+        Returns:
+        dict: Description of the index (k, days and coverage, the share of stocks with
+            correlation neighbors), also stored in the artifact
+        """
+        if self.price_history is None:
+            raise ValueError("No price history loaded")
+        
+        _, returns = self.price_history.log_returns(days=days + 1, tickers=self.tickers.tolist())
+        self.correlation_ids, self.correlation_scores = correlation_neighbors(
+            standardized_returns(returns), k=self.neighbor_k if k is None else k,
+            block_size=block_size, workers=workers
+        )
+        has_neighbors = (self.correlation_ids >= 0).any(axis=1)
+        self.correlation_index = {'k': int(self.correlation_ids.shape[1]), 'days': len(returns),
+                                  'coverage': float(has_neighbors.mean()) if len(has_neighbors) else 0.0}
+        self._new_model_version()
+        return self.correlation_index
+    
+    def build_neighbor_index(self, k=None, block_size=None):
+        """
+        Build the top-K most similar stocks for every stock.
+        
+        Similarities are computed for block_size stocks at a time, so memory stays
+        at block_size x N scores instead of the full N x N matrix.
+        
+        Parameters:
+        k (int): Neighbors to keep per stock (defaults to self.neighbor_k)
+        block_size (int): Stocks scored per block (defaults to a ~64 MB block)
+        """
+        if k is not None:
+            self.neighbor_k = k
+        num_stocks = len(self.normalized_features)
+        k = max(min(self.neighbor_k, num_stocks - 1), 0)
+        self.neighbor_ids, self.neighbor_scores = self._neighbor_rows(np.arange(num_stocks), k, block_size)
+        self._new_model_version()
+    
+    def _new_model_version(self):
+        """
+        Give the model a new version after an index or feature rebuild.
+        
+        Cached results are keyed by model version, so this keeps an enabled
+        result cache from serving results computed before the rebuild.
+        """
+        self.model_version = uuid.uuid4().hex
+    
+    def _neighbor_rows(self, row_ids, k, block_size=None):
+        """Top-k neighbor ids and scores for the given stock rows, scored block_size rows at a time."""
+        num_stocks = len(self.normalized_features)
+        if block_size is None:
+            block_size = max(1, (64 << 20) // (8 * max(num_stocks, 1)))
+        
+        neighbor_ids = np.zeros((len(row_ids), k), dtype=np.int32)
+        neighbor_scores = np.zeros((len(row_ids), k), dtype=np.float32)
+        if k <= 0:
+            return neighbor_ids, neighbor_scores
+        
+        for start in range(0, len(row_ids), block_size):
+            block = row_ids[start:start + block_size]
+            scores = self.normalized_features[block] @ self.normalized_features.T
+            # A stock is not its own neighbor
+            scores[np.arange(len(block)), block] = -np.inf
+            
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            order = np.argsort(-top_scores, axis=1, kind='stable')
+            
+            neighbor_ids[start:start + len(block)] = np.take_along_axis(top, order, axis=1)
+            neighbor_scores[start:start + len(block)] = np.take_along_axis(top_scores, order, axis=1)
+        
+        return neighbor_ids, neighbor_scores
     
     def expand_user_portfolio(self, user_id):
         """
@@ -83,22 +441,20 @@ class ImprovedStockRecommender:
         Returns:
         pd.DataFrame: The expanded user portfolio
         """
-        if self.unique_portfolios is None:
+        if self.portfolio_store is None:
             raise ValueError("No unique portfolios data loaded")
             
-        user_data = self.unique_portfolios[self.unique_portfolios['user_id'] == user_id]
+        holdings = self.portfolio_store.get(user_id)
         
-        if user_data.empty:
+        if holdings is None:
             raise ValueError(f"User {user_id} not found in unique portfolios data")
             
-        user_row = user_data.iloc[0]
-        tickers = user_row['ticker_list']
-        weights = user_row['weight_list']
+        ticker_ids, weights = holdings
         
         expanded_df = pd.DataFrame({
-            'user_id': [user_id] * len(tickers),
-            'ticker': tickers,
-            'weight': weights
+            'user_id': [user_id] * len(ticker_ids),
+            'ticker': self.tickers[ticker_ids],
+            'weight': weights.astype(np.float64)
         })
         
         return expanded_df
@@ -113,9 +469,14 @@ class ImprovedStockRecommender:
         Returns:
         np.ndarray: Vector representing user's stock preferences
         """
+        row = self._portfolio_row(user_input) if isinstance(user_input, str) else None
+        if row is not None:
+            # Unique-portfolio users already have a row in the portfolio matrix
+            return self._profiles_from_weights(self.portfolio_matrix[row])[0]
+        
         if isinstance(user_input, str):
             # If user_id is provided, first check in unique portfolios
-            if self.unique_portfolios is not None:
+            if self.portfolio_store is not None:
                 try:
                     user_portfolio = self.expand_user_portfolio(user_input)
                 except ValueError:
@@ -135,465 +496,210 @@ class ImprovedStockRecommender:
             user_portfolio = user_input
         
         # Create weighted average of stock features for the user's portfolio
-        user_vector = np.zeros(len(self.feature_columns))
-        total_weight = 0
+        return self._profiles_from_weights(self.portfolio_weights(user_portfolio))[0]
+    
+    def _user_holdings(self, user_id):
+        """Resolve a user's holdings, falling back to the standard-format portfolios."""
+        if self.portfolio_store is not None:
+            return super()._user_holdings(user_id)
         
-        for _, row in user_portfolio.iterrows():
-            ticker = row['ticker']
-            weight = row['weight']
-            
-            if ticker in self.stocks_data.index:
-                stock_idx = list(self.stocks_data.index).index(ticker)
-                user_vector += weight * self.stock_features[stock_idx]
-                total_weight += weight
+        user_portfolio = self.user_portfolios[self.user_portfolios['user_id'] == user_id]
+        holdings = self.portfolio_weights(user_portfolio)
+        total_weight = float(user_portfolio['weight'].sum())
         
-        if total_weight > 0:
-            user_vector /= total_weight
+        if holdings.nnz == 0 and total_weight == 0:
+            raise ValueError(f"No portfolio data found for user {user_id}")
         
-        return user_vector
+        return holdings.indices, holdings.data, total_weight
     
-    def analyze_portfolio_risks(self, user_id):
+    def analyze_portfolio_risks_batch(self, user_ids=None):
         """
-        Analyze portfolio risks and provide alerts for overconcentration or lack of diversity.
+        Run the portfolio risk checks for many unique-portfolio users at once.
+        
+        Sector weights for all users come from one sparse product of the portfolio
+        matrix with a (stocks x sectors) indicator matrix. As in
+        analyze_portfolio_risks, high_portfolio_volatility is only raised for
+        users with risk_coverage_threshold of their weight in stocks with price
+        history.
         
         Parameters:
-        user_id (str): The ID of the user
+        user_ids (list): User IDs to analyze, or None for every user
         
         Returns:
-        dict: Risk analysis results with alerts
+        pd.DataFrame: One row per alert with user_id, type, sector, weight, sector_count,
+        portfolio_volatility and message
         """
-        try:
-            # Get user portfolio
-            if self.unique_portfolios is not None:
-                user_portfolio = self.expand_user_portfolio(user_id)
-            else:
-                user_portfolio = self.user_portfolios[self.user_portfolios['user_id'] == user_id]
-                
-            if user_portfolio.empty:
-                raise ValueError(f"No portfolio data found for user {user_id}")
-            
-            # Calculate sector weights
-            sector_weights = {}
-            total_weight = 0
-            
-            for _, row in user_portfolio.iterrows():
-                ticker = row['ticker']
-                weight = row['weight']
-                total_weight += weight
-                
-                if ticker in self.stocks_data.index:
-                    stock_info = self.stocks_data.loc[ticker]
-                    # Convert Series to dict if needed
-                    if isinstance(stock_info, pd.Series):
-                        stock_info = stock_info.to_dict()
-                    
-                    # Make sure sector is a string
-                    sector = stock_info['sector']
-                    if isinstance(sector, pd.Series):
-                        sector = str(sector.iloc[0]) if not sector.empty else "Unknown"
-                        
-                    # Convert sector to string if it might be a complex object
-                    if not isinstance(sector, str):
-                        sector = str(sector)
-                    
-                    if sector in sector_weights:
-                        sector_weights[sector] += weight
-                    else:
-                        sector_weights[sector] = weight
-            
-            # Normalize sector weights
-            for sector in sector_weights:
-                sector_weights[sector] = sector_weights[sector] / total_weight if total_weight > 0 else 0
-            
-            # Sort sectors by weight
-            sorted_sectors = sorted(sector_weights.items(), key=lambda x: x[1], reverse=True)
-            
-            # Initialize risk analysis
-            risk_analysis = {
-                'alerts': [],
-                'sector_concentration': sorted_sectors,
-                'sector_count': len(sector_weights),
-                'most_concentrated_sector': sorted_sectors[0] if sorted_sectors else None,
-            }
-            
-            # Check for sector overconcentration
-            for sector, weight in sorted_sectors:
-                if weight > self.sector_concentration_threshold:
-                    alert = {
-                        'type': 'sector_overconcentration',
-                        'sector': sector,
-                        'weight': weight,
-                        'message': f"Your portfolio is heavily concentrated in the {sector} sector ({weight*100:.1f}%). Consider diversifying to reduce risk."
-                    }
-                    risk_analysis['alerts'].append(alert)
-            
-            # Check for lack of sector diversity
-            if len(sector_weights) < self.sector_count_min:
-                alert = {
-                    'type': 'lack_of_diversity',
-                    'sector_count': len(sector_weights),
-                    'message': f"Your portfolio only contains {len(sector_weights)} sectors. Consider investing in at least {self.sector_count_min} different sectors to improve diversification."
-                }
-                risk_analysis['alerts'].append(alert)
-            
-            # Check for high-beta concentration
-            high_beta_stocks = []
-            for _, row in user_portfolio.iterrows():
-                ticker = row['ticker']
-                weight = row['weight']
-                
-                if ticker in self.stocks_data.index:
-                    stock_info = self.stocks_data.loc[ticker]
-                    # Convert Series to dict if needed
-                    if isinstance(stock_info, pd.Series):
-                        stock_info = stock_info.to_dict()
-                    
-                    beta = stock_info['beta']
-                    # Convert beta to float if it's a Series
-                    if isinstance(beta, pd.Series):
-                        beta = float(beta.iloc[0]) if not beta.empty and not pd.isna(beta.iloc[0]) else 0.0
-                    
-                    if isinstance(beta, (int, float)) and beta > 1.5:  # Stocks with beta > 1.5 are considered highly volatile
-                        high_beta_stocks.append((ticker, beta, weight))
-            
-            high_beta_weight = sum(weight for _, _, weight in high_beta_stocks)
-            if high_beta_weight > 0 and total_weight > 0 and high_beta_weight / total_weight > 0.3:  # If more than 30% in high-beta stocks
-                alert = {
-                    'type': 'high_volatility',
-                    'high_beta_weight': high_beta_weight / total_weight,
-                    'message': f"Your portfolio has {high_beta_weight/total_weight*100:.1f}% allocated to high-volatility stocks. This may lead to larger swings in portfolio value."
-                }
-                risk_analysis['alerts'].append(alert)
-            
-            return risk_analysis
-            
-        except Exception as e:
-            print(f"Debug - Error in analyze_portfolio_risks: {str(e)}")
-            import traceback
-            traceback.print_exc()
-            # Return a simple structure instead of raising an error
-            return {
-                'alerts': [],
-                'sector_concentration': [],
-                'sector_count': 0,
-                'error': str(e)
-            }
-
-    def generate_diversification_recommendations(self, user_id, n=5):
-        """
-        Generate stock recommendations specifically for diversification.
+        if self.portfolio_store is None:
+            raise ValueError("No unique portfolios data loaded")
         
-        Parameters:
-        user_id (str): The ID of the user
-        n (int): Number of recommendations to generate
+        if user_ids is None:
+            user_ids = self.portfolio_store.user_ids
+        rows = self._portfolio_rows(user_ids)
+        weights = self.portfolio_matrix[rows]
+        total_weights = self.portfolio_store.total_weights[rows]
         
-        Returns:
-        list: Recommended stocks for diversification with explanations
-        """
-        try:
-            # Get user portfolio
-            if self.unique_portfolios is not None:
-                user_portfolio = self.expand_user_portfolio(user_id)
-            else:
-                user_portfolio = self.user_portfolios[self.user_portfolios['user_id'] == user_id]
-                
-            if user_portfolio.empty:
-                raise ValueError(f"No portfolio data found for user {user_id}")
-            
-            # Identify sectors in the user's portfolio
-            portfolio_sectors = set()
-            for _, row in user_portfolio.iterrows():
-                ticker = row['ticker']
-                if ticker in self.stocks_data.index:
-                    stock_info = self.stocks_data.loc[ticker]
-                    # Convert Series to dict if needed
-                    if isinstance(stock_info, pd.Series):
-                        stock_info = stock_info.to_dict()
-                    
-                    # Make sure sector is a string
-                    sector = stock_info['sector']
-                    if isinstance(sector, pd.Series):
-                        sector = str(sector.iloc[0]) if not sector.empty else "Unknown"
-                    
-                    portfolio_sectors.add(sector)
-            
-            # Create a vector of the user's preferences
-            user_vector = self.create_user_profile(user_portfolio)
-            
-            # Calculate similarities for all stocks
-            similarities = cosine_similarity([user_vector], self.stock_features)[0]
-            
-            # Get indices of stocks that are NOT in the user's portfolio sectors
-            diversification_indices = []
-            portfolio_tickers = set(user_portfolio['ticker'])
-            
-            for idx, ticker in enumerate(self.stocks_data.index):
-                stock_info = self.stocks_data.loc[ticker]
-                # Convert Series to dict if needed
-                if isinstance(stock_info, pd.Series):
-                    stock_info = stock_info.to_dict()
-                
-                # Make sure sector is a string
-                sector = stock_info['sector']
-                if isinstance(sector, pd.Series):
-                    sector = str(sector.iloc[0]) if not sector.empty else "Unknown"
-                
-                if sector not in portfolio_sectors and ticker not in portfolio_tickers:
-                    diversification_indices.append((idx, similarities[idx], sector))
-            
-            # Sort by similarity (we still want stocks that match user preferences)
-            diversification_indices.sort(key=lambda x: x[1], reverse=True)
-            
-            # Get top N recommendations
-            recommendations = []
-            sectors_added = set()
-            
-            for idx, similarity, sector in diversification_indices:
-                # Ensure sector diversity in the recommendations
-                if sector not in sectors_added or len(sectors_added) >= 3:
-                    ticker = self.stocks_data.index[idx]
-                    stock_info = self.stocks_data.loc[ticker]
-                    # Convert Series to dict if needed
-                    if isinstance(stock_info, pd.Series):
-                        stock_info = stock_info.to_dict()
-                    
-                    # Generate a simple explanation
-                    explanation = self._generate_simple_explanation(ticker, similarity, sector, is_diversification=True)
-                    
-                    # Create recommendation dict with proper handling of Series objects
-                    company_name = stock_info['company_name']
-                    if isinstance(company_name, pd.Series):
-                        company_name = str(company_name.iloc[0]) if not company_name.empty else "Unknown"
-                    
-                    # Make sure sector is a string
-                    sector_value = stock_info['sector']
-                    if isinstance(sector_value, pd.Series):
-                        sector_value = str(sector_value.iloc[0]) if not sector_value.empty else "Unknown"
-                    
-                    price = stock_info['price'] 
-                    if isinstance(price, pd.Series):
-                        price = float(price.iloc[0]) if not price.empty else 0.0
-                    
-                    market_cap = stock_info['market_cap']
-                    if isinstance(market_cap, pd.Series):
-                        market_cap = float(market_cap.iloc[0]) if not market_cap.empty else 0.0
-                    
-                    esg_score = stock_info['esg_score']
-                    if isinstance(esg_score, pd.Series):
-                        esg_score = float(esg_score.iloc[0]) if not esg_score.empty else 0.0
-                    
-                    recommendations.append({
-                        'ticker': ticker,
-                        'company_name': company_name,
-                        'similarity_score': similarity,
-                        'sector': sector_value,
-                        'price': price,
-                        'market_cap': market_cap,
-                        'esg_score': esg_score,
-                        'explanation': explanation,
-                        'recommendation_type': 'diversification'
-                    })
-                    
-                    sectors_added.add(sector)
-                
-                if len(recommendations) >= n:
-                    break
-            
-            return recommendations
-            
-        except Exception as e:
-            raise ValueError(f"Error generating diversification recommendations for user {user_id}: {str(e)}")
+        num_stocks, num_sectors = len(self.sector_codes), len(self.sector_names)
+        sector_indicator = sparse.csr_matrix(
+            (np.ones(num_stocks), (np.arange(num_stocks), self.sector_codes)),
+            shape=(num_stocks, num_sectors)
+        )
+        
+        # (users x sectors) weights, and which sectors each user holds at all
+        sector_totals = (weights @ sector_indicator).toarray()
+        holdings = weights.copy()
+        holdings.data = np.ones_like(holdings.data)
+        sector_counts = ((holdings @ sector_indicator).toarray() > 0).sum(axis=1)
+        high_beta_totals = weights @ (self.betas > 1.5).astype(np.float64)
+        
+        has_weight = total_weights > 0
+        safe_totals = np.where(has_weight, total_weights, 1.0)
+        sector_weights = np.where(has_weight[:, None], sector_totals / safe_totals[:, None], 0.0)
+        high_beta_weights = np.where(has_weight, high_beta_totals / safe_totals, 0.0)
+        has_holdings = (holdings.getnnz(axis=1) > 0) | has_weight
+        
+        over_users, over_sectors = np.nonzero(sector_weights > self.sector_concentration_threshold)
+        lack_users = np.flatnonzero(has_holdings & (sector_counts < self.sector_count_min))
+        volatile_users = np.flatnonzero(has_holdings & (high_beta_weights > 0.3))
+        
+        portfolio_volatility = np.zeros(len(rows))
+        if self.risk_factors is not None:
+            scale = np.divide(1.0, total_weights, out=np.zeros(len(rows)), where=has_weight)
+            fractions = sparse.diags(scale) @ weights
+            portfolio_volatility, _, _ = portfolio_risk_batch(fractions, self.risk_factors, self.specific_variance)
+            # Only portfolios mostly priced from history, as in analyze_portfolio_risks
+            covered = fractions @ estimated_stocks(self.risk_factors).astype(np.float64) >= self.risk_coverage_threshold
+            portfolio_volatility = np.where(covered, portfolio_volatility, 0.0)
+        risky_users = np.flatnonzero(portfolio_volatility > self.portfolio_volatility_threshold)
+        
+        alerts = []
+        for user, code in zip(over_users, over_sectors):
+            sector, weight = self.sector_names[code], float(sector_weights[user, code])
+            alerts.append((user, 0, -weight, user_ids[user], 'sector_overconcentration', sector, weight,
+                           None, None, self._sector_alert_message(sector, weight)))
+        for user in lack_users:
+            count = int(sector_counts[user])
+            alerts.append((user, 1, 0.0, user_ids[user], 'lack_of_diversity', None, None,
+                           count, None, self._diversity_alert_message(count)))
+        for user in volatile_users:
+            weight = float(high_beta_weights[user])
+            alerts.append((user, 2, 0.0, user_ids[user], 'high_volatility', None, weight,
+                           None, None, self._volatility_alert_message(weight)))
+        for user in risky_users:
+            volatility = float(portfolio_volatility[user])
+            alerts.append((user, 3, 0.0, user_ids[user], 'high_portfolio_volatility', None, None,
+                           None, volatility, self._portfolio_volatility_alert_message(volatility)))
+        
+        # Same alert order per user as analyze_portfolio_risks
+        alerts.sort(key=lambda alert: alert[:3])
+        return pd.DataFrame(
+            [alert[3:] for alert in alerts],
+            columns=['user_id', 'type', 'sector', 'weight', 'sector_count', 'portfolio_volatility', 'message']
+        )
 
-    def _generate_simple_explanation(self, ticker, similarity_score, sector, is_diversification=False):
+    def build_ann_index(self, n_lists=None, n_probe=8):
         """
-        Generate a simple, jargon-free explanation for why a stock is recommended.
+        Build the approximate nearest-neighbor index used for user queries.
         
         Parameters:
-        ticker (str): The ticker symbol
-        similarity_score (float): The similarity score
-        sector (str): The stock's sector
-        is_diversification (bool): Whether this is a diversification recommendation
-        
-        Returns:
-        str: A simple explanation
+        n_lists (int): Number of k-means clusters (defaults to sqrt of the universe size)
+        n_probe (int): Clusters scored per query; raise for recall, lower for latency
         """
-        stock_info = self.stocks_data.loc[ticker]
-        # Convert Series to dict if needed
-        if isinstance(stock_info, pd.Series):
-            stock_info = stock_info.to_dict()
-        
-        # Basic explanation template
-        if is_diversification:
-            explanation = f"This stock is in the {sector} sector, which is not currently in your portfolio. "
-            explanation += "Adding it would help spread your investments across more industries. "
-        else:
-            explanation = f"This stock is similar to what you already like, with a match score of {similarity_score:.2f}. "
-        
-        # Add information about the company
-        price = stock_info['price']
-        # Handle Series objects
-        if isinstance(price, pd.Series):
-            price = float(price.iloc[0]) if not price.empty and not pd.isna(price.iloc[0]) else 0.0
-        
-        price_val = float(price) if isinstance(price, (int, float, str)) else 0
-        explanation += f"It's priced at ${price_val:.2f}. "
-        
-        # Add information about company size
-        market_cap = stock_info['market_cap']
-        # Handle Series objects
-        if isinstance(market_cap, pd.Series):
-            market_cap = float(market_cap.iloc[0]) if not market_cap.empty and not pd.isna(market_cap.iloc[0]) else 0.0
-            
-        market_cap_val = float(market_cap) if isinstance(market_cap, (int, float, str)) else 0
-        
-        if market_cap_val > 10000:
-            size = "very large"
-        elif market_cap_val > 1000:
-            size = "large"
-        elif market_cap_val > 100:
-            size = "medium-sized"
-        else:
-            size = "smaller"
-        explanation += f"It's a {size} company. "
-        
-        # Add information about ESG score if available
-        esg_score = stock_info['esg_score']
-        # Handle Series objects
-        if isinstance(esg_score, pd.Series):
-            esg_score = float(esg_score.iloc[0]) if not esg_score.empty and not pd.isna(esg_score.iloc[0]) else 0.0
-            
-        if isinstance(esg_score, (int, float)):
-            esg_val = float(esg_score)
-            if esg_val > 80:
-                explanation += "It has excellent environmental and social practices. "
-            elif esg_val > 60:
-                explanation += "It has good environmental and social practices. "
-        
-        # Add information about volatility if available
-        beta = stock_info['beta']
-        # Handle Series objects
-        if isinstance(beta, pd.Series):
-            beta = float(beta.iloc[0]) if not beta.empty and not pd.isna(beta.iloc[0]) else 0.0
-            
-        if isinstance(beta, (int, float)):
-            beta_val = float(beta)
-            if beta_val > 1.5:
-                explanation += "The stock price tends to change more than the overall market. "
-            elif beta_val < 0.8:
-                explanation += "The stock price tends to be more stable than the overall market. "
-        
-        return explanation
-
-    def generate_recommendations(self, user_input, n=5, exclude_portfolio=True, include_explanations=True):
+        self.ann_index = IVFIndex(n_lists=n_lists, n_probe=n_probe).fit(self.normalized_features)
+        self._new_model_version()
+    
+    def generate_recommendations(self, user_input, n=5, exclude_portfolio=True, include_explanations=True,
+                                 context=None, similarity='fundamentals', correlation_weight=0.5):
         """
         Generate stock recommendations based on user input.
         
         Parameters:
-        user_input (str or pd.DataFrame): User ID, ticker, or DataFrame containing user portfolio
+        user_input (str or pd.DataFrame): User ID, ticker, DataFrame containing user portfolio, or profile vector
         n (int): Number of recommendations to generate
         exclude_portfolio (bool): Whether to exclude stocks already in the user's portfolio
-        include_explanations (bool): Whether to include simple explanations
+        include_explanations (bool or str): Explanation mode - True/'text', 'ids' for
+            fragment ids only (see render_explanation), or False/'off'
+        context (PortfolioContext): Shared portfolio view from portfolio_context(user_id)
+        similarity (str): 'fundamentals', 'correlation' or 'blend' (see RecommenderRuntime.generate_recommendations)
+        correlation_weight (float): Weight of the correlation score in 'blend' (0 to 1)
         
         Returns:
         list: Top N recommended stocks with similarity scores and explanations
         """
-        if isinstance(user_input, str):
-            # Check if input is a ticker
-            if user_input in self.stocks_data.index:
-                stock_idx = list(self.stocks_data.index).index(user_input)
-                similarities = self.similarity_matrix[stock_idx]
-                portfolio_tickers = [user_input] if exclude_portfolio else []
-            else:
-                # Input is a user ID
-                try:
-                    if self.unique_portfolios is not None:
-                        user_portfolio = self.expand_user_portfolio(user_input)
-                    else:
-                        user_portfolio = self.user_portfolios[self.user_portfolios['user_id'] == user_input]
-                        
-                    if user_portfolio.empty:
-                        raise ValueError(f"No portfolio data found for user {user_input}")
-                        
-                    user_vector = self.create_user_profile(user_portfolio)
-                    similarities = cosine_similarity([user_vector], self.stock_features)[0]
-                    
-                    portfolio_tickers = set(user_portfolio['ticker']) if exclude_portfolio else []
-                except ValueError as e:
-                    raise ValueError(f"Error processing user {user_input}: {str(e)}")
-        else:
-            # If user_input is a portfolio or user profile vector
-            if isinstance(user_input, pd.DataFrame):
-                user_vector = self.create_user_profile(user_input)
-                portfolio_tickers = set(user_input['ticker']) if exclude_portfolio else []
-            else:
-                user_vector = user_input
-                portfolio_tickers = []
-            
-            # Calculate similarities between user profile and all stocks
-            similarities = cosine_similarity([user_vector], self.stock_features)[0]
-        
-        # Get indices of stocks, sorted by similarity
-        similar_indices = similarities.argsort()[::-1]
-        
-        # Filter out stocks in the user's portfolio if requested
-        if exclude_portfolio and portfolio_tickers:
-            similar_indices = [idx for idx in similar_indices 
-                             if self.stocks_data.index[idx] not in portfolio_tickers]
-        
-        # Get top N recommendations
-        top_n_indices = similar_indices[:n]
-        recommendations = []
-        
-        for idx in top_n_indices:
-            ticker = self.stocks_data.index[idx]
-            similarity = similarities[idx]
-            stock_info = self.stocks_data.loc[ticker]
-            # Convert Series to dict if needed
-            if isinstance(stock_info, pd.Series):
-                stock_info = stock_info.to_dict()
-            
-            # Handle potential Series objects for each field
-            company_name = stock_info['company_name']
-            if isinstance(company_name, pd.Series):
-                company_name = str(company_name.iloc[0]) if not company_name.empty else "Unknown"
-            
-            sector = stock_info['sector']
-            if isinstance(sector, pd.Series):
-                sector = str(sector.iloc[0]) if not sector.empty else "Unknown"
-            
-            price = stock_info['price']
-            if isinstance(price, pd.Series):
-                price = float(price.iloc[0]) if not price.empty and not pd.isna(price.iloc[0]) else 0.0
+        if isinstance(user_input, pd.DataFrame):
+            if similarity not in SIMILARITY_MODES:
+                raise ValueError(f"similarity must be one of {', '.join(SIMILARITY_MODES)}")
+            weights = self.portfolio_weights(user_input)
+            exclude_ids = weights.indices if exclude_portfolio else []
+            include_explanations = explanation_mode(include_explanations)
+            profile = self._profiles_from_weights(weights)[0]
+            if similarity == 'fundamentals':
+                return self._recommend_from_profile(profile, n, exclude_ids, include_explanations)
             
-            market_cap = stock_info['market_cap']
-            if isinstance(market_cap, pd.Series):
-                market_cap = float(market_cap.iloc[0]) if not market_cap.empty and not pd.isna(market_cap.iloc[0]) else 0.0
+            similarities = self._correlation_similarities(weights.indices, weights.data)
+            if similarity == 'blend':
+                fundamentals = self._user_similarities(profile, min_candidates=n + len(exclude_ids))
+                similarities = self._blend_similarities(fundamentals, similarities, correlation_weight)
+            return self._top_recommendations(similarities, n, exclude_ids, include_explanations)
+        
+        return super().generate_recommendations(user_input, n, exclude_portfolio, include_explanations, context,
+                                                similarity, correlation_weight)
+    
+    def generate_recommendations_batch(self, user_ids=None, n=5, exclude_portfolio=True,
+                                       include_explanations=True, block_size=1024):
+        """
+        Generate top-N recommendations for many unique-portfolio users at once.
+        
+        Scores are computed as (users x stocks) blocks of block_size users, with
+        each user's holdings masked out of their own row.
+        
+        Parameters:
+        user_ids (list): User IDs to recommend for, or None for every user
+        n (int): Number of recommendations per user
+        exclude_portfolio (bool): Whether to exclude stocks already in each portfolio
+        include_explanations (bool or str): Explanation mode, as for generate_recommendations
+        block_size (int): Number of users scored per block
+        
+        Returns:
+        dict: User ID -> list of recommendations, as returned by generate_recommendations
+        """
+        if self.portfolio_store is None:
+            raise ValueError("No unique portfolios data loaded")
+        include_explanations = explanation_mode(include_explanations)
+        
+        if user_ids is None:
+            user_ids = self.portfolio_store.user_ids
+        rows = self._portfolio_rows(user_ids)
+        n = min(n, len(self.stocks_data))
+        results = {}
+        
+        for start in range(0, len(rows), block_size):
+            block_ids = user_ids[start:start + block_size]
+            weights = self.portfolio_matrix[rows[start:start + block_size]]
+            scores = self._profile_similarities(self._profiles_from_weights(weights))
             
-            esg_score = stock_info['esg_score']
-            if isinstance(esg_score, pd.Series):
-                esg_score = float(esg_score.iloc[0]) if not esg_score.empty and not pd.isna(esg_score.iloc[0]) else 0.0
+            if exclude_portfolio:
+                held_rows, held_cols = weights.nonzero()
+                scores[held_rows, held_cols] = -np.inf
             
-            rec_dict = {
-                'ticker': ticker,
-                'company_name': company_name,
-                'similarity_score': similarity,
-                'sector': sector,
-                'price': price,
-                'market_cap': market_cap,
-                'esg_score': esg_score,
-                'recommendation_type': 'standard'
-            }
+            if n <= 0:
+                results.update((user_id, []) for user_id in block_ids)
+                continue
             
-            # Add simple explanation if requested
-            if include_explanations:
-                explanation = self._generate_simple_explanation(
-                    ticker, similarity, sector
-                )
-                rec_dict['explanation'] = explanation
+            # Partial top-N per row, then sort just those N
+            top = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            order = np.argsort(-top_scores, axis=1, kind='stable')
+            top = np.take_along_axis(top, order, axis=1)
+            top_scores = np.take_along_axis(top_scores, order, axis=1)
             
-            recommendations.append(rec_dict)
+            for user_id, user_top, user_scores in zip(block_ids, top, top_scores):
+                results[user_id] = [
+                    self._build_recommendation(idx, score, include_explanations)
+                    for idx, score in zip(user_top, user_scores)
+                    if score > -np.inf
+                ]
         
-        return recommendations
+        return results
     
     def get_user_portfolio_summary(self, user_id):
         """
@@ -606,7 +712,7 @@ class ImprovedStockRecommender:
         dict: Summary statistics about the user's portfolio
         """
         try:
-            if self.unique_portfolios is not None:
+            if self.portfolio_store is not None:
                 user_portfolio = self.expand_user_portfolio(user_id)
             else:
                 user_portfolio = self.user_portfolios[self.user_portfolios['user_id'] == user_id]
@@ -662,36 +768,501 @@ class ImprovedStockRecommender:
         except Exception as e:
             raise ValueError(f"Error generating portfolio summary for user {user_id}: {str(e)}")
     
+    def _transform_features(self, frame):
+        """Scale stock rows with the fitted scaler, filling missing values with the fitted means."""
+        if len(frame) == 0:
+            return np.empty((0, len(self.feature_columns)))
+        features = frame[self.feature_columns].astype(np.float64)
+        features = features.fillna(pd.Series(self.scaler.mean_, index=self.feature_columns))
+        return self.scaler.transform(features)
+    
+    def feature_drift(self):
+        """
+        How far the current stock universe has drifted from the fitted scaler.
+        
+        Returns:
+        float: Largest shift of a feature mean (in fitted standard deviations) or
+        relative change of a feature's standard deviation
+        """
+        features = self.stocks_data[self.feature_columns]
+        features = features.fillna(features.mean())
+        mean_shift = np.abs(features.mean().to_numpy() - self.scaler.mean_) / self.scaler.scale_
+        scale_change = np.abs(features.std(ddof=0).to_numpy() / self.scaler.scale_ - 1)
+        return float(np.nanmax(np.concatenate((mean_shift, scale_change))))
+    
+    def update_stocks(self, upserts=None, removals=None, drift_threshold=None):
+        """
+        Apply added, changed or delisted stocks without a full retrain.
+        
+        New and changed rows are transformed with the fitted scaler and only the
+        neighbor rows they affect are recomputed. If drift_threshold is given and
+        feature_drift() exceeds it afterwards, the scaler is refit and the model is
+        rebuilt instead. The change is kept in last_delta for save_delta.
+        
+        Parameters:
+        upserts (pd.DataFrame): Stock rows indexed (or with a column) by ticker; NaN cells keep the current value
+        removals (list): Tickers to delist
+        drift_threshold (float): Refit when feature drift exceeds this (None never refits)
+        
+        Returns:
+        dict: Counts of upserted, removed and patched rows, and whether the scaler was refit
+        """
+        if upserts is not None and 'ticker' in upserts.columns:
+            upserts = upserts.set_index('ticker')
+        if upserts is not None:
+            upserts = upserts[~upserts.index.duplicated(keep='last')]
+        removed = [ticker for ticker in dict.fromkeys(removals or []) if ticker in self.ticker_index]
+        base_version = self.model_version
+        
+        changed_ids, feature_rows = self._apply_stock_changes(removed, upserts)
+        self._new_model_version()
+        
+        if drift_threshold is not None and self.feature_drift() > drift_threshold:
+            ann_index = self.ann_index
+            self.prepare_features()
+            if ann_index is not None:
+                self.build_ann_index(n_lists=ann_index.n_lists, n_probe=ann_index.n_probe)
+            self.last_delta = None
+            return {'upserted': len(changed_ids), 'removed': len(removed),
+                    'patched_rows': len(self.stocks_data), 'refit': True}
+        
+        patched = self._patch_neighbor_index(changed_ids)
+        self.last_delta = {
+            'base_version': base_version,
+            'removed': removed,
+            'stocks': self.stocks_data.iloc[changed_ids],
+            'feature_rows': feature_rows,
+            'neighbor_rows': patched,
+            'neighbor_ids': self.neighbor_ids[patched],
+            'neighbor_scores': self.neighbor_scores[patched]
+        }
+        return {'upserted': len(changed_ids), 'removed': len(removed),
+                'patched_rows': len(patched), 'refit': False}
+    
+    def _apply_stock_changes(self, removed, upserts, feature_rows=None):
+        """
+        Remove and upsert stock rows, keeping every row-aligned array in step.
+        
+        Removed rows are dropped and later ids shift down; the neighbor index,
+        portfolios and ANN lists are remapped accordingly, with neighbor entries
+        that pointed at removed stocks set to -1. Upserted rows replace the row of
+        an existing ticker or are appended.
+        
+        Returns:
+        tuple: (ids of the upserted rows, their scaled feature rows)
+        """
+        id_map = None
+        stock_features = np.asarray(self.stock_features)
+        normalized_features = np.asarray(self.normalized_features)
+        neighbor_ids = np.asarray(self.neighbor_ids)
+        neighbor_scores = np.asarray(self.neighbor_scores)
+        risk_factors = None if self.risk_factors is None else np.asarray(self.risk_factors)
+        specific_variance = None if self.specific_variance is None else np.asarray(self.specific_variance)
+        correlation_ids = None if self.correlation_ids is None else np.asarray(self.correlation_ids)
+        correlation_scores = None if self.correlation_scores is None else np.asarray(self.correlation_scores)
+        
+        if removed:
+            keep = ~np.isin(self.tickers, removed)
+            id_map = np.full(len(keep), -1, dtype=np.int64)
+            id_map[keep] = np.arange(np.count_nonzero(keep))
+            
+            self.stocks_data = self.stocks_data.iloc[keep]
+            stock_features = stock_features[keep]
+            normalized_features = normalized_features[keep]
+            # -1 padding must stay -1 rather than index id_map from the end
+            neighbor_ids = neighbor_ids[keep]
+            neighbor_ids = np.where(neighbor_ids >= 0, id_map[neighbor_ids], -1).astype(np.int32)
+            neighbor_scores = np.where(neighbor_ids >= 0, neighbor_scores[keep], -np.inf).astype(np.float32)
+            if risk_factors is not None:
+                risk_factors = risk_factors[keep]
+                specific_variance = specific_variance[keep]
+            if correlation_ids is not None:
+                correlation_ids = correlation_ids[keep]
+                correlation_ids = np.where(correlation_ids >= 0, id_map[correlation_ids], -1).astype(np.int32)
+                correlation_scores = np.where(correlation_ids >= 0, correlation_scores[keep], -np.inf).astype(np.float32)
+            if self.portfolio_store is not None:
+                self.portfolio_store = self.portfolio_store.remap_tickers(id_map)
+            self._build_stock_columns()
+            self._build_ticker_index()
+        
+        changed_ids = np.empty(0, dtype=np.int64)
+        if upserts is not None and len(upserts):
+            changed_ids = self._upsert_stock_rows(upserts)
+            self._build_stock_columns()
+            self._build_ticker_index()
+        if feature_rows is None:
+            feature_rows = self._transform_features(self.stocks_data.iloc[changed_ids])
+        
+        # Grow the row-aligned arrays for appended stocks, then write the upserted rows
+        num_stocks, num_old = len(self.stocks_data), len(stock_features)
+        self.stock_features = np.zeros((num_stocks, stock_features.shape[1]))
+        self.stock_features[:num_old] = stock_features
+        self.stock_features[changed_ids] = feature_rows
+        self.normalized_features = np.zeros_like(self.stock_features)
+        self.normalized_features[:num_old] = normalized_features
+        self.normalized_features[changed_ids] = self._normalize_rows(self.stock_features[changed_ids])
+        
+        self.neighbor_ids = np.full((num_stocks, neighbor_ids.shape[1]), -1, dtype=np.int32)
+        self.neighbor_ids[:num_old] = neighbor_ids
+        self.neighbor_scores = np.full((num_stocks, neighbor_scores.shape[1]), -np.inf, dtype=np.float32)
+        self.neighbor_scores[:num_old] = neighbor_scores
+        
+        # Appended stocks have no return history yet: no factor loadings, variance from volatility_1yr
+        if risk_factors is not None:
+            self.risk_factors = np.zeros((num_stocks, risk_factors.shape[1]), dtype=np.float32)
+            self.risk_factors[:num_old] = risk_factors
+            self.specific_variance = np.zeros(num_stocks)
+            self.specific_variance[:num_old] = specific_variance
+            self.specific_variance[num_old:] = self._fallback_variance(np.arange(num_old, num_stocks))
+        
+        # ...and no correlation neighbors until the index is rebuilt
+        if correlation_ids is not None:
+            self.correlation_ids = np.full((num_stocks, correlation_ids.shape[1]), -1, dtype=np.int32)
+            self.correlation_ids[:num_old] = correlation_ids
+            self.correlation_scores = np.full((num_stocks, correlation_scores.shape[1]), -np.inf, dtype=np.float32)
+            self.correlation_scores[:num_old] = correlation_scores
+        
+        if self.portfolio_store is not None:
+            self._build_portfolio_matrix()
+        if self.ann_index is not None:
+            self.ann_index.update(self.normalized_features, changed_ids, id_map)
+        
+        return changed_ids, feature_rows
+    
+    def _upsert_stock_rows(self, upserts):
+        """Merge upserted rows into stocks_data and return their row ids (existing first, then appended)."""
+        existing = np.array([ticker in self.ticker_index for ticker in upserts.index], dtype=bool)
+        positions = np.array([self.ticker_index[ticker] for ticker in upserts.index[existing]], dtype=np.int64)
+        stocks_data = self.stocks_data.copy()
+        
+        updates = upserts[existing]
+        for column in updates.columns.intersection(stocks_data.columns):
+            new_values = updates[column]
+            has_value = new_values.notna().to_numpy()
+            if not has_value.any():
+                continue
+            if pd.api.types.is_numeric_dtype(stocks_data[column]) and pd.api.types.is_numeric_dtype(new_values):
+                values = stocks_data[column].to_numpy(dtype=np.result_type(stocks_data[column].dtype, new_values.dtype))
+            else:
+                values = stocks_data[column].to_numpy(dtype=object)
+            values = values.copy()
+            values[positions[has_value]] = new_values.to_numpy()[has_value]
+            stocks_data[column] = values
+        
+        new_rows = upserts[~existing].reindex(columns=stocks_data.columns)
+        appended = np.arange(len(stocks_data), len(stocks_data) + len(new_rows))
+        if len(new_rows):
+            stocks_data = pd.concat([stocks_data, new_rows])
+            stocks_data.index.name = 'ticker'
+        
+        self.stocks_data = stocks_data
+        return np.concatenate((positions, appended))
+    
+    def _patch_neighbor_index(self, changed_ids):
+        """
+        Bring the neighbor index up to date after _apply_stock_changes.
+        
+        Rows of changed stocks, and rows whose lists point at a changed or removed
+        stock, are recomputed. Every other row only merges in the changed stocks
+        that now beat its weakest neighbor.
+        
+        Returns:
+        np.ndarray: Ids of the patched rows
+        """
+        num_stocks = len(self.normalized_features)
+        k = max(min(self.neighbor_k, num_stocks - 1), 0)
+        if self.neighbor_ids.shape[1] != k or len(changed_ids) > num_stocks // 4:
+            self.build_neighbor_index()
+            return np.arange(num_stocks)
+        if k == 0:
+            return np.empty(0, dtype=np.int64)
+        
+        stale = (self.neighbor_ids < 0).any(axis=1) | np.isin(self.neighbor_ids, changed_ids).any(axis=1)
+        stale[changed_ids] = True
+        
+        merged = np.empty(0, dtype=np.int64)
+        fresh = np.flatnonzero(~stale)
+        if len(changed_ids) and len(fresh):
+            scores = (self.normalized_features[fresh] @ self.normalized_features[changed_ids].T).astype(np.float32)
+            better = scores.max(axis=1) > self.neighbor_scores[fresh, -1]
+            merged = fresh[better]
+            
+            candidate_ids = np.hstack((self.neighbor_ids[merged], np.broadcast_to(changed_ids, (len(merged), len(changed_ids)))))
+            candidate_scores = np.hstack((self.neighbor_scores[merged], scores[better]))
+            order = np.argsort(-candidate_scores, axis=1, kind='stable')[:, :k]
+            self.neighbor_ids[merged] = np.take_along_axis(candidate_ids, order, axis=1)
+            self.neighbor_scores[merged] = np.take_along_axis(candidate_scores, order, axis=1)
+        
+        recompute = np.flatnonzero(stale)
+        self.neighbor_ids[recompute], self.neighbor_scores[recompute] = self._neighbor_rows(recompute, k)
+        return np.union1d(recompute, merged)
+    
+    def save_delta(self, path):
+        """
+        Write the last update_stocks change as a delta artifact.
+        
+        Parameters:
+        path (str): Delta artifact directory
+        """
+        delta = self.last_delta
+        if delta is None:
+            raise ValueError("No incremental update to save (none applied, or the scaler was refit)")
+        
+        arrays, stock_columns = self._stock_column_arrays(delta['stocks'])
+        arrays.update({
+            'removed_tickers': np.array(delta['removed'], dtype=str),
+            'stock_features': np.asarray(delta['feature_rows'], dtype=np.float64),
+            'neighbor_rows': delta['neighbor_rows'],
+            'neighbor_ids': delta['neighbor_ids'],
+            'neighbor_scores': delta['neighbor_scores']
+        })
+        write_artifact(path, arrays, {
+            'kind': 'delta',
+            'base_version': delta['base_version'],
+            'model_version': self.model_version,
+            'stock_columns': stock_columns
+        })
+    
+    def apply_delta(self, path):
+        """
+        Apply a delta artifact written by save_delta to the model it was based on.
+        
+        Parameters:
+        path (str): Delta artifact directory
+        """
+        manifest, arrays = read_artifact(path, mmap_mode=None)
+        if manifest.get('kind') != 'delta':
+            raise ValueError(f"{path} is not a delta artifact")
+        if manifest['base_version'] != self.model_version:
+            raise ValueError(f"Delta applies to model {manifest['base_version']}, not {self.model_version}")
+        
+        upserts = self._stock_frame(manifest['stock_columns'], arrays)
+        self._apply_stock_changes(arrays['removed_tickers'].tolist(), upserts, arrays['stock_features'])
+        
+        rows = arrays['neighbor_rows']
+        width = arrays['neighbor_ids'].shape[1]
+        if self.neighbor_ids.shape[1] != width:
+            self.neighbor_ids = np.zeros((len(self.stocks_data), width), dtype=np.int32)
+            self.neighbor_scores = np.zeros((len(self.stocks_data), width), dtype=np.float32)
+        self.neighbor_ids[rows] = arrays['neighbor_ids']
+        self.neighbor_scores[rows] = arrays['neighbor_scores']
+        self.model_version = manifest['model_version']
+        self.last_delta = None
+    
     def save_model(self, filepath):
         """
-        Save the trained model to a file.
+        Save the trained model.
+        
+        Paths ending in .pkl get the legacy joblib pickle; any other path is written
+        as a memory-mappable artifact directory (see model_artifact.py).
         
         Parameters:
         filepath (str): Path to save the model
         """
+        if filepath.endswith('.pkl'):
+            self._save_pickle(filepath)
+        else:
+            self._save_artifact(filepath)
+    
+    def load_model(self, filepath, mmap_mode='r'):
+        """
+        Load a trained model from an artifact directory or a legacy .pkl file.
+        
+        Parameters:
+        filepath (str): Path to the saved model
+        mmap_mode (str): Memory-map mode for artifact arrays (None reads them into memory)
+        """
+        if is_artifact(filepath):
+            self._load_artifact(filepath, mmap_mode)
+        else:
+            self._load_pickle(filepath)
+    
+    def _save_artifact(self, path):
+        """Write features, neighbors, portfolios and scaler parameters as raw arrays."""
+        # Changes already bump the version; saving an unchanged model keeps it, so caches and deltas stay valid
+        if self.model_version is None:
+            self._new_model_version()
+        arrays = {
+            'stock_features': self.stock_features,
+            'normalized_features': self.normalized_features,
+            'neighbor_ids': self.neighbor_ids,
+            'neighbor_scores': self.neighbor_scores,
+            'scaler_mean': self.scaler.mean_,
+            'scaler_scale': self.scaler.scale_,
+            'scaler_var': self.scaler.var_
+        }
+        stock_arrays, stock_columns = self._stock_column_arrays(self.stocks_data)
+        arrays.update(stock_arrays)
+        
+        if self.user_portfolios is not None:
+            arrays['user_portfolios.user_id'] = self.user_portfolios['user_id'].to_numpy(dtype=str)
+            arrays['user_portfolios.ticker'] = self.user_portfolios['ticker'].to_numpy(dtype=str)
+            arrays['user_portfolios.weight'] = self.user_portfolios['weight'].to_numpy(dtype=np.float64)
+        
+        if self.portfolio_store is not None:
+            arrays.update({
+                'portfolios.user_ids': self.portfolio_store.user_ids.astype(str),
+                'portfolios.offsets': self.portfolio_store.offsets,
+                'portfolios.ticker_ids': self.portfolio_store.ticker_ids,
+                'portfolios.weights': self.portfolio_store.weights,
+                'portfolios.total_weights': self.portfolio_store.total_weights
+            })
+        
+        if self.risk_factors is not None:
+            arrays['risk.factors'] = self.risk_factors
+            arrays['risk.specific_variance'] = self.specific_variance
+        
+        if self.correlation_ids is not None:
+            arrays['correlation_ids'] = self.correlation_ids
+            arrays['correlation_scores'] = self.correlation_scores
+        
+        ann = None
+        if self.ann_index is not None:
+            arrays.update({
+                'ann.centroids': self.ann_index.centroids,
+                'ann.list_offsets': self.ann_index.list_offsets,
+                'ann.list_ids': self.ann_index.list_ids
+            })
+            ann = {'n_lists': self.ann_index.n_lists, 'n_probe': self.ann_index.n_probe,
+                   'n_iter': self.ann_index.n_iter, 'seed': self.ann_index.seed}
+        
+        write_artifact(path, arrays, {
+            'model_version': self.model_version,
+            'feature_columns': list(self.feature_columns),
+            'neighbor_k': self.neighbor_k,
+            'stock_columns': stock_columns,
+            'scaler': {
+                'n_samples_seen': int(self.scaler.n_samples_seen_),
+                'feature_names': [str(name) for name in getattr(self.scaler, 'feature_names_in_', [])]
+            },
+            'ann_index': ann,
+            'risk_model': self.risk_model if self.risk_factors is not None else None,
+            'correlation_index': self.correlation_index if self.correlation_ids is not None else None
+        })
+    
+    def _stock_column_arrays(self, frame):
+        """
+        Stock rows as one array per column, for an artifact.
+        
+        Returns:
+        tuple: (dict of 'stocks.<column>' arrays, manifest description of the columns)
+        """
+        arrays = {'stocks.ticker': frame.index.to_numpy(dtype=str)}
+        stock_columns = []
+        for column in frame.columns:
+            values = frame[column]
+            if pd.api.types.is_numeric_dtype(values):
+                arrays[f'stocks.{column}'] = values.to_numpy()
+                stock_columns.append({'name': column, 'kind': 'numeric'})
+            else:
+                nulls = values.isna().to_numpy()
+                arrays[f'stocks.{column}'] = values.fillna('').to_numpy(dtype=str)
+                if nulls.any():
+                    arrays[f'stocks.{column}.nulls'] = nulls
+                stock_columns.append({'name': column, 'kind': 'string', 'nulls': bool(nulls.any())})
+        return arrays, stock_columns
+    
+    def _stock_frame(self, stock_columns, arrays):
+        """Rebuild a stocks DataFrame from the arrays written by _stock_column_arrays."""
+        columns = {}
+        for column in stock_columns:
+            values = arrays[f'stocks.{column["name"]}']
+            if column['kind'] == 'string':
+                values = pd.Series(values, dtype=object)
+                if column['nulls']:
+                    values[np.asarray(arrays[f'stocks.{column["name"]}.nulls'])] = np.nan
+                values = values.to_numpy()
+            columns[column['name']] = np.array(values)
+        return pd.DataFrame(columns, index=pd.Index(np.array(arrays['stocks.ticker'], dtype=object), name='ticker'))
+    
+    def _load_artifact(self, path, mmap_mode='r'):
+        """Open an artifact directory, rebuilding the pandas and scikit-learn objects used for training."""
+        manifest, arrays = super()._load_artifact(path, mmap_mode)
+        self.feature_columns = manifest['feature_columns']
+        
+        self.stocks_data = self._stock_frame(manifest['stock_columns'], arrays)
+        
+        if 'user_portfolios.user_id' in arrays:
+            self.user_portfolios = pd.DataFrame({
+                'user_id': np.array(arrays['user_portfolios.user_id'], dtype=object),
+                'ticker': np.array(arrays['user_portfolios.ticker'], dtype=object),
+                'weight': np.array(arrays['user_portfolios.weight'])
+            })
+        else:
+            self.user_portfolios = None
+        
+        self.scaler = StandardScaler()
+        self.scaler.mean_ = np.array(arrays['scaler_mean'])
+        self.scaler.scale_ = np.array(arrays['scaler_scale'])
+        self.scaler.var_ = np.array(arrays['scaler_var'])
+        self.scaler.n_samples_seen_ = manifest['scaler']['n_samples_seen']
+        self.scaler.n_features_in_ = len(self.scaler.mean_)
+        if manifest['scaler']['feature_names']:
+            self.scaler.feature_names_in_ = np.array(manifest['scaler']['feature_names'], dtype=object)
+        
+        if self.portfolio_store is not None:
+            self._build_portfolio_matrix()
+        
+        return manifest, arrays
+    
+    def _save_pickle(self, filepath):
+        """Save the whole model as a single joblib pickle (legacy format)."""
         model_data = {
             'stocks_data': self.stocks_data,
             'user_portfolios': self.user_portfolios,
-            'unique_portfolios': self.unique_portfolios,
+            'portfolio_store': self.portfolio_store,
             'stock_features': self.stock_features,
             'feature_columns': self.feature_columns,
             'scaler': self.scaler,
-            'similarity_matrix': self.similarity_matrix
+            'neighbor_k': self.neighbor_k,
+            'neighbor_ids': self.neighbor_ids,
+            'neighbor_scores': self.neighbor_scores,
+            'ann_index': self.ann_index,
+            'risk_model': self.risk_model,
+            'risk_factors': None if self.risk_factors is None else np.asarray(self.risk_factors),
+            'specific_variance': None if self.specific_variance is None else np.asarray(self.specific_variance),
+            'correlation_index': self.correlation_index,
+            'correlation_ids': None if self.correlation_ids is None else np.asarray(self.correlation_ids),
+            'correlation_scores': None if self.correlation_scores is None else np.asarray(self.correlation_scores)
         }
         joblib.dump(model_data, filepath)
     
-    def load_model(self, filepath):
-        """
-        Load a trained model from a file.
-        
-        Parameters:
-        filepath (str): Path to the saved model
-        """
+    def _load_pickle(self, filepath):
+        """Load a model saved as a single joblib pickle (legacy format)."""
         model_data = joblib.load(filepath)
+        self.model_version = None
         self.stocks_data = model_data['stocks_data']
         self.user_portfolios = model_data.get('user_portfolios')
-        self.unique_portfolios = model_data.get('unique_portfolios')
+        self.portfolio_store = model_data.get('portfolio_store')
         self.stock_features = model_data['stock_features']
         self.feature_columns = model_data['feature_columns']
         self.scaler = model_data['scaler']
-        self.similarity_matrix = model_data['similarity_matrix'] 
\ No newline at end of file
+        
+        self._build_stock_columns()
+        self._build_ticker_index()
+        self._build_normalized_features()
+        if 'neighbor_ids' in model_data:
+            self.neighbor_k = model_data['neighbor_k']
+            self.neighbor_ids = model_data['neighbor_ids']
+            self.neighbor_scores = model_data['neighbor_scores']
+        else:
+            # Models saved with a dense similarity matrix: index neighbors on load
+            self.build_neighbor_index()
+        self.ann_index = model_data.get('ann_index')
+        self.risk_model = model_data.get('risk_model')
+        self.risk_factors = model_data.get('risk_factors')
+        self.specific_variance = model_data.get('specific_variance')
+        self.correlation_index = model_data.get('correlation_index')
+        self.correlation_ids = model_data.get('correlation_ids')
+        self.correlation_scores = model_data.get('correlation_scores')
+        unique_portfolios = model_data.get('unique_portfolios')
+        if self.portfolio_store is None and unique_portfolios is not None:
+            # Models saved before the portfolio store kept the parsed DataFrame
+            self.portfolio_store = PortfolioStore.from_lists(
+                unique_portfolios['user_id'].tolist(),
+                unique_portfolios['ticker_list'].tolist(),
+                unique_portfolios['weight_list'].tolist(),
+                self.ticker_index
+            )
+        if self.portfolio_store is not None:
+            self._build_portfolio_matrix()
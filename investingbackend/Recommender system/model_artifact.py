@@ -0,0 +1,115 @@
+import json
+import os
+import shutil
+import uuid
+import numpy as np
+
+FORMAT_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+# File naming the version subdirectory readers should open
+POINTER_NAME = 'CURRENT'
+VERSION_PREFIX = 'v-'
+
+def is_artifact(path):
+    """True if path is a model artifact directory (versioned, or a single manifest from older code)."""
+    return os.path.isdir(path) and (os.path.exists(os.path.join(path, POINTER_NAME)) or
+                                    os.path.exists(os.path.join(path, MANIFEST_NAME)))
+
+def current_version(path):
+    """
+    The directory holding an artifact's files.
+
+    Parameters:
+    path (str): Artifact directory
+
+    Returns:
+    str: The version subdirectory CURRENT points to, or path itself for artifacts
+        written before versioning
+    """
+    try:
+        with open(os.path.join(path, POINTER_NAME)) as f:
+            return os.path.join(path, f.read().strip())
+    except FileNotFoundError:
+        return path
+
+def write_artifact(path, arrays, metadata):
+    """
+    Write a model artifact directory: one .npy file per array plus a JSON manifest.
+
+    Every write goes to a new version subdirectory, and the CURRENT file is
+    then switched to it with an atomic os.replace, so a reader always finds
+    either the old or the new model, never a missing or half-written one.
+    The version CURRENT pointed to before stays on disk until the next write,
+    for readers that resolved it just before the switch; older versions are
+    removed.
+
+    Parameters:
+    path (str): Artifact directory
+    arrays (dict): Array name -> np.ndarray (no object arrays)
+    metadata (dict): JSON-serializable values stored in the manifest
+    """
+    path = os.path.normpath(path)
+    os.makedirs(path, exist_ok=True)
+    previous = os.path.relpath(current_version(path), path)
+    version = VERSION_PREFIX + uuid.uuid4().hex
+    target = os.path.join(path, version)
+    os.makedirs(target)
+
+    entries = {}
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        np.save(os.path.join(target, name + '.npy'), array, allow_pickle=False)
+        entries[name] = {'dtype': array.dtype.str, 'shape': list(array.shape)}
+
+    manifest = {'format_version': FORMAT_VERSION, 'arrays': entries, **metadata}
+    with open(os.path.join(target, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    staging = os.path.join(path, POINTER_NAME + '.tmp')
+    with open(staging, 'w') as f:
+        f.write(version)
+    os.replace(staging, os.path.join(path, POINTER_NAME))
+
+    # Older versions, unfinished writes and the files of an unversioned artifact
+    for name in os.listdir(path):
+        entry = os.path.join(path, name)
+        if name.startswith(VERSION_PREFIX) and name not in (version, previous):
+            shutil.rmtree(entry)
+        elif name == MANIFEST_NAME or name.endswith('.npy'):
+            os.remove(entry)
+
+def read_artifact(path, mmap_mode='r'):
+    """
+    Open a model artifact directory.
+
+    Arrays are memory-mapped by default, so loading is near-instant and
+    processes serving the same artifact share one page-cache copy. The
+    manifest and arrays come from the one version CURRENT points to; if files
+    disappear mid-read (two writes landing, or an unversioned artifact being
+    replaced), CURRENT is resolved again.
+
+    Parameters:
+    path (str): Artifact directory
+    mmap_mode (str): Passed to np.load; None reads arrays into memory
+
+    Returns:
+    tuple: (manifest dict, dict of array name -> np.ndarray)
+    """
+    for attempt in range(3):
+        directory = current_version(path)
+        try:
+            with open(os.path.join(directory, MANIFEST_NAME)) as f:
+                manifest = json.load(f)
+
+            version = manifest.get('format_version')
+            if version is None or version > FORMAT_VERSION:
+                raise ValueError(f"Unsupported model artifact version {version} in {path}")
+
+            arrays = {
+                name: np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode, allow_pickle=False)
+                for name in manifest['arrays']
+            }
+            return manifest, arrays
+        except FileNotFoundError:
+            if attempt == 2:
+                raise
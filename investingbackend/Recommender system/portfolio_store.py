@@ -0,0 +1,249 @@
+import argparse
+import csv
+import os
+import time
+from itertools import chain
+import numpy as np
+
+def _parse_list_cell(cell):
+    """Split a "['A', 'B']" / "[0.1, 0.2]" cell into its raw item strings."""
+    inner = cell.strip()[1:-1]
+    if not inner.strip():
+        return []
+    return [item.strip().strip("'\"") for item in inner.split(',')]
+
+def read_portfolio_csv(file_path, chunk_size=100000):
+    """
+    Stream users_unique_portfolio.csv straight into typed arrays.
+
+    Only the user_id, ticker and weight columns are parsed; the list-valued
+    interaction columns are skipped. Tickers get codes into a vocabulary built
+    while reading.
+
+    Parameters:
+    file_path (str): Path to the unique portfolios CSV
+    chunk_size (int): Rows converted to arrays at a time
+
+    Returns:
+    tuple: (user_ids, offsets, ticker_codes, weights, vocabulary list)
+    """
+    vocabulary = {}
+    user_ids, length_chunks, code_chunks, weight_chunks = [], [], [], []
+
+    with open(file_path, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        user_col, ticker_col, weight_col = (header.index(name) for name in ('user_id', 'ticker', 'weight'))
+
+        lengths, tickers, weights = [], [], []
+        for record in reader:
+            row_tickers = _parse_list_cell(record[ticker_col])
+            row_weights = _parse_list_cell(record[weight_col])
+            if len(row_tickers) != len(row_weights):
+                raise ValueError(f"Ticker and weight lists differ in length for user {record[user_col]}")
+
+            user_ids.append(record[user_col])
+            lengths.append(len(row_tickers))
+            tickers.extend(row_tickers)
+            weights.extend(row_weights)
+
+            if len(lengths) >= chunk_size:
+                length_chunks.append(np.array(lengths, dtype=np.int64))
+                code_chunks.append(np.fromiter((vocabulary.setdefault(t, len(vocabulary)) for t in tickers),
+                                               dtype=np.int32, count=len(tickers)))
+                weight_chunks.append(np.array(weights, dtype=np.float64))
+                lengths, tickers, weights = [], [], []
+
+        length_chunks.append(np.array(lengths, dtype=np.int64))
+        code_chunks.append(np.fromiter((vocabulary.setdefault(t, len(vocabulary)) for t in tickers),
+                                       dtype=np.int32, count=len(tickers)))
+        weight_chunks.append(np.array(weights, dtype=np.float64))
+
+    offsets = np.concatenate(([0], np.cumsum(np.concatenate(length_chunks))))
+    return (user_ids, offsets, np.concatenate(code_chunks), np.concatenate(weight_chunks),
+            list(vocabulary))
+
+def convert_portfolio_csv(csv_path, npz_path=None):
+    """
+    One-time conversion of the unique portfolios CSV to a binary .npz file.
+
+    Parameters:
+    csv_path (str): Path to users_unique_portfolio.csv
+    npz_path (str): Output path (defaults to the CSV path with a .npz extension)
+
+    Returns:
+    str: Path of the written .npz file
+    """
+    if npz_path is None:
+        npz_path = os.path.splitext(csv_path)[0] + '.npz'
+
+    user_ids, offsets, ticker_codes, weights, vocabulary = read_portfolio_csv(csv_path)
+    np.savez(
+        npz_path,
+        user_ids=np.array(user_ids, dtype=str),
+        offsets=offsets,
+        ticker_codes=ticker_codes,
+        weights=weights,
+        vocabulary=np.array(vocabulary, dtype=str)
+    )
+    return npz_path
+
+class PortfolioStore:
+    """
+    User portfolios kept as compressed sparse rows.
+
+    User i holds ticker_ids[offsets[i]:offsets[i+1]] with the matching weights,
+    where ticker ids are rows of the recommender's stocks_data. A dict maps each
+    user_id to its row, so lookups are O(1) and return views into the arrays.
+    """
+    def __init__(self, user_ids, offsets, ticker_ids, weights, total_weights):
+        self.user_ids = np.asarray(user_ids, dtype=object)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.ticker_ids = np.asarray(ticker_ids, dtype=np.int32)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        # Per-user weight totals, including tickers that were not in the stock universe
+        self.total_weights = np.asarray(total_weights, dtype=np.float64)
+
+        self.user_index = {}
+        for row, user_id in enumerate(self.user_ids):
+            self.user_index.setdefault(user_id, row)
+
+    @classmethod
+    def from_lists(cls, user_ids, ticker_lists, weight_lists, ticker_index):
+        """
+        Build a store from per-user lists of tickers and weights.
+
+        Parameters:
+        user_ids (list): User IDs, one per portfolio
+        ticker_lists (list): List of tickers for each user
+        weight_lists (list): List of weights for each user, aligned with ticker_lists
+        ticker_index (dict): Ticker -> stock row; tickers not in it are dropped
+
+        Returns:
+        PortfolioStore: The packed portfolios
+        """
+        num_users = len(user_ids)
+        lengths = np.fromiter((len(tickers) for tickers in ticker_lists), dtype=np.int64, count=num_users)
+        num_holdings = int(lengths.sum())
+
+        ticker_ids = np.fromiter((ticker_index.get(ticker, -1) for ticker in chain.from_iterable(ticker_lists)),
+                                 dtype=np.int64, count=num_holdings)
+        weights = np.fromiter(chain.from_iterable(weight_lists), dtype=np.float64, count=num_holdings)
+        return cls._pack(user_ids, lengths, ticker_ids, weights)
+
+    @classmethod
+    def from_arrays(cls, user_ids, offsets, ticker_codes, weights, vocabulary, ticker_index):
+        """
+        Build a store from CSR arrays whose ticker codes index a vocabulary.
+
+        Codes are remapped to stock rows via ticker_index, dropping tickers that
+        are not in the stock universe (their weight still counts in the totals).
+        """
+        code_to_id = np.array([ticker_index.get(ticker, -1) for ticker in vocabulary], dtype=np.int64)
+        ticker_ids = code_to_id[ticker_codes] if len(ticker_codes) else np.empty(0, dtype=np.int64)
+        return cls._pack(user_ids, np.diff(offsets), ticker_ids, np.asarray(weights, dtype=np.float64))
+
+    @classmethod
+    def _pack(cls, user_ids, lengths, ticker_ids, weights):
+        """Drop unknown (-1) ticker ids, keeping their weight in the per-user totals."""
+        num_users = len(user_ids)
+        rows = np.repeat(np.arange(num_users), lengths)
+
+        total_weights = np.bincount(rows, weights=weights, minlength=num_users)
+        known = ticker_ids >= 0
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(rows[known], minlength=num_users))))
+
+        return cls(user_ids, offsets, ticker_ids[known], weights[known], total_weights)
+
+    @classmethod
+    def from_csv(cls, file_path, ticker_index):
+        """Parse users_unique_portfolio.csv with the streaming reader."""
+        return cls.from_arrays(*read_portfolio_csv(file_path), ticker_index)
+
+    @classmethod
+    def from_npz(cls, file_path, ticker_index):
+        """Load portfolios written by convert_portfolio_csv."""
+        with np.load(file_path) as data:
+            return cls.from_arrays(data['user_ids'].astype(object), data['offsets'], data['ticker_codes'],
+                                   data['weights'], data['vocabulary'].tolist(), ticker_index)
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def __contains__(self, user_id):
+        return user_id in self.user_index
+
+    @property
+    def nbytes(self):
+        """Memory held by the packed arrays (excluding the user_id strings)."""
+        return (self.offsets.nbytes + self.ticker_ids.nbytes + self.weights.nbytes
+                + self.total_weights.nbytes + self.user_ids.nbytes)
+
+    def row(self, user_id):
+        """Row of the user in the store, or None when the user is unknown."""
+        return self.user_index.get(user_id)
+
+    def get(self, user_id):
+        """
+        Look up a user's holdings.
+
+        Parameters:
+        user_id (str): The ID of the user
+
+        Returns:
+        tuple: (ticker_ids, weights) views into the store, or None when the user is unknown
+        """
+        row = self.user_index.get(user_id)
+        if row is None:
+            return None
+        start, stop = self.offsets[row], self.offsets[row + 1]
+        return self.ticker_ids[start:stop], self.weights[start:stop]
+
+    def remap_tickers(self, id_map):
+        """
+        A store with ticker ids translated through id_map.
+
+        Holdings whose id maps to -1 (delisted stocks) are dropped; their weight
+        stays in the per-user totals like any other ticker outside the universe.
+
+        Parameters:
+        id_map (np.ndarray): Old stock row -> new stock row, or -1
+
+        Returns:
+        PortfolioStore: The remapped portfolios
+        """
+        ticker_ids = id_map[self.ticker_ids]
+        known = ticker_ids >= 0
+        rows = np.repeat(np.arange(len(self.user_ids)), np.diff(self.offsets))
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(rows[known], minlength=len(self.user_ids)))))
+        return PortfolioStore(self.user_ids, offsets, ticker_ids[known], self.weights[known], self.total_weights)
+
+    def to_matrix(self, num_stocks):
+        """
+        The portfolios as a sparse (users x stocks) weight matrix.
+
+        Parameters:
+        num_stocks (int): Number of columns (size of the stock universe)
+
+        Returns:
+        sparse.csr_matrix: Weight matrix over the same ticker ids and weights
+        """
+        # Imported here so inference-only callers don't pay for scipy
+        from scipy import sparse
+        return sparse.csr_matrix(
+            (self.weights, self.ticker_ids, self.offsets),
+            shape=(len(self.user_ids), num_stocks)
+        )
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert users_unique_portfolio.csv to a binary .npz file for fast loading')
+    parser.add_argument('csv_path', type=str, help='Path to the unique portfolios CSV')
+    parser.add_argument('npz_path', type=str, nargs='?', default=None, help='Output path (default: CSV path with .npz)')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    npz_path = convert_portfolio_csv(args.csv_path, args.npz_path)
+    print(f"Wrote {npz_path} in {time.perf_counter() - start:.2f}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from recommender_runtime import RecommenderRuntime, explanation_mode, to_json_safe
+
+RESULT_KINDS = ('recommend', 'risk', 'diversify')
+
+# The model each pool worker loaded in _init_worker
+_worker_runtime = None
+
+def _init_worker(model_path):
+    """Load the model artifact once per worker process (memory-mapped, so workers share its pages)."""
+    global _worker_runtime
+    _worker_runtime = RecommenderRuntime()
+    _worker_runtime.load_model(model_path)
+
+def _precompute_chunk(user_ids, n, diversify_n, explanations):
+    """
+    Compute every result kind for a chunk of users in a pool worker.
+
+    Returns:
+    list: (user_id, kind, JSON payload bytes or None, error message or None) rows
+    """
+    runtime = _worker_runtime
+    rows = []
+    for user_id in user_ids:
+        try:
+            context = runtime.portfolio_context(user_id)
+        except ValueError:
+            # Let each call raise the error it would raise online
+            context = None
+
+        computations = (
+            ('recommend', lambda: runtime.generate_recommendations(
+                user_id, n=n, include_explanations=explanations, context=context)),
+            ('risk', lambda: runtime.analyze_portfolio_risks(user_id, context=context)),
+            ('diversify', lambda: runtime.generate_diversification_recommendations(
+                user_id, n=diversify_n, include_explanations=explanations, context=context))
+        )
+        for kind, compute in computations:
+            try:
+                payload = json.dumps(to_json_safe(compute())).encode('utf-8')
+                rows.append((user_id, kind, payload, None))
+            except ValueError as e:
+                rows.append((user_id, kind, None, str(e)))
+    return rows
+
+def precompute_results(model_path, store_path, n=3, diversify_n=3, explanations='text',
+                       workers=None, chunk_size=500):
+    """
+    Precompute recommendations, risk alerts and diversification for every user into a SQLite store.
+
+    Users are split into chunks across a process pool; the parent process writes
+    the rows. The store is built next to store_path and swapped into place, so a
+    server reading the previous store is never handed a half-written file.
+
+    Parameters:
+    model_path (str): Model artifact directory
+    store_path (str): SQLite file to write
+    n (int): Recommendations per user
+    diversify_n (int): Diversification recommendations per user
+    explanations (bool or str): Explanation mode, as for generate_recommendations
+    workers (int): Worker processes (defaults to the CPU count)
+    chunk_size (int): Users per task
+
+    Returns:
+    dict: Metadata stored with the results
+    """
+    explanations = explanation_mode(explanations)
+    runtime = RecommenderRuntime()
+    runtime.load_model(model_path)
+    if runtime.portfolio_store is None:
+        raise ValueError("The model has no portfolio data to precompute results for")
+    user_ids = list(runtime.portfolio_store.user_index)
+    chunks = [user_ids[start:start + chunk_size] for start in range(0, len(user_ids), chunk_size)]
+
+    metadata = {
+        'model_version': runtime.model_version,
+        'n': n,
+        'diversify_n': diversify_n,
+        'explanations': explanations,
+        'users': len(user_ids),
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z')
+    }
+
+    staging = store_path + '.tmp'
+    if os.path.exists(staging):
+        os.remove(staging)
+    connection = sqlite3.connect(staging)
+    try:
+        # A staging file that is discarded on failure needs no journal
+        connection.execute("PRAGMA journal_mode = OFF")
+        connection.execute("PRAGMA synchronous = OFF")
+        connection.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+        connection.execute(
+            "CREATE TABLE results (user_id TEXT, kind TEXT, payload BLOB, error TEXT, "
+            "PRIMARY KEY (user_id, kind)) WITHOUT ROWID"
+        )
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(model_path,)) as pool:
+            results = pool.map(_precompute_chunk, chunks, [n] * len(chunks), [diversify_n] * len(chunks),
+                               [explanations] * len(chunks))
+            done = 0
+            for rows in results:
+                connection.executemany("INSERT INTO results VALUES (?, ?, ?, ?)", rows)
+                done += len(rows) // len(RESULT_KINDS)
+                print(f"Precomputed {done}/{len(user_ids)} users", flush=True)
+
+        connection.executemany("INSERT INTO meta VALUES (?, ?)",
+                               [(key, json.dumps(value)) for key, value in metadata.items()])
+        connection.commit()
+    finally:
+        connection.close()
+
+    os.replace(staging, store_path)
+    return metadata
+
+class PrecomputedStore:
+    """
+    Read-only view of a store written by precompute_results.
+
+    Lookups are a primary-key read returning the stored JSON bytes, so serving
+    a precomputed user costs no model work at all. Safe to share across threads.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.metadata = {key: json.loads(value) for key, value in self.connection.execute("SELECT key, value FROM meta")}
+
+    def matches(self, kind, n, explanations):
+        """True if the store holds results for this query's options."""
+        expected_n = self.metadata['diversify_n'] if kind == 'diversify' else self.metadata['n']
+        return kind == 'risk' or (n == expected_n and explanations == self.metadata['explanations'])
+
+    def get(self, user_id, kind):
+        """
+        Stored result for a user.
+
+        Parameters:
+        user_id (str): The ID of the user
+        kind (str): 'recommend', 'risk' or 'diversify'
+
+        Returns:
+        bytes: The result as JSON, or None if the user is not in the store (raises
+            ValueError with the stored message if the result could not be computed)
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT payload, error FROM results WHERE user_id = ? AND kind = ?", (user_id, kind)
+            ).fetchone()
+        if row is None:
+            return None
+        payload, error = row
+        if error is not None:
+            raise ValueError(error)
+        return payload
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,170 @@
+import numpy as np
+
+TRADING_DAYS = 252
+RISK_FREE_RATE = 2.0
+# Return and volatility windows in trading days, by column suffix
+PRICE_FEATURE_WINDOWS = {'3m': 63, '6m': 126, '1yr': 252}
+# Share of a window's returns a ticker needs before that window's features are reported
+MIN_WINDOW_FRACTION = 0.5
+# Share of stocks a column needs values for before it is added as a model feature, and
+# share of stocks with a year of history before the risk model is built by default
+MIN_FEATURE_COVERAGE = 0.8
+# Largest factor between the typical size of a derived column and the stocks_data column it replaces
+MAX_UNIT_RATIO = 10.0
+
+def min_observations(days, min_fraction=MIN_WINDOW_FRACTION):
+    """Returns a window of `days` trading days needs before its features are reported."""
+    return max(int(np.ceil(days * min_fraction)), 2)
+
+def price_feature_columns(windows=PRICE_FEATURE_WINDOWS):
+    """Names of the columns compute_price_features returns, in order."""
+    columns = []
+    for name in windows:
+        columns += [f'avg_return_{name}', f'volatility_{name}']
+    return columns + ['sharpe_ratio', 'max_drawdown']
+
+def feature_coverage(features):
+    """Share of tickers with a value, per column of compute_price_features output."""
+    return {column: float(np.mean(~np.isnan(values))) if len(values) else 0.0
+            for column, values in features.items()}
+
+def units_mismatch(derived, reported, check_sign=True, max_ratio=MAX_UNIT_RATIO):
+    """
+    Whether derived values look like they use other units or signs than reported ones.
+
+    Only the stocks with both values are compared, by their median magnitude,
+    which tells fractions from percent (a factor of 100) without flagging stocks
+    whose history simply disagrees with the reported figure. With check_sign, a
+    reported column with a single sign (volatility >= 0, drawdown <= 0) must
+    keep it.
+
+    Parameters:
+    derived (np.ndarray): Values computed from price history, NaN where unknown
+    reported (np.ndarray): The values they would replace, NaN where unknown
+    check_sign (bool): Whether the sign is a convention rather than data (not for returns)
+    max_ratio (float): Largest factor allowed between the median magnitudes
+
+    Returns:
+    bool: True when the columns don't look comparable
+    """
+    both = ~np.isnan(derived) & ~np.isnan(reported)
+    if not both.any():
+        return False
+    derived, reported = derived[both], reported[both]
+
+    derived_size = np.median(np.abs(derived))
+    reported_size = np.median(np.abs(reported))
+    if derived_size > 0 and reported_size > 0 and max(derived_size / reported_size,
+                                                      reported_size / derived_size) > max_ratio:
+        return True
+    if not check_sign:
+        return False
+    if (reported >= 0).all() and np.median(derived) < 0:
+        return True
+    return bool((reported <= 0).all() and np.median(derived) > 0)
+
+def forward_fill(prices):
+    """
+    Carry each column's last known price over missing (NaN) days.
+
+    Parameters:
+    prices (np.ndarray): (days x tickers) prices
+
+    Returns:
+    np.ndarray: Filled prices; leading NaNs stay NaN
+    """
+    valid = ~np.isnan(prices)
+    rows = np.where(valid, np.arange(len(prices))[:, None], 0)
+    np.maximum.accumulate(rows, axis=0, out=rows)
+    filled = np.take_along_axis(prices, rows, axis=0)
+    filled[~np.maximum.accumulate(valid, axis=0)] = np.nan
+    return filled
+
+def compute_price_features(prices, risk_free_rate=RISK_FREE_RATE, windows=PRICE_FEATURE_WINDOWS,
+                           min_fraction=MIN_WINDOW_FRACTION):
+    """
+    Return and risk features for every ticker from its recent prices, all tickers at once.
+
+    Returns are in percent over each window, volatilities are annualized
+    standard deviations of daily log returns in percent. Sharpe ratio and max
+    drawdown use the 1yr window, matching the columns of stocks_data.csv.
+    Missing days are forward filled (a 0 return). A window's features are NaN
+    for tickers with fewer than min_fraction of its returns, i.e. priced for
+    too short a time; max drawdown follows the 1yr window.
+
+    Parameters:
+    prices (np.ndarray): (days x tickers) prices, oldest first; the last longest window + 1 days
+        are used, earlier days only fill gaps at their start
+    risk_free_rate (float): Annual risk-free rate in percent, for the Sharpe ratio
+    windows (dict): Column suffix -> window length in trading days (must include '1yr')
+    min_fraction (float): Share of each window's returns a ticker needs
+
+    Returns:
+    dict: Column name -> float64 array with one value per ticker
+    """
+    longest = max(windows.values())
+    prices = forward_fill(np.array(prices, dtype=np.float64))[-(longest + 1):]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns = np.diff(np.log(prices), axis=0)
+
+    features = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for name, days in windows.items():
+            window = returns[-days:]
+            valid = ~np.isnan(window)
+            count = valid.sum(axis=0)
+            total = np.where(valid, window, 0.0).sum(axis=0)
+            mean = total / count
+            variance = np.where(valid, (window - mean) ** 2, 0.0).sum(axis=0) / (count - 1)
+            enough = count >= min_observations(days, min_fraction)
+
+            features[f'avg_return_{name}'] = np.where(enough, np.expm1(total) * 100, np.nan)
+            features[f'volatility_{name}'] = np.where(enough, np.sqrt(variance * TRADING_DAYS) * 100, np.nan)
+
+        volatility = features['volatility_1yr']
+        features['sharpe_ratio'] = np.where(volatility > 0, (features['avg_return_1yr'] - risk_free_rate) / volatility,
+                                            np.nan)
+
+        # Deepest fall from a running peak within the year
+        window_prices = prices[-(windows['1yr'] + 1):]
+        running_max = np.fmax.accumulate(window_prices, axis=0)
+        drawdown = np.where(np.isnan(window_prices), 0.0, window_prices / running_max - 1).min(axis=0)
+        enough = (~np.isnan(returns[-windows['1yr']:])).sum(axis=0) >= min_observations(windows['1yr'], min_fraction)
+        features['max_drawdown'] = np.where(enough, drawdown * 100, np.nan)
+
+    return {column: features[column] for column in price_feature_columns(windows)}
+
+def price_features(history, tickers, risk_free_rate=RISK_FREE_RATE, windows=PRICE_FEATURE_WINDOWS, block_size=16384,
+                   min_fraction=MIN_WINDOW_FRACTION):
+    """
+    compute_price_features for a list of tickers, read from a PriceHistory.
+
+    Tickers are processed block_size at a time so memory stays at a few
+    windows' worth of prices per block. Gaps are filled from closes up to one
+    longest window before it, the way RollingStats carries prices forward.
+
+    Parameters:
+    history (PriceHistory): Memory-mapped price history
+    tickers (list): Tickers to compute features for (NaN for tickers without history)
+    risk_free_rate (float): Annual risk-free rate in percent
+    windows (dict): Column suffix -> window length in trading days
+    block_size (int): Tickers computed at a time
+    min_fraction (float): Share of each window's returns a ticker needs
+
+    Returns:
+    dict: Column name -> float64 array aligned with tickers
+    """
+    columns = history.columns(tickers)
+    features = {column: np.full(len(tickers), np.nan) for column in price_feature_columns(windows)}
+    # A further window of days before the longest, to fill gaps at its start from earlier closes
+    recent = history.prices[-(2 * max(windows.values()) + 1):]
+
+    for start in range(0, len(tickers), block_size):
+        block_columns = columns[start:start + block_size]
+        known = np.flatnonzero(block_columns >= 0)
+        if not len(known) or not len(recent):
+            continue
+        block = compute_price_features(recent[:, block_columns[known]], risk_free_rate, windows, min_fraction)
+        for column, values in block.items():
+            features[column][start + known] = values
+    return features
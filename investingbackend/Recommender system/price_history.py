@@ -0,0 +1,332 @@
+import argparse
+import json
+import os
+import shutil
+import time
+import numpy as np
+import pandas as pd
+
+FORMAT_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+PRICES_NAME = 'prices.f32'
+DATES_NAME = 'dates.i64'
+
+def is_price_history(path):
+    """True if path is a price history directory (has a manifest)."""
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, MANIFEST_NAME))
+
+def _write_manifest(path, tickers, num_dates):
+    """Replace the manifest in one rename, so readers see either the old or the new day count."""
+    staging = os.path.join(path, MANIFEST_NAME + '.tmp')
+    with open(staging, 'w') as f:
+        json.dump({'format_version': FORMAT_VERSION, 'num_dates': num_dates, 'tickers': list(tickers)}, f)
+    os.replace(staging, os.path.join(path, MANIFEST_NAME))
+
+def write_price_history(path, dates, tickers, prices):
+    """
+    Write a price history directory: raw float32 prices, raw dates and a JSON manifest.
+
+    Prices are stored row-major as (dates x tickers), so a new trading day is
+    one more row at the end of the file. The directory is written next to the
+    target and swapped into place.
+
+    Parameters:
+    path (str): Price history directory
+    dates (np.ndarray): Trading days, ascending (anything np.datetime64 accepts)
+    tickers (list): Ticker of each column
+    prices (np.ndarray): (dates x tickers) prices, NaN where a ticker has no price
+    """
+    dates = np.asarray(dates, dtype='datetime64[D]')
+    prices = np.ascontiguousarray(prices, dtype=np.float32)
+    if prices.shape != (len(dates), len(tickers)):
+        raise ValueError(f"Prices have shape {prices.shape}, expected {(len(dates), len(tickers))}")
+    if len(dates) > 1 and not (np.diff(dates) > np.timedelta64(0, 'D')).all():
+        raise ValueError("Dates must be strictly increasing")
+
+    path = os.path.normpath(path)
+    staging = path + '.tmp'
+    if os.path.exists(staging):
+        shutil.rmtree(staging)
+    os.makedirs(staging)
+
+    prices.tofile(os.path.join(staging, PRICES_NAME))
+    dates.astype(np.int64).tofile(os.path.join(staging, DATES_NAME))
+    _write_manifest(staging, tickers, len(dates))
+
+    previous = path + '.old'
+    if os.path.exists(path):
+        if os.path.exists(previous):
+            shutil.rmtree(previous)
+        os.rename(path, previous)
+    os.rename(staging, path)
+    if os.path.exists(previous):
+        shutil.rmtree(previous)
+
+def convert_price_csv(csv_path, path, chunk_size=2000000):
+    """
+    Pivot a long date,ticker,price CSV (historical_prices.csv) into a price history directory.
+
+    The CSV is read in chunks and only integer codes and float32 prices are
+    kept, so memory stays near the size of the final matrix. Tickers keep the
+    order they first appear in; dates are sorted.
+
+    Parameters:
+    csv_path (str): Path to historical_prices.csv
+    path (str): Price history directory to write
+    chunk_size (int): CSV rows parsed at a time
+
+    Returns:
+    str: The price history directory
+    """
+    tickers = pd.Index([], dtype=object)
+    dates = pd.Index([], dtype=object)
+    ticker_codes, date_codes, prices = [], [], []
+
+    for chunk in pd.read_csv(csv_path, usecols=['date', 'ticker', 'price'], dtype={'date': str, 'ticker': str},
+                             chunksize=chunk_size):
+        chunk_tickers = pd.unique(chunk['ticker'])
+        tickers = tickers.append(pd.Index(chunk_tickers).difference(tickers, sort=False))
+        chunk_dates = pd.unique(chunk['date'])
+        dates = dates.append(pd.Index(chunk_dates).difference(dates, sort=False))
+
+        ticker_codes.append(tickers.get_indexer(chunk['ticker']).astype(np.int32))
+        date_codes.append(dates.get_indexer(chunk['date']).astype(np.int32))
+        prices.append(chunk['price'].to_numpy(dtype=np.float32))
+
+    date_values = np.array(dates.tolist(), dtype='datetime64[D]')
+    order = np.argsort(date_values, kind='stable')
+    date_rank = np.empty_like(order)
+    date_rank[order] = np.arange(len(order))
+
+    matrix = np.full((len(dates), len(tickers)), np.nan, dtype=np.float32)
+    for ticker_chunk, date_chunk, price_chunk in zip(ticker_codes, date_codes, prices):
+        matrix[date_rank[date_chunk], ticker_chunk] = price_chunk
+
+    write_price_history(path, date_values[order], tickers.tolist(), matrix)
+    return path
+
+class PriceHistory:
+    """
+    Memory-mapped (dates x tickers) float32 price matrix with a date index.
+
+    Opening is near-instant and processes reading the same directory share one
+    page-cache copy. Window slices over all tickers are views into the map.
+    Days are appended in place; adding tickers needs a rewrite with
+    write_price_history.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+
+        version = manifest.get('format_version')
+        if version is None or version > FORMAT_VERSION:
+            raise ValueError(f"Unsupported price history version {version} in {path}")
+
+        self.tickers = manifest['tickers']
+        self.ticker_index = {ticker: column for column, ticker in enumerate(self.tickers)}
+        self._map(manifest['num_dates'])
+
+    def _map(self, num_dates):
+        """Map the first num_dates rows; rows past them are an unfinished append."""
+        self.dates = np.fromfile(os.path.join(self.path, DATES_NAME), dtype=np.int64,
+                                 count=num_dates).astype('datetime64[D]')
+        if num_dates and self.tickers:
+            self.prices = np.memmap(os.path.join(self.path, PRICES_NAME), dtype=np.float32, mode='r',
+                                    shape=(num_dates, len(self.tickers)))
+        else:
+            self.prices = np.empty((num_dates, len(self.tickers)), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.dates)
+
+    @property
+    def last_date(self):
+        """Most recent trading day, or None if the history is empty."""
+        return self.dates[-1] if len(self.dates) else None
+
+    def columns(self, tickers):
+        """
+        Column of each ticker.
+
+        Parameters:
+        tickers (list): Tickers to look up
+
+        Returns:
+        np.ndarray: Column indices, -1 for tickers without history
+        """
+        return np.fromiter((self.ticker_index.get(ticker, -1) for ticker in tickers), dtype=np.int64,
+                           count=len(tickers))
+
+    def window(self, start=None, end=None, tickers=None):
+        """
+        Prices between two dates.
+
+        Parameters:
+        start (str or np.datetime64): First day included (defaults to the first day)
+        end (str or np.datetime64): Last day included (defaults to the last day)
+        tickers (list): Tickers to select (defaults to all; unknown tickers get NaN columns)
+
+        Returns:
+        tuple: (dates, prices) - prices is a view into the map when tickers is None
+        """
+        first = 0 if start is None else int(np.searchsorted(self.dates, np.datetime64(start, 'D'), 'left'))
+        stop = len(self.dates) if end is None else int(np.searchsorted(self.dates, np.datetime64(end, 'D'), 'right'))
+        return self.dates[first:stop], self._select(slice(first, stop), tickers)
+
+    def last(self, days, tickers=None):
+        """
+        Prices over the most recent trading days.
+
+        Parameters:
+        days (int): Number of trading days
+        tickers (list): Tickers to select (defaults to all)
+
+        Returns:
+        tuple: (dates, prices)
+        """
+        first = max(len(self.dates) - days, 0)
+        return self.dates[first:], self._select(slice(first, None), tickers)
+
+    def log_returns(self, start=None, end=None, tickers=None, days=None):
+        """
+        Daily log returns over a window (from the most recent `days` days when given).
+
+        Returns:
+        tuple: (dates, returns) - float32 (days - 1 x tickers); a return is NaN
+            when either of its prices is missing
+        """
+        dates, prices = self.last(days, tickers) if days is not None else self.window(start, end, tickers)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_prices = np.log(prices)
+        return dates[1:], np.diff(log_prices, axis=0)
+
+    def _select(self, rows, tickers):
+        if tickers is None:
+            return self.prices[rows]
+        columns = self.columns(tickers)
+        selected = self.prices[rows][:, np.maximum(columns, 0)]
+        selected[:, columns < 0] = np.nan
+        return selected
+
+    def append(self, dates, prices):
+        """
+        Append new trading days without rewriting existing ones.
+
+        Rows are added to the end of the files first and the manifest's day
+        count is bumped last, so a reader never maps a partly written day.
+
+        Parameters:
+        dates (list): New trading days, ascending and after last_date
+        prices (np.ndarray or dict): (new days x tickers) prices in column order,
+            or for a single day a dict of ticker -> price (missing tickers get NaN)
+
+        Returns:
+        int: Number of days in the history afterwards
+        """
+        dates = np.atleast_1d(np.asarray(dates, dtype='datetime64[D]'))
+        if isinstance(prices, dict):
+            if len(dates) != 1:
+                raise ValueError("A dict of prices covers exactly one day")
+            unknown = [ticker for ticker in prices if ticker not in self.ticker_index]
+            if unknown:
+                raise ValueError(f"Tickers without price history: {', '.join(unknown[:5])}")
+            row = np.full(len(self.tickers), np.nan, dtype=np.float32)
+            row[self.columns(list(prices))] = list(prices.values())
+            prices = row
+        prices = np.ascontiguousarray(np.atleast_2d(prices), dtype=np.float32)
+
+        if prices.shape != (len(dates), len(self.tickers)):
+            raise ValueError(f"Prices have shape {prices.shape}, expected {(len(dates), len(self.tickers))}")
+        if len(dates) > 1 and not (np.diff(dates) > np.timedelta64(0, 'D')).all():
+            raise ValueError("Dates must be strictly increasing")
+        if len(self.dates) and len(dates) and dates[0] <= self.last_date:
+            raise ValueError(f"Date {dates[0]} is not after the last day in the history ({self.last_date})")
+
+        num_dates = len(self.dates)
+        # Drop leftovers of an append that never reached the manifest
+        with open(os.path.join(self.path, PRICES_NAME), 'r+b') as f:
+            f.truncate(num_dates * len(self.tickers) * 4)
+            f.seek(0, os.SEEK_END)
+            prices.tofile(f)
+        with open(os.path.join(self.path, DATES_NAME), 'r+b') as f:
+            f.truncate(num_dates * 8)
+            f.seek(0, os.SEEK_END)
+            dates.astype(np.int64).tofile(f)
+
+        _write_manifest(self.path, self.tickers, num_dates + len(dates))
+        self._map(num_dates + len(dates))
+        return len(self.dates)
+
+    def refresh(self):
+        """Remap after another process appended days."""
+        with open(os.path.join(self.path, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+        if manifest['tickers'] != self.tickers:
+            self.__init__(self.path)
+        elif manifest['num_dates'] != len(self.dates):
+            self._map(manifest['num_dates'])
+
+def open_price_history(path):
+    """
+    Open price history from a directory, converting a long CSV on first use.
+
+    A CSV path is converted to a directory next to it (historical_prices.csv ->
+    historical_prices/), which is reused while it is newer than the CSV.
+
+    Parameters:
+    path (str): Price history directory or historical_prices.csv
+
+    Returns:
+    PriceHistory: The opened history
+    """
+    if not path.endswith('.csv'):
+        return PriceHistory(path)
+    directory = os.path.splitext(path)[0]
+    manifest = os.path.join(directory, MANIFEST_NAME)
+    if not (is_price_history(directory) and os.path.getmtime(manifest) >= os.path.getmtime(path)):
+        convert_price_csv(path, directory)
+    return PriceHistory(directory)
+
+def main():
+    parser = argparse.ArgumentParser(description='Build and update memory-mapped price history')
+    subparsers = parser.add_subparsers(dest='command', help='Command to run')
+
+    convert_parser = subparsers.add_parser('convert', help='Convert historical_prices.csv to a price history directory')
+    convert_parser.add_argument('csv_path', type=str, help='Long date,ticker,price CSV')
+    convert_parser.add_argument('path', type=str, nargs='?', default=None, help='Output directory (default: CSV path without .csv)')
+
+    append_parser = subparsers.add_parser('append', help='Append new trading days from a date,ticker,price CSV')
+    append_parser.add_argument('path', type=str, help='Price history directory')
+    append_parser.add_argument('csv_path', type=str, help='CSV with the new days')
+
+    info_parser = subparsers.add_parser('info', help='Show the size and date range of a price history')
+    info_parser.add_argument('path', type=str, help='Price history directory')
+
+    args = parser.parse_args()
+    start = time.perf_counter()
+
+    if args.command == 'convert':
+        path = convert_price_csv(args.csv_path, args.path or os.path.splitext(args.csv_path)[0])
+        history = PriceHistory(path)
+        print(f"Wrote {path} ({len(history)} days x {len(history.tickers)} tickers) in {time.perf_counter() - start:.2f}s")
+    elif args.command == 'append':
+        history = PriceHistory(args.path)
+        new_prices = pd.read_csv(args.csv_path, usecols=['date', 'ticker', 'price'])
+        unknown = set(new_prices['ticker']) - set(history.ticker_index)
+        if unknown:
+            print(f"Skipping {len(unknown)} tickers without price history")
+        matrix = new_prices.pivot_table(index='date', columns='ticker', values='price', aggfunc='last')
+        matrix = matrix.reindex(columns=history.tickers)
+        history.append(matrix.index.to_numpy(dtype=str), matrix.to_numpy(dtype=np.float32))
+        print(f"Appended {len(matrix)} days in {time.perf_counter() - start:.2f}s; history ends {history.last_date}")
+    elif args.command == 'info':
+        history = PriceHistory(args.path)
+        missing = float(np.isnan(history.prices).mean()) if history.prices.size else 0.0
+        print(f"{len(history)} days x {len(history.tickers)} tickers, {history.dates[0] if len(history) else '-'} "
+              f"to {history.last_date}, {missing:.1%} missing")
+    else:
+        parser.print_help()
+
+if __name__ == "__main__":
+    main()
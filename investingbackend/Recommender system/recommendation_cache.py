@@ -0,0 +1,152 @@
+import hashlib
+import sys
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+def portfolio_fingerprint(kind, stock_ids, weights, params, model_version):
+    """
+    Cache key for a query on a portfolio.
+
+    Parameters:
+    kind (str): Which analysis the result belongs to
+    stock_ids (np.ndarray): Stock rows held (or the queried stock)
+    weights (np.ndarray): Matching weights
+    params (tuple): Query options such as n and flags
+    model_version (str): Version of the model that computed the result
+
+    Returns:
+    str: Hex digest identifying the query
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{kind}|{model_version}|{params!r}|".encode())
+    digest.update(np.ascontiguousarray(stock_ids, dtype=np.int64).tobytes())
+    digest.update(np.ascontiguousarray(weights, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+def estimate_size(value):
+    """Approximate memory held by a result made of dicts, lists, tuples and scalars."""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(estimate_size(key) + estimate_size(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(estimate_size(item) for item in value)
+    return size
+
+class RecommendationCache:
+    """
+    Thread-safe LRU cache of recommendation and risk results.
+
+    Entries are bounded by an approximate memory cap rather than a count, can
+    expire after a TTL, and can be dropped per user or all at once when the
+    model changes. Hit/miss counters are kept for monitoring.
+    """
+    def __init__(self, max_bytes=64 << 20, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # key -> (value, size, expires_at, tag)
+        self.entries = OrderedDict()
+        # tag (user ID or ticker) -> keys cached for it
+        self.tag_keys = {}
+        self.current_bytes = 0
+        self.model_version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Cached value for key, or None on a miss or an expired entry."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[2] is not None and entry[2] <= time.monotonic():
+                self._drop(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, tag=None):
+        """
+        Store a value, evicting least recently used entries to stay under max_bytes.
+
+        Parameters:
+        key (str): Cache key, usually from portfolio_fingerprint
+        value: Result to cache
+        tag (str): User ID or ticker the result belongs to, for invalidate()
+        """
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = (value, size, expires_at, tag)
+            self.current_bytes += size
+            if tag is not None:
+                self.tag_keys.setdefault(tag, set()).add(key)
+
+            while self.current_bytes > self.max_bytes:
+                self._drop(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, tag):
+        """Drop every entry cached for a user ID or ticker (e.g. after their portfolio changed)."""
+        with self.lock:
+            for key in list(self.tag_keys.get(tag, ())):
+                self._drop(key)
+                self.invalidations += 1
+
+    def bind_model(self, model_version):
+        """Clear the cache when results come from a different model version than before."""
+        with self.lock:
+            if model_version != self.model_version:
+                self.invalidations += len(self.entries)
+                self._clear()
+                self.model_version = model_version
+
+    def clear(self):
+        """Drop every entry."""
+        with self.lock:
+            self.invalidations += len(self.entries)
+            self._clear()
+
+    def stats(self):
+        """Counters and occupancy, for monitoring."""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations
+            }
+
+    def _drop(self, key):
+        value, size, expires_at, tag = self.entries.pop(key)
+        self.current_bytes -= size
+        if tag is not None:
+            keys = self.tag_keys.get(tag)
+            keys.discard(key)
+            if not keys:
+                del self.tag_keys[tag]
+
+    def _clear(self):
+        self.entries.clear()
+        self.tag_keys.clear()
+        self.current_bytes = 0
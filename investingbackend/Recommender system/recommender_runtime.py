@@ -0,0 +1,953 @@
+import argparse
+import copy
+import json
+import math
+import sys
+import traceback
+import numpy as np
+from ann_index import IVFIndex
+from model_artifact import is_artifact, read_artifact
+from portfolio_store import PortfolioStore
+from recommendation_cache import RecommendationCache, portfolio_fingerprint
+from risk_model import estimated_stocks, portfolio_risk
+
+# Explanation fragments, by id. Every recommendation's explanation is a reason,
+# the price and the size/ESG/beta phrases of its stock.
+EXPLANATION_FRAGMENTS = {
+    'similar': "This stock is similar to what you already like, with a match score of {score:.2f}. ",
+    'new_sector': ("This stock is in the {sector} sector, which is not currently in your portfolio. "
+                   "Adding it would help spread your investments across more industries. "),
+    'price': "It's priced at ${price:.2f}. ",
+    'size_smaller': "It's a smaller company. ",
+    'size_medium': "It's a medium-sized company. ",
+    'size_large': "It's a large company. ",
+    'size_very_large': "It's a very large company. ",
+    'esg_good': "It has good environmental and social practices. ",
+    'esg_excellent': "It has excellent environmental and social practices. ",
+    'beta_high': "The stock price tends to change more than the overall market. ",
+    'beta_low': "The stock price tends to be more stable than the overall market. "
+}
+EXPLANATION_MODES = ('text', 'ids', 'off')
+# What generate_recommendations ranks stocks by: scaled fundamentals (cosine),
+# return correlations, or a weighted mix of the two
+SIMILARITY_MODES = ('fundamentals', 'correlation', 'blend')
+
+_SIZE_IDS = ('size_smaller', 'size_medium', 'size_large', 'size_very_large')
+_ESG_IDS = ((), ('esg_good',), ('esg_excellent',))
+_BETA_IDS = ((), ('beta_high',), ('beta_low',))
+
+# Stock phrase ids and their rendered text for each explanation code (size * 9 + esg * 3 + beta)
+_STOCK_FRAGMENT_IDS = [
+    (size_id,) + esg_ids + beta_ids
+    for size_id in _SIZE_IDS for esg_ids in _ESG_IDS for beta_ids in _BETA_IDS
+]
+_STOCK_FRAGMENT_TEXT = [
+    ''.join(EXPLANATION_FRAGMENTS[fragment_id] for fragment_id in fragment_ids)
+    for fragment_ids in _STOCK_FRAGMENT_IDS
+]
+
+def explanation_mode(include_explanations):
+    """
+    Normalize an include_explanations argument to 'text', 'ids' or 'off'.
+    
+    True and False are accepted for 'text' and 'off'.
+    """
+    if include_explanations is True:
+        return 'text'
+    if include_explanations is False or include_explanations is None:
+        return 'off'
+    if include_explanations not in EXPLANATION_MODES:
+        raise ValueError(f"Explanation mode must be one of {', '.join(EXPLANATION_MODES)}")
+    return include_explanations
+
+def render_explanation(recommendation):
+    """
+    Explanation text for a recommendation returned with include_explanations='ids'.
+    
+    Parameters:
+    recommendation (dict): A result dict carrying 'explanation_ids'
+    
+    Returns:
+    str: The same text the 'text' mode returns
+    """
+    values = {
+        'score': recommendation['similarity_score'],
+        'sector': recommendation['sector'],
+        'price': recommendation['price']
+    }
+    return ''.join(EXPLANATION_FRAGMENTS[fragment_id].format(**values)
+                   for fragment_id in recommendation['explanation_ids'])
+
+def to_json_safe(value):
+    """Convert numpy scalars, tuples and NaN into plain JSON-serializable values."""
+    if isinstance(value, dict):
+        return {str(key): to_json_safe(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_json_safe(item) for item in value]
+    if isinstance(value, np.ndarray):
+        return [to_json_safe(item) for item in value.tolist()]
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        # JSON has no NaN, and JSON.parse in the Node backend rejects it
+        return float(value) if math.isfinite(value) else None
+    if isinstance(value, np.bool_):
+        return bool(value)
+    return value
+
+class PortfolioContext:
+    """
+    One user's portfolio, resolved once and shared by several analyses.
+
+    Holdings are looked up on creation; sector totals, the profile vector and
+    the exact similarity row are computed on first use and then reused, so a
+    full report derives them once instead of once per analysis.
+    """
+    def __init__(self, runtime, user_id):
+        self.runtime = runtime
+        self.user_id = user_id
+        self.stock_ids, self.weights, self.total_weight = runtime._user_holdings(user_id)
+        self._sector_totals = None
+        self._profile = None
+        self._similarities = None
+        self._correlations = None
+
+    @property
+    def sector_totals(self):
+        """Held weight per sector code."""
+        if self._sector_totals is None:
+            self._sector_totals = np.bincount(self.runtime.sector_codes[self.stock_ids], weights=self.weights,
+                                              minlength=len(self.runtime.sector_names))
+        return self._sector_totals
+
+    @property
+    def held_sectors(self):
+        """Codes of the sectors the portfolio holds at least one stock in, in order of first holding."""
+        codes = self.runtime.sector_codes[self.stock_ids]
+        _, first_positions = np.unique(codes, return_index=True)
+        return codes[np.sort(first_positions)]
+
+    @property
+    def profile(self):
+        """Weighted average of the held stocks' feature rows."""
+        if self._profile is None:
+            self._profile = self.runtime._profile_from_holdings(self.stock_ids, self.weights)
+        return self._profile
+
+    def similarities(self, min_candidates=0, eligible_ids=None):
+        """
+        Cosine similarity of the profile against the stocks.
+
+        The exact row is computed once. With an ANN index, each call retrieves its
+        own candidates, since they depend on min_candidates and eligible_ids.
+        """
+        if self.runtime.ann_index is not None:
+            return self.runtime._user_similarities(self.profile, min_candidates, eligible_ids)
+        if self._similarities is None:
+            self._similarities = self.runtime._profile_similarities(self.profile)[0]
+        return self._similarities
+
+    def correlations(self):
+        """Weighted return correlation of the holdings with every stock (see _correlation_similarities)."""
+        if self._correlations is None:
+            self._correlations = self.runtime._correlation_similarities(self.stock_ids, self.weights)
+        return self._correlations
+
+class RecommenderRuntime:
+    """
+    Inference-only recommender over the arrays of a saved model artifact.
+
+    Needs only NumPy and the standard library, so short-lived workers can answer
+    recommendation, risk and similar-stock queries without importing pandas or
+    scikit-learn. Training lives in ImprovedStockRecommender, which extends it.
+    """
+    def __init__(self):
+        # Identifies the saved artifact this model was loaded from (None until saved/loaded)
+        self.model_version = None
+        # Unique-format portfolios, packed as CSR arrays
+        self.portfolio_store = None
+        self.stock_features = None
+        self.normalized_features = None
+        # Top-K most similar stocks per stock (ids and cosine scores)
+        self.neighbor_k = 50
+        self.neighbor_ids = None
+        self.neighbor_scores = None
+        # Top-K most correlated stocks per stock by daily returns, when trained with price history
+        self.correlation_ids = None
+        self.correlation_scores = None
+        # How they were built ({'k', 'days', 'coverage'}); coverage is the share of stocks with any
+        self.correlation_index = None
+        # Optional approximate nearest-neighbor index for user queries
+        self.ann_index = None
+        # Row position of each ticker in the stock arrays
+        self.ticker_index = {}
+        # Columnar stock metadata used to assemble results
+        self.tickers = None
+        self.company_names = None
+        self.sector_names = []
+        self.sector_codes = None
+        self.prices = None
+        self.market_caps = None
+        self.esg_scores = None
+        self.betas = None
+        self.explanation_codes = None
+        self.explanation_text = None
+        # Define sector diversification thresholds
+        self.sector_concentration_threshold = 0.5  # Alert if a sector is over 50%
+        self.sector_count_min = 3  # Recommend having at least 3 sectors
+        self.portfolio_volatility_threshold = 25.0  # Alert above 25% annualized volatility
+        self.risk_coverage_threshold = 0.8  # Report volatility when 80% of the weight has price history
+        # Covariance model (factors @ factors.T + diag(specific_variance)), when trained with price history
+        self.risk_factors = None
+        self.specific_variance = None
+        self.risk_model = None
+        # Optional cache of query results (see enable_cache)
+        self.result_cache = None
+    
+    def enable_cache(self, max_bytes=64 << 20, ttl=None):
+        """
+        Cache recommendation, risk and diversification results.
+        
+        Results are keyed by the user's holdings, the query options and the model
+        version, so a changed portfolio or model never serves a stale result.
+        
+        Parameters:
+        max_bytes (int): Approximate memory cap; least recently used results are evicted first
+        ttl (float): Seconds a result stays valid (None keeps it until evicted)
+        
+        Returns:
+        RecommendationCache: The cache, e.g. for stats()
+        """
+        self.result_cache = RecommendationCache(max_bytes=max_bytes, ttl=ttl)
+        return self.result_cache
+    
+    def invalidate_cached_results(self, user_id=None):
+        """Drop cached results for one user (or ticker), or all of them when user_id is None."""
+        if self.result_cache is None:
+            return
+        if user_id is None:
+            self.result_cache.clear()
+        else:
+            self.result_cache.invalidate(user_id)
+    
+    def _cached(self, kind, user_input, params, compute, context=None):
+        """Serve compute() through the result cache when the query can be fingerprinted."""
+        if self.result_cache is None or not isinstance(user_input, str):
+            return compute()
+        
+        if kind == 'recommend' and user_input in self.ticker_index:
+            stock_ids, weights = [self.ticker_index[user_input]], []
+        elif context is not None:
+            stock_ids, weights = context.stock_ids, context.weights
+        else:
+            try:
+                stock_ids, weights, _ = self._user_holdings(user_input)
+            except ValueError:
+                # Unknown users aren't cached; compute() reports the error
+                stock_ids = None
+            if stock_ids is None:
+                return compute()
+        
+        self.result_cache.bind_model(self.model_version)
+        key = portfolio_fingerprint(kind, stock_ids, weights, params, self.model_version)
+        result = self.result_cache.get(key)
+        if result is None:
+            result = compute()
+            if isinstance(result, dict) and 'error' in result:
+                return result
+            self.result_cache.put(key, result, tag=user_input)
+        # Callers may modify what they get back
+        return copy.deepcopy(result)
+    
+    def portfolio_context(self, user_id):
+        """
+        Resolve a user's portfolio once for several analyses.
+        
+        Pass the result as context= to analyze_portfolio_risks,
+        generate_recommendations and generate_diversification_recommendations so
+        they share the holdings, profile and similarity row.
+        
+        Parameters:
+        user_id (str): The ID of the user
+        
+        Returns:
+        PortfolioContext: The user's memoized portfolio view
+        """
+        return PortfolioContext(self, user_id)
+    
+    def load_model(self, filepath, mmap_mode='r'):
+        """
+        Load a model artifact directory written by ImprovedStockRecommender.save_model.
+        
+        Parameters:
+        filepath (str): Path to the artifact directory
+        mmap_mode (str): Memory-map mode for the arrays (None reads them into memory)
+        """
+        if not is_artifact(filepath):
+            raise ValueError(f"{filepath} is not a model artifact directory")
+        self._load_artifact(filepath, mmap_mode)
+    
+    def _load_artifact(self, path, mmap_mode='r'):
+        """
+        Memory-map the arrays needed for inference.
+        
+        Returns:
+        tuple: (manifest dict, dict of arrays) for subclasses that load more
+        """
+        manifest, arrays = read_artifact(path, mmap_mode)
+        self.model_version = manifest['model_version']
+        self.neighbor_k = manifest['neighbor_k']
+        
+        self.stock_features = arrays['stock_features']
+        self.normalized_features = arrays['normalized_features']
+        self.neighbor_ids = arrays['neighbor_ids']
+        self.neighbor_scores = arrays['neighbor_scores']
+        
+        self.ann_index = None
+        if manifest.get('ann_index'):
+            self.ann_index = IVFIndex(**manifest['ann_index'])
+            self.ann_index.centroids = arrays['ann.centroids']
+            self.ann_index.list_offsets = arrays['ann.list_offsets']
+            self.ann_index.list_ids = arrays['ann.list_ids']
+        
+        string_columns = {column['name'] for column in manifest['stock_columns']
+                          if column['kind'] == 'string' and column['nulls']}
+        self.tickers = arrays['stocks.ticker'].astype(object)
+        self.company_names = self._string_column(arrays, 'company_name', 'company_name' in string_columns)
+        sector_names, sector_codes = np.unique(
+            self._string_column(arrays, 'sector', 'sector' in string_columns).astype(str), return_inverse=True
+        )
+        self.sector_codes = sector_codes.astype(np.int32)
+        self.sector_names = sector_names.tolist()
+        self.prices = np.asarray(arrays['stocks.price'], dtype=np.float64)
+        self.market_caps = np.asarray(arrays['stocks.market_cap'], dtype=np.float64)
+        self.esg_scores = np.asarray(arrays['stocks.esg_score'], dtype=np.float64)
+        self.betas = np.asarray(arrays['stocks.beta'], dtype=np.float64)
+        self._build_explanation_fragments()
+        self._build_ticker_index()
+        
+        self.portfolio_store = None
+        if 'portfolios.offsets' in arrays:
+            self.portfolio_store = PortfolioStore(
+                arrays['portfolios.user_ids'],
+                arrays['portfolios.offsets'],
+                arrays['portfolios.ticker_ids'],
+                arrays['portfolios.weights'],
+                arrays['portfolios.total_weights']
+            )
+        
+        self.risk_model = manifest.get('risk_model')
+        self.risk_factors = arrays.get('risk.factors')
+        self.specific_variance = arrays.get('risk.specific_variance')
+        self.correlation_ids = arrays.get('correlation_ids')
+        self.correlation_scores = arrays.get('correlation_scores')
+        self.correlation_index = manifest.get('correlation_index')
+        
+        return manifest, arrays
+    
+    def _string_column(self, arrays, name, has_nulls):
+        """A stored string column as an object array, with missing values as "Unknown"."""
+        values = arrays[f'stocks.{name}'].astype(object)
+        if has_nulls:
+            values[np.asarray(arrays[f'stocks.{name}.nulls'])] = "Unknown"
+        return values
+    
+    def _build_explanation_fragments(self):
+        """
+        Precompute the stock-specific part of every stock's explanation.
+        
+        explanation_codes picks each stock's size, ESG and beta phrases (an index
+        into _STOCK_FRAGMENT_IDS), and explanation_text holds the rendered price and
+        phrases, so a request only prepends its reason.
+        """
+        size = ((self.market_caps > 100).astype(np.int8) + (self.market_caps > 1000)
+                + (self.market_caps > 10000))
+        esg = (self.esg_scores > 60).astype(np.int8) + (self.esg_scores > 80)
+        beta = np.where(self.betas > 1.5, 1, np.where(self.betas < 0.8, 2, 0)).astype(np.int8)
+        self.explanation_codes = size * 9 + esg * 3 + beta
+        
+        price_fragment = EXPLANATION_FRAGMENTS['price']
+        self.explanation_text = [
+            price_fragment.format(price=price) + _STOCK_FRAGMENT_TEXT[code]
+            for price, code in zip(self.prices.tolist(), self.explanation_codes.tolist())
+        ]
+    
+    def _build_ticker_index(self):
+        """Map each ticker to its row in the stock arrays (first listing wins for duplicates)."""
+        self.ticker_index = {}
+        for idx, ticker in enumerate(self.tickers):
+            self.ticker_index.setdefault(ticker, idx)
+    
+    def _portfolio_row(self, user_id):
+        """Row of a unique-portfolio user, or None if the user isn't in the store."""
+        if self.portfolio_store is None:
+            return None
+        return self.portfolio_store.row(user_id)
+    
+    def _portfolio_rows(self, user_ids):
+        """Store rows for a list of user IDs, raising ValueError for unknown users."""
+        if self.portfolio_store is None:
+            raise ValueError("No unique portfolios data loaded")
+        
+        rows = [self.portfolio_store.row(user_id) for user_id in user_ids]
+        missing = [user_id for user_id, row in zip(user_ids, rows) if row is None]
+        if missing:
+            raise ValueError(f"Users not found in unique portfolios data: {', '.join(missing[:5])}")
+        return np.asarray(rows, dtype=np.int64)
+    
+    def _similar_stock_indices(self, stock_idx, n, exclude_self=True):
+        """
+        Top-N stocks similar to the stock at stock_idx, with their similarities.
+        
+        Served from the neighbor index when it holds enough neighbors, otherwise
+        by scoring the stock against the whole universe.
+        """
+        if n <= self.neighbor_ids.shape[1]:
+            ids = self.neighbor_ids[stock_idx, :n].astype(np.int64)
+            scores = self.neighbor_scores[stock_idx, :n].astype(np.float64)
+            if not exclude_self:
+                self_score = 1.0 if self.normalized_features[stock_idx].any() else 0.0
+                ids = np.concatenate(([stock_idx], ids))[:n]
+                scores = np.concatenate(([self_score], scores))[:n]
+            return ids, scores
+        
+        similarities = self.normalized_features @ self.normalized_features[stock_idx]
+        ids = self._top_n_indices(similarities, n, [stock_idx] if exclude_self else None)
+        return ids, similarities[ids]
+    
+    def _user_holdings(self, user_id):
+        """
+        Resolve a user's holdings to stock rows.
+        
+        Parameters:
+        user_id (str): The ID of the user
+        
+        Returns:
+        tuple: (stock ids, weights, total weight including tickers not in the stock universe)
+        """
+        row = self._portfolio_row(user_id)
+        if row is None:
+            raise ValueError(f"User {user_id} not found in unique portfolios data")
+        stock_ids, weights = self.portfolio_store.get(user_id)
+        total_weight = float(self.portfolio_store.total_weights[row])
+        
+        if len(stock_ids) == 0 and total_weight == 0:
+            raise ValueError(f"No portfolio data found for user {user_id}")
+        
+        return stock_ids, weights, total_weight
+    
+    def _sector_alert_message(self, sector, weight):
+        return f"Your portfolio is heavily concentrated in the {sector} sector ({weight*100:.1f}%). Consider diversifying to reduce risk."
+    
+    def _diversity_alert_message(self, sector_count):
+        return f"Your portfolio only contains {sector_count} sectors. Consider investing in at least {self.sector_count_min} different sectors to improve diversification."
+    
+    def _volatility_alert_message(self, high_beta_weight):
+        return f"Your portfolio has {high_beta_weight*100:.1f}% allocated to high-volatility stocks. This may lead to larger swings in portfolio value."
+    
+    def _portfolio_volatility_alert_message(self, volatility):
+        return f"Your portfolio's value typically moves about {volatility:.1f}% in a year based on recent prices. Adding steadier or less related stocks can smooth out the swings."
+    
+    def analyze_portfolio_risks(self, user_id, context=None):
+        """
+        Analyze portfolio risks and provide alerts for overconcentration or lack of diversity.
+        
+        When the model has a covariance model (trained with price history), the
+        result also holds risk_model_coverage, the share of the portfolio's
+        weight in stocks with price history. Only when it reaches
+        risk_coverage_threshold does it hold portfolio_volatility (annualized,
+        in percent) and risk_contributions, each holding's share of the
+        portfolio variance, since the rest is priced from volatility_1yr alone.
+        
+        Parameters:
+        user_id (str): The ID of the user
+        context (PortfolioContext): Shared portfolio view from portfolio_context(user_id)
+        
+        Returns:
+        dict: Risk analysis results with alerts
+        """
+        return self._cached('risk', user_id, (), lambda: self._analyze_portfolio_risks(user_id, context), context)
+    
+    def _analyze_portfolio_risks(self, user_id, context=None):
+        """Uncached analyze_portfolio_risks."""
+        try:
+            if context is None:
+                context = self.portfolio_context(user_id)
+            stock_ids, weights, total_weight = context.stock_ids, context.weights, context.total_weight
+            
+            # Calculate sector weights
+            num_sectors = len(self.sector_names)
+            sector_totals = context.sector_totals
+            held_sectors = context.held_sectors
+            
+            # Normalize sector weights
+            sector_weights = sector_totals / total_weight if total_weight > 0 else np.zeros(num_sectors)
+            
+            # Sort sectors by weight
+            held_sectors = held_sectors[np.argsort(-sector_weights[held_sectors], kind='stable')]
+            sorted_sectors = [(self.sector_names[code], float(sector_weights[code])) for code in held_sectors]
+            
+            # Initialize risk analysis
+            risk_analysis = {
+                'alerts': [],
+                'sector_concentration': sorted_sectors,
+                'sector_count': len(sorted_sectors),
+                'most_concentrated_sector': sorted_sectors[0] if sorted_sectors else None,
+            }
+            
+            # Check for sector overconcentration
+            for sector, weight in sorted_sectors:
+                if weight > self.sector_concentration_threshold:
+                    risk_analysis['alerts'].append({
+                        'type': 'sector_overconcentration',
+                        'sector': sector,
+                        'weight': weight,
+                        'message': self._sector_alert_message(sector, weight)
+                    })
+            
+            # Check for lack of sector diversity
+            if len(sorted_sectors) < self.sector_count_min:
+                risk_analysis['alerts'].append({
+                    'type': 'lack_of_diversity',
+                    'sector_count': len(sorted_sectors),
+                    'message': self._diversity_alert_message(len(sorted_sectors))
+                })
+            
+            # Check for high-beta concentration (beta > 1.5 is considered highly volatile)
+            high_beta_weight = float(weights[self.betas[stock_ids] > 1.5].sum())
+            if high_beta_weight > 0 and total_weight > 0 and high_beta_weight / total_weight > 0.3:  # If more than 30% in high-beta stocks
+                risk_analysis['alerts'].append({
+                    'type': 'high_volatility',
+                    'high_beta_weight': high_beta_weight / total_weight,
+                    'message': self._volatility_alert_message(high_beta_weight / total_weight)
+                })
+            
+            # Volatility from the covariance model, and how much of it each holding contributes
+            if self.risk_factors is not None and len(stock_ids) and total_weight > 0:
+                # Share of the weight priced from history rather than volatility_1yr alone
+                coverage = float(weights[estimated_stocks(self.risk_factors[stock_ids])].sum() / total_weight)
+                risk_analysis['risk_model_coverage'] = coverage
+                if coverage >= self.risk_coverage_threshold:
+                    volatility, shares = portfolio_risk(self.risk_factors, self.specific_variance, stock_ids,
+                                                        weights / total_weight)
+                    order = np.argsort(-shares, kind='stable')
+                    risk_analysis['portfolio_volatility'] = volatility
+                    risk_analysis['risk_contributions'] = [
+                        {'ticker': self.tickers[stock_ids[i]], 'weight': float(weights[i] / total_weight),
+                         'risk_share': float(shares[i])}
+                        for i in order
+                    ]
+                    if volatility > self.portfolio_volatility_threshold:
+                        risk_analysis['alerts'].append({
+                            'type': 'high_portfolio_volatility',
+                            'portfolio_volatility': volatility,
+                            'message': self._portfolio_volatility_alert_message(volatility)
+                        })
+            
+            return risk_analysis
+            
+        except Exception as e:
+            # stderr, so callers parsing stdout as JSON only see the result
+            print(f"Error in analyze_portfolio_risks: {str(e)}", file=sys.stderr)
+            traceback.print_exc()
+            # Return a simple structure instead of raising an error
+            return {
+                'alerts': [],
+                'sector_concentration': [],
+                'sector_count': 0,
+                'error': str(e)
+            }
+    
+    def _profile_from_holdings(self, stock_ids, weights):
+        """Weighted average of the held stocks' feature rows."""
+        total_weight = weights.sum()
+        if total_weight <= 0:
+            return np.zeros(self.stock_features.shape[1])
+        return weights @ self.stock_features[stock_ids] / total_weight
+    
+    def _select_diverse(self, ordered_ids, n):
+        """
+        Pick diversification candidates from ids sorted best first.
+        
+        Each sector's best candidate is taken until three sectors are represented;
+        after that every candidate qualifies.
+        """
+        positions = np.arange(len(ordered_ids))
+        _, first_positions = np.unique(self.sector_codes[ordered_ids], return_index=True)
+        
+        accepted = np.zeros(len(ordered_ids), dtype=bool)
+        accepted[first_positions] = True
+        if len(first_positions) >= 3:
+            third_sector_position = np.sort(first_positions)[2]
+            accepted |= positions > third_sector_position
+        
+        return ordered_ids[accepted][:n]
+    
+    def generate_diversification_recommendations(self, user_id, n=5, include_explanations=True, context=None):
+        """
+        Generate stock recommendations specifically for diversification.
+        
+        Parameters:
+        user_id (str): The ID of the user
+        n (int): Number of recommendations to generate
+        include_explanations (bool or str): Explanation mode, as for generate_recommendations
+        context (PortfolioContext): Shared portfolio view from portfolio_context(user_id)
+        
+        Returns:
+        list: Recommended stocks for diversification with explanations
+        """
+        include_explanations = explanation_mode(include_explanations)
+        return self._cached(
+            'diversify', user_id, (n, include_explanations),
+            lambda: self._generate_diversification_recommendations(user_id, n, include_explanations, context),
+            context
+        )
+    
+    def _generate_diversification_recommendations(self, user_id, n, include_explanations='text', context=None):
+        """Uncached generate_diversification_recommendations."""
+        try:
+            if context is None:
+                context = self.portfolio_context(user_id)
+            stock_ids = context.stock_ids
+            
+            # Only stocks outside the portfolio's sectors, and not already held, qualify
+            eligible = ~np.isin(self.sector_codes, context.held_sectors)
+            eligible[stock_ids] = False
+            eligible_ids = np.flatnonzero(eligible)
+            
+            # Rank eligible stocks by similarity (we still want stocks that match user preferences)
+            similarities = context.similarities(min_candidates=n, eligible_ids=eligible_ids)
+            scores = np.where(eligible, similarities, -np.inf)
+            
+            num_candidates = int(np.count_nonzero(scores > -np.inf))
+            if n <= 0 or num_candidates == 0:
+                return []
+            
+            # Sort only a prefix of the best candidates, widening it until n are accepted
+            prefix = min(num_candidates, max(4 * n, 32))
+            while True:
+                ordered_ids = self._top_n_indices(scores, prefix)
+                selected = self._select_diverse(ordered_ids, n)
+                if len(selected) >= n or prefix == num_candidates:
+                    break
+                prefix = min(num_candidates, prefix * 4)
+            
+            return [
+                self._build_recommendation(idx, similarities[idx], include_explanations, is_diversification=True)
+                for idx in selected
+            ]
+            
+        except Exception as e:
+            raise ValueError(f"Error generating diversification recommendations for user {user_id}: {str(e)}")
+    
+    def _generate_simple_explanation(self, stock_idx, similarity_score, sector, is_diversification=False):
+        """
+        Generate a simple, jargon-free explanation for why a stock is recommended.
+        
+        Parameters:
+        stock_idx (int): Row of the stock
+        similarity_score (float): The similarity score
+        sector (str): The stock's sector
+        is_diversification (bool): Whether this is a diversification recommendation
+        
+        Returns:
+        str: A simple explanation
+        """
+        if is_diversification:
+            reason = EXPLANATION_FRAGMENTS['new_sector'].format(sector=sector)
+        else:
+            reason = EXPLANATION_FRAGMENTS['similar'].format(score=float(similarity_score))
+        return reason + self.explanation_text[stock_idx]
+    
+    def _explanation_ids(self, stock_idx, is_diversification=False):
+        """Fragment ids of the explanation, for render_explanation()."""
+        reason = 'new_sector' if is_diversification else 'similar'
+        return [reason, 'price', *_STOCK_FRAGMENT_IDS[self.explanation_codes[stock_idx]]]
+    
+    def _normalize_rows(self, vectors):
+        """Scale rows to unit length, leaving all-zero rows as zeros (as cosine_similarity does)."""
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+    
+    def _build_normalized_features(self):
+        """Cache unit-length stock feature rows so cosine scores are a single matmul."""
+        self.normalized_features = self._normalize_rows(self.stock_features)
+    
+    def _profile_similarities(self, profiles):
+        """Cosine similarity of each profile row against every stock."""
+        return self._normalize_rows(np.atleast_2d(profiles)) @ self.normalized_features.T
+    
+    def _user_similarities(self, profile, min_candidates=0, eligible_ids=None):
+        """
+        Cosine similarity of a user profile against the stocks.
+        
+        With an ANN index only the retrieved candidates are scored and every other
+        stock gets -inf. If fewer than min_candidates usable candidates come back
+        (optionally counting only eligible_ids), all stocks are scored exactly.
+        """
+        if self.ann_index is None:
+            return self._profile_similarities(profile)[0]
+        
+        norm = np.linalg.norm(profile)
+        query = profile / norm if norm > 0 else profile
+        candidate_ids = self.ann_index.candidates(query)
+        
+        usable = candidate_ids
+        if eligible_ids is not None:
+            usable = np.intersect1d(candidate_ids, eligible_ids)
+        if len(usable) < min_candidates:
+            return self._profile_similarities(profile)[0]
+        
+        similarities = np.full(len(self.normalized_features), -np.inf)
+        similarities[candidate_ids] = self.normalized_features[candidate_ids] @ query
+        return similarities
+    
+    def _correlation_similarities(self, stock_ids, weights):
+        """
+        Weight-averaged return correlation of the given holdings with every stock.
+        
+        Only each holding's top-K correlated neighbors are stored, so any other
+        pair counts as uncorrelated; a holding correlates 1.0 with itself. Stocks
+        no holding reaches get -inf. Raises ValueError when no holding has
+        correlation neighbors (e.g. none has price history), rather than
+        returning no recommendations.
+        """
+        if self.correlation_ids is None:
+            raise ValueError("No correlation index; train the model with price history first")
+        stock_ids = np.asarray(stock_ids, dtype=np.int64)
+        weights = np.asarray(weights, dtype=np.float64)
+        total_weight = weights.sum()
+        num_stocks = len(self.correlation_ids)
+        
+        ids = np.asarray(self.correlation_ids[stock_ids], dtype=np.int64).reshape(len(stock_ids), -1)
+        scores = np.asarray(self.correlation_scores[stock_ids], dtype=np.float64).reshape(len(stock_ids), -1)
+        valid = ids >= 0
+        if total_weight <= 0 or not valid.any():
+            raise ValueError("No return-correlation neighbors for these holdings (too little price history); "
+                             "use similarity='fundamentals'")
+        ids = np.concatenate((ids[valid], stock_ids))
+        contributions = np.concatenate(((weights[:, None] * scores)[valid], weights))
+        
+        similarities = np.bincount(ids, weights=contributions, minlength=num_stocks) / total_weight
+        reached = np.bincount(ids, minlength=num_stocks) > 0
+        return np.where(reached, similarities, -np.inf)
+    
+    def _blend_similarities(self, fundamentals, correlations, correlation_weight):
+        """
+        Weighted mix of cosine and correlation scores.
+        
+        Stocks without a stored correlation count as uncorrelated (0). Stocks the
+        ANN index did not retrieve (-inf fundamentals) stay -inf whatever the
+        weight, instead of turning into 0 * -inf = NaN.
+        """
+        fundamentals = np.asarray(fundamentals, dtype=np.float64)
+        candidates = np.isfinite(fundamentals)
+        correlations = np.where(np.isfinite(correlations), correlations, 0.0)
+        similarities = np.full(len(fundamentals), -np.inf)
+        similarities[candidates] = ((1 - correlation_weight) * fundamentals[candidates]
+                                    + correlation_weight * correlations[candidates])
+        return similarities
+    
+    def _top_n_indices(self, similarities, n, exclude_ids=None):
+        """
+        Indices of the n highest similarities, best first, skipping excluded stocks.
+        
+        Uses argpartition so only the selected candidates get sorted.
+        """
+        scores = np.array(similarities, dtype=np.float64)
+        if exclude_ids is not None and len(exclude_ids):
+            scores[np.asarray(exclude_ids, dtype=np.int64)] = -np.inf
+        
+        n = min(n, int(np.count_nonzero(scores > -np.inf)))
+        if n <= 0:
+            return np.empty(0, dtype=np.int64)
+        
+        top = np.argpartition(-scores, n - 1)[:n]
+        return top[np.argsort(-scores[top], kind='stable')]
+    
+    def _build_recommendation(self, idx, similarity, include_explanations='text', is_diversification=False):
+        """
+        Assemble the result dict for the stock at row idx from the columnar arrays.
+        
+        include_explanations is an explanation mode: 'text' adds the explanation,
+        'ids' only its fragment ids (see render_explanation) and 'off' neither.
+        """
+        sector = self.sector_names[self.sector_codes[idx]]
+        rec_dict = {
+            'ticker': self.tickers[idx],
+            'company_name': self.company_names[idx],
+            'similarity_score': similarity,
+            'sector': sector,
+            'price': float(self.prices[idx]),
+            'market_cap': float(self.market_caps[idx]),
+            'esg_score': float(self.esg_scores[idx]),
+            'recommendation_type': 'diversification' if is_diversification else 'standard'
+        }
+        
+        # Add simple explanation if requested
+        if include_explanations == 'text':
+            rec_dict['explanation'] = self._generate_simple_explanation(
+                idx, similarity, sector, is_diversification=is_diversification
+            )
+        elif include_explanations == 'ids':
+            rec_dict['explanation_ids'] = self._explanation_ids(idx, is_diversification)
+        
+        return rec_dict
+    
+    def generate_recommendations(self, user_input, n=5, exclude_portfolio=True, include_explanations=True,
+                                 context=None, similarity='fundamentals', correlation_weight=0.5):
+        """
+        Generate stock recommendations based on user input.
+        
+        Parameters:
+        user_input (str or np.ndarray): User ID, ticker, or user profile vector
+        n (int): Number of recommendations to generate
+        exclude_portfolio (bool): Whether to exclude stocks already in the user's portfolio
+        include_explanations (bool or str): Explanation mode - True/'text', 'ids' for
+            fragment ids only (see render_explanation), or False/'off'
+        context (PortfolioContext): Shared portfolio view from portfolio_context(user_id)
+        similarity (str): 'fundamentals' (cosine of scaled features), 'correlation'
+            (daily return correlation) or 'blend'; the last two need a model trained
+            with price history and a user ID or ticker
+        correlation_weight (float): Weight of the correlation score in 'blend' (0 to 1)
+        
+        Returns:
+        list: Top N recommended stocks with similarity scores and explanations
+        """
+        include_explanations = explanation_mode(include_explanations)
+        if similarity not in SIMILARITY_MODES:
+            raise ValueError(f"similarity must be one of {', '.join(SIMILARITY_MODES)}")
+        if similarity != 'fundamentals':
+            if self.correlation_ids is None:
+                raise ValueError("No correlation index; train the model with price history first")
+            if not isinstance(user_input, str):
+                raise ValueError(f"'{similarity}' similarity needs a user ID or ticker, not a profile vector")
+        if similarity == 'blend' and not 0 <= correlation_weight <= 1:
+            raise ValueError("correlation_weight must be between 0 and 1")
+        
+        params = (n, exclude_portfolio, include_explanations)
+        if similarity != 'fundamentals':
+            params += (similarity, correlation_weight if similarity == 'blend' else None)
+        return self._cached(
+            'recommend', user_input, params,
+            lambda: self._generate_recommendations(user_input, n, exclude_portfolio, include_explanations, context,
+                                                   similarity, correlation_weight),
+            context
+        )
+    
+    def _generate_recommendations(self, user_input, n, exclude_portfolio, include_explanations, context=None,
+                                  similarity='fundamentals', correlation_weight=0.5):
+        """Uncached generate_recommendations."""
+        if not isinstance(user_input, str):
+            # A user profile vector
+            return self._recommend_from_profile(np.asarray(user_input, dtype=np.float64), n, [],
+                                                include_explanations)
+        
+        # Check if input is a ticker
+        if user_input in self.ticker_index:
+            stock_idx = self.ticker_index[user_input]
+            if similarity == 'fundamentals':
+                # Similar stocks come straight from the neighbor index
+                ids, scores = self._similar_stock_indices(stock_idx, n, exclude_self=exclude_portfolio)
+                return [
+                    self._build_recommendation(idx, float(score), include_explanations)
+                    for idx, score in zip(ids, scores)
+                ]
+            
+            similarities = self._correlation_similarities([stock_idx], np.ones(1))
+            if similarity == 'blend':
+                fundamentals = self.normalized_features @ self.normalized_features[stock_idx]
+                similarities = self._blend_similarities(fundamentals, similarities, correlation_weight)
+            exclude_ids = [stock_idx] if exclude_portfolio else []
+            return self._top_recommendations(similarities, n, exclude_ids, include_explanations)
+        
+        # Input is a user ID
+        if context is None:
+            try:
+                context = self.portfolio_context(user_input)
+            except ValueError as e:
+                raise ValueError(f"Error processing user {user_input}: {str(e)}")
+        
+        exclude_ids = context.stock_ids if exclude_portfolio else []
+        if similarity == 'correlation':
+            similarities = context.correlations()
+        else:
+            similarities = context.similarities(min_candidates=n + len(exclude_ids))
+            if similarity == 'blend':
+                similarities = self._blend_similarities(similarities, context.correlations(), correlation_weight)
+        return self._top_recommendations(similarities, n, exclude_ids, include_explanations)
+    
+    def _recommend_from_profile(self, profile, n, exclude_ids, include_explanations='text'):
+        """Top-N recommendations for a profile vector, skipping the excluded stock rows."""
+        similarities = self._user_similarities(profile, min_candidates=n + len(exclude_ids))
+        return self._top_recommendations(similarities, n, exclude_ids, include_explanations)
+    
+    def _top_recommendations(self, similarities, n, exclude_ids, include_explanations='text'):
+        """Result dicts for the n most similar stocks outside exclude_ids."""
+        # Get top N recommendations, skipping the user's own holdings
+        top_n_indices = self._top_n_indices(similarities, n, exclude_ids)
+        
+        return [
+            self._build_recommendation(idx, similarities[idx], include_explanations)
+            for idx in top_n_indices
+        ]
+
+def main():
+    parser = argparse.ArgumentParser(description='Answer recommender queries from a model artifact as JSON')
+    parser.add_argument('--model', type=str, default='improved_stock_recommender', help='Model artifact directory')
+    subparsers = parser.add_subparsers(dest='command', help='Query to run')
+
+    recommend_parser = subparsers.add_parser('recommend', help='Recommendations for a user or ticker')
+    recommend_parser.add_argument('user_input', type=str, help='User ID or ticker')
+    recommend_parser.add_argument('--n', type=int, default=3, help='Number of recommendations')
+    recommend_parser.add_argument('--explanations', choices=EXPLANATION_MODES, default='text',
+                                  help='Explanation text, fragment ids only, or none')
+    recommend_parser.add_argument('--no-explanations', action='store_true', help='Leave out explanations')
+    recommend_parser.add_argument('--similarity', choices=SIMILARITY_MODES, default='fundamentals',
+                                  help='Rank by fundamentals, return correlation, or a blend of both')
+    recommend_parser.add_argument('--correlation-weight', type=float, default=0.5,
+                                  help="Weight of the correlation score with --similarity blend")
+
+    risk_parser = subparsers.add_parser('risk', help='Portfolio risk alerts for a user')
+    risk_parser.add_argument('user_id', type=str, help='User ID')
+
+    diversify_parser = subparsers.add_parser('diversify', help='Diversification recommendations for a user')
+    diversify_parser.add_argument('user_id', type=str, help='User ID')
+    diversify_parser.add_argument('--n', type=int, default=3, help='Number of recommendations')
+    diversify_parser.add_argument('--explanations', choices=EXPLANATION_MODES, default='text',
+                                  help='Explanation text, fragment ids only, or none')
+
+    similar_parser = subparsers.add_parser('similar', help='Stocks similar to a ticker')
+    similar_parser.add_argument('ticker', type=str, help='Stock ticker')
+    similar_parser.add_argument('--count', type=int, default=5, help='Number of similar stocks')
+
+    args = parser.parse_args()
+    if not args.command:
+        parser.print_help()
+        return
+
+    runtime = RecommenderRuntime()
+    try:
+        runtime.load_model(args.model)
+        if args.command == 'recommend':
+            result = runtime.generate_recommendations(args.user_input, n=args.n,
+                                                      include_explanations='off' if args.no_explanations else args.explanations,
+                                                      similarity=args.similarity,
+                                                      correlation_weight=args.correlation_weight)
+        elif args.command == 'risk':
+            result = runtime.analyze_portfolio_risks(args.user_id)
+        elif args.command == 'diversify':
+            result = runtime.generate_diversification_recommendations(args.user_id, n=args.n,
+                                                                      include_explanations=args.explanations)
+        else:
+            ticker = args.ticker.upper()
+            if ticker not in runtime.ticker_index:
+                raise ValueError(f"Ticker {ticker} not found in database")
+            result = runtime.generate_recommendations(ticker, n=args.count)
+        print(json.dumps(to_json_safe(result)))
+    except Exception as e:
+        print(json.dumps({'error': str(e)}))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import numpy as np
+
+TRADING_DAYS = 252
+
+def estimate_risk_model(returns, fallback_variance, rank=32, min_days=None, block_size=16384):
+    """
+    Low-rank plus diagonal estimate of the daily return covariance matrix.
+
+    The sample covariance S is shrunk toward its own diagonal,
+    (1 - shrinkage) * S + shrinkage * diag(S), with the Ledoit-Wolf intensity
+    for that target. Every quantity comes from the (days x days) Gram matrix
+    of the returns, so no (stocks x stocks) matrix is ever formed. The result
+    is factors @ factors.T + diag(specific_variance): the top `rank`
+    eigenvectors carry the shared part of S, and each stock's variance stays
+    exact through its specific variance.
+
+    Parameters:
+    returns (np.ndarray): (days x stocks) daily log returns, NaN where missing
+    fallback_variance (np.ndarray): Daily variance for stocks with too little history (no factor loadings)
+    rank (int): Number of factors kept
+    min_days (int): Returns a stock needs to be estimated (defaults to half the days)
+    block_size (int): Stocks processed at a time
+
+    Returns:
+    tuple: (factors float32 (stocks x rank), specific_variance float64 (stocks,), shrinkage float)
+    """
+    num_days, num_stocks = returns.shape
+    if min_days is None:
+        min_days = max(num_days // 2, 2)
+    blocks = [slice(start, start + block_size) for start in range(0, num_stocks, block_size)]
+
+    # Demeaned returns with missing days at zero; stocks without enough history are left out
+    counts = np.zeros(num_stocks, dtype=np.int64)
+    means = np.zeros(num_stocks)
+    for block in blocks:
+        valid = ~np.isnan(returns[:, block])
+        counts[block] = valid.sum(axis=0)
+        means[block] = np.where(valid, returns[:, block], 0.0).sum(axis=0) / np.maximum(counts[block], 1)
+    estimated = counts >= min_days
+
+    def centered(block):
+        values = np.asarray(returns[:, block], dtype=np.float64) - means[block]
+        values[np.isnan(values) | ~estimated[block]] = 0.0
+        return values
+
+    gram = np.zeros((num_days, num_days))
+    sample_variance = np.zeros(num_stocks)
+    diagonal_spread = 0.0
+    for block in blocks:
+        values = centered(block)
+        gram += values @ values.T
+        squares = values ** 2
+        sample_variance[block] = squares.sum(axis=0) / num_days
+        diagonal_spread += float(((squares - sample_variance[block]) ** 2).sum())
+
+    # Ledoit-Wolf intensity for the diagonal target, from Frobenius norms of the Gram matrix
+    frobenius = float((gram ** 2).sum()) / num_days ** 2
+    off_diagonal = frobenius - float((sample_variance ** 2).sum())
+    spread = float((np.diag(gram) ** 2).sum()) - num_days * frobenius - diagonal_spread
+    shrinkage = float(np.clip(spread / num_days ** 2 / off_diagonal, 0.0, 1.0)) if off_diagonal > 0 else 1.0
+
+    # S = (X^T U)(X^T U)^T / days for the eigenvectors U of the Gram matrix
+    rank = max(min(rank, num_days - 1, int(estimated.sum())), 0)
+    _, eigenvectors = np.linalg.eigh(gram)
+    top = eigenvectors[:, ::-1][:, :rank]
+    scale = np.sqrt((1 - shrinkage) / num_days)
+
+    factors = np.zeros((num_stocks, rank), dtype=np.float32)
+    for block in blocks:
+        factors[block] = (centered(block).T @ top) * scale
+    loadings = (factors.astype(np.float64) ** 2).sum(axis=1)
+    specific_variance = np.where(estimated, np.maximum(sample_variance - loadings, 0.0),
+                                 np.asarray(fallback_variance, dtype=np.float64))
+    factors[~estimated] = 0.0
+    return factors, np.nan_to_num(specific_variance), shrinkage
+
+def estimated_stocks(factors):
+    """Stocks the covariance model estimated from price history; the others have no factor loadings."""
+    return np.asarray(factors != 0).any(axis=1)
+
+def volatility_variance(volatility):
+    """Daily variance from annual volatility in percent (e.g. the volatility_1yr column)."""
+    return (np.asarray(volatility, dtype=np.float64) / 100) ** 2 / TRADING_DAYS
+
+def portfolio_risk(factors, specific_variance, stock_ids, weights):
+    """
+    Volatility of one portfolio and each holding's share of it.
+
+    Parameters:
+    factors (np.ndarray): (stocks x rank) factor loadings
+    specific_variance (np.ndarray): Daily specific variance per stock
+    stock_ids (np.ndarray): Stock rows held
+    weights (np.ndarray): Portfolio fractions of those rows
+
+    Returns:
+    tuple: (annualized volatility in percent, np.ndarray of each holding's share of the variance)
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    loadings = np.asarray(factors[stock_ids], dtype=np.float64)
+    exposures = weights @ loadings
+    # (Sigma w) restricted to the held stocks
+    marginal = loadings @ exposures + specific_variance[stock_ids] * weights
+    variance = float(weights @ marginal)
+    if variance <= 0:
+        return 0.0, np.zeros(len(weights))
+    return float(np.sqrt(variance * TRADING_DAYS) * 100), weights * marginal / variance
+
+def portfolio_risk_batch(weight_matrix, factors, specific_variance, block_size=100000):
+    """
+    w^T Sigma w, and the holding contributing most to it, for every row of a sparse weight matrix.
+
+    Each block of rows costs one sparse product with the factors and one with
+    the specific variances, so the covariance matrix is never formed.
+
+    Parameters:
+    weight_matrix (sparse.csr_matrix): Portfolio fractions, one row per portfolio
+    factors (np.ndarray): (stocks x rank) factor loadings
+    specific_variance (np.ndarray): Daily specific variance per stock
+    block_size (int): Portfolios per block
+
+    Returns:
+    tuple: (annualized volatility in percent, stock row of the largest risk contributor
+        (-1 for empty portfolios), that holding's share of the variance) - one value per portfolio
+    """
+    factors32 = np.asarray(factors, dtype=np.float32)
+    factors = np.asarray(factors, dtype=np.float64)
+    specific_variance = np.asarray(specific_variance, dtype=np.float64)
+    num_portfolios = weight_matrix.shape[0]
+    volatility = np.zeros(num_portfolios)
+    top_stock = np.full(num_portfolios, -1, dtype=np.int64)
+    top_share = np.zeros(num_portfolios)
+
+    for start in range(0, num_portfolios, block_size):
+        block = weight_matrix[start:start + block_size].tocsr()
+        exposures = np.asarray(block @ factors)
+        variance = (exposures ** 2).sum(axis=1) + np.asarray(block.multiply(block) @ specific_variance).ravel()
+        volatility[start:start + len(variance)] = np.sqrt(np.maximum(variance, 0.0) * TRADING_DAYS) * 100
+
+        # Each holding's w_i (Sigma w)_i / w^T Sigma w (float32 is plenty for picking the largest)
+        lengths = np.diff(block.indptr)
+        if not lengths.any():
+            continue
+        rows = np.repeat(np.arange(len(lengths)), lengths)
+        weights = block.data.astype(np.float64)
+        marginal = np.einsum('ij,ij->i', factors32[block.indices], exposures.astype(np.float32)[rows])
+        marginal = marginal + specific_variance[block.indices] * weights
+        with np.errstate(divide='ignore', invalid='ignore'):
+            shares = np.where(variance[rows] > 0, weights * marginal / variance[rows], 0.0)
+
+        # First holding of each row that reaches the row's maximum
+        held = np.flatnonzero(lengths > 0)
+        row_max = np.maximum.reduceat(shares, block.indptr[:-1][held])
+        candidates = np.flatnonzero(shares == np.repeat(row_max, lengths[held]))
+        firsts = candidates[np.concatenate(([True], rows[candidates][1:] != rows[candidates][:-1]))]
+        top_stock[start + held] = block.indices[firsts]
+        top_share[start + held] = shares[firsts]
+    return volatility, top_stock, top_share
@@ -0,0 +1,341 @@
+import argparse
+import os
+import time
+import numpy as np
+import pandas as pd
+from model_artifact import is_artifact, read_artifact, write_artifact
+from price_features import (MIN_WINDOW_FRACTION, PRICE_FEATURE_WINDOWS, RISK_FREE_RATE, TRADING_DAYS,
+                            compute_price_features, min_observations, price_feature_columns)
+
+def rolling_stats_path(model_path):
+    """Directory the rolling statistics of a model artifact are kept in, next to it."""
+    return os.path.normpath(model_path) + '_rolling_stats'
+
+class RollingStats:
+    """
+    Per-ticker return and risk statistics updated one trading day at a time.
+
+    Daily log returns go into a ring buffer as long as the longest window.
+    Each window keeps running count, mean and sum of squared deviations
+    (Welford's update, adding the new return and removing the one that left
+    the window), so a day costs O(tickers) per window however long the
+    windows are. A ticker without a close carries its last price forward, a
+    0 return. Max drawdown is read off the 1yr window of the ring when the
+    features are requested.
+
+    features() gives the same values as price_features.compute_price_features
+    over the same days (see check_parity).
+    """
+    def __init__(self, tickers, windows=PRICE_FEATURE_WINDOWS, risk_free_rate=RISK_FREE_RATE,
+                 min_fraction=MIN_WINDOW_FRACTION):
+        self.tickers = list(tickers)
+        self.ticker_index = {ticker: column for column, ticker in enumerate(self.tickers)}
+        self.windows = dict(windows)
+        self.risk_free_rate = risk_free_rate
+        self.min_fraction = min_fraction
+        num_tickers = len(self.tickers)
+
+        # Returns of the last max(windows) days; row `head` is the next one written
+        self.ring = np.full((max(self.windows.values()), num_tickers), np.nan, dtype=np.float32)
+        self.head = 0
+        self.counts = np.zeros((len(self.windows), num_tickers), dtype=np.int64)
+        self.means = np.zeros((len(self.windows), num_tickers))
+        self.m2 = np.zeros((len(self.windows), num_tickers))
+
+        self.last_prices = np.full(num_tickers, np.nan)
+        self.last_date = None
+        # Days since the moments were last recomputed from the ring
+        self.updates_since_sync = 0
+
+    @classmethod
+    def from_history(cls, history, windows=PRICE_FEATURE_WINDOWS, risk_free_rate=RISK_FREE_RATE):
+        """
+        Seed statistics by replaying the most recent days of a PriceHistory.
+
+        Parameters:
+        history (PriceHistory): Memory-mapped price history
+        windows (dict): Column suffix -> window length in trading days
+        risk_free_rate (float): Annual risk-free rate in percent
+
+        Returns:
+        RollingStats: Statistics as of the history's last day
+        """
+        stats = cls(history.tickers, windows, risk_free_rate)
+        dates, prices = history.last(max(stats.windows.values()) + 1)
+        for date, row in zip(dates, prices):
+            stats.update(date, row)
+        return stats
+
+    def update(self, date, prices):
+        """
+        Add one trading day's closing prices.
+
+        Parameters:
+        date (str or np.datetime64): The trading day, after last_date
+        prices (np.ndarray or dict): Price per ticker in column order (NaN when
+            missing), or a dict of ticker -> price; tickers without a price
+            carry their last price forward
+
+        Returns:
+        int: Number of tickers that had a price
+        """
+        date = np.datetime64(date, 'D')
+        if self.last_date is not None and date <= self.last_date:
+            raise ValueError(f"Date {date} is not after the last update ({self.last_date})")
+        if isinstance(prices, dict):
+            row = np.full(len(self.tickers), np.nan)
+            columns = [self.ticker_index.get(ticker, -1) for ticker in prices]
+            known = np.array(columns, dtype=np.int64) >= 0
+            row[np.array(columns, dtype=np.int64)[known]] = np.array(list(prices.values()), dtype=np.float64)[known]
+            prices = row
+        prices = np.asarray(prices, dtype=np.float64)
+        if prices.shape != (len(self.tickers),):
+            raise ValueError(f"Expected {len(self.tickers)} prices, got {prices.shape}")
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            returns = np.log(prices / self.last_prices).astype(np.float32)
+        # A missing close carries the last price forward (as forward_fill does in the batch path)
+        returns[np.isnan(prices) & ~np.isnan(self.last_prices)] = 0.0
+
+        # Remove the returns leaving each window, then add today's
+        size = len(self.ring)
+        for slot, days in enumerate(self.windows.values()):
+            self._remove(slot, self.ring[(self.head - days) % size])
+            self._add(slot, returns)
+        self.ring[self.head] = returns
+        self.head = (self.head + 1) % size
+
+        priced = ~np.isnan(prices)
+        self.last_prices[priced] = prices[priced]
+
+        self.last_date = date
+        self.updates_since_sync += 1
+        if self.updates_since_sync >= size:
+            self.resync()
+        return int(priced.sum())
+
+    def _add(self, slot, values):
+        """Welford's update for the tickers that have a value."""
+        valid = ~np.isnan(values)
+        values = values.astype(np.float64)
+        count = self.counts[slot] + valid
+        delta = np.where(valid, values - self.means[slot], 0.0)
+        self.means[slot] += np.divide(delta, count, out=np.zeros_like(delta), where=count > 0)
+        self.m2[slot] += np.where(valid, delta * (values - self.means[slot]), 0.0)
+        self.counts[slot] = count
+
+    def _remove(self, slot, values):
+        """Welford's update run backwards, for values leaving the window."""
+        valid = ~np.isnan(values)
+        values = values.astype(np.float64)
+        count = self.counts[slot] - valid
+        delta = np.where(valid, values - self.means[slot], 0.0)
+        self.means[slot] -= np.divide(delta, count, out=np.zeros_like(delta), where=count > 0)
+        self.m2[slot] -= np.where(valid, delta * (values - self.means[slot]), 0.0)
+        empty = count == 0
+        self.means[slot][empty] = 0.0
+        self.m2[slot][empty] = 0.0
+        self.counts[slot] = count
+
+    def resync(self):
+        """Recompute every window's moments from the ring, clearing accumulated rounding error."""
+        size = len(self.ring)
+        for slot, days in enumerate(self.windows.values()):
+            window = self.ring[(self.head - days + np.arange(days)) % size].astype(np.float64)
+            valid = ~np.isnan(window)
+            count = valid.sum(axis=0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mean = np.where(count > 0, np.where(valid, window, 0.0).sum(axis=0) / count, 0.0)
+            self.counts[slot] = count
+            self.means[slot] = mean
+            self.m2[slot] = np.where(valid, (window - mean) ** 2, 0.0).sum(axis=0)
+        self.updates_since_sync = 0
+
+    def features(self):
+        """
+        Current statistics for every ticker.
+
+        Like compute_price_features, a window's values are NaN for tickers with
+        fewer than min_fraction of its returns.
+
+        Returns:
+        dict: Column name -> float64 array aligned with tickers (see price_feature_columns)
+        """
+        features = {}
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for slot, (name, days) in enumerate(self.windows.items()):
+                count = self.counts[slot]
+                enough = count >= min_observations(days, self.min_fraction)
+                features[f'avg_return_{name}'] = np.where(enough, np.expm1(self.means[slot] * count) * 100, np.nan)
+                variance = np.maximum(self.m2[slot], 0.0) / (count - 1)
+                features[f'volatility_{name}'] = np.where(enough, np.sqrt(variance * TRADING_DAYS) * 100, np.nan)
+
+            volatility = features['volatility_1yr']
+            features['sharpe_ratio'] = np.where(volatility > 0,
+                                                (features['avg_return_1yr'] - self.risk_free_rate) / volatility, np.nan)
+        features['max_drawdown'] = np.where(np.isnan(features['avg_return_1yr']), np.nan, self._max_drawdowns())
+        return {column: features[column] for column in price_feature_columns(self.windows)}
+
+    def _max_drawdowns(self, block_size=16384):
+        """Deepest fall from a running peak over the 1yr window, in percent, rebuilt from the ring's returns."""
+        days = self.windows['1yr']
+        rows = (self.head - days + np.arange(days)) % len(self.ring)
+        drawdowns = np.zeros(len(self.tickers))
+        for start in range(0, len(self.tickers), block_size):
+            returns = np.nan_to_num(self.ring[rows, start:start + block_size].astype(np.float64))
+            # Log prices relative to the window's first day; days before a ticker's first price stay flat
+            log_prices = np.vstack((np.zeros((1, returns.shape[1])), np.cumsum(returns, axis=0)))
+            falls = log_prices - np.maximum.accumulate(log_prices, axis=0)
+            drawdowns[start:start + block_size] = np.expm1(falls.min(axis=0)) * 100
+        return drawdowns
+
+    def frame(self):
+        """features() as a DataFrame indexed by ticker, e.g. for update_stocks upserts."""
+        return pd.DataFrame(self.features(), index=pd.Index(self.tickers, name='ticker'))
+
+    def save(self, path):
+        """Write the state as an artifact directory (see model_artifact.py)."""
+        arrays = {
+            'tickers': np.array(self.tickers, dtype=str),
+            'ring': self.ring,
+            'counts': self.counts,
+            'means': self.means,
+            'm2': self.m2,
+            'last_prices': self.last_prices
+        }
+        write_artifact(path, arrays, {
+            'kind': 'rolling_stats',
+            'windows': self.windows,
+            'risk_free_rate': self.risk_free_rate,
+            'min_fraction': self.min_fraction,
+            'head': self.head,
+            'updates_since_sync': self.updates_since_sync,
+            'last_date': None if self.last_date is None else str(self.last_date)
+        })
+
+    @classmethod
+    def load(cls, path):
+        """Read state written by save."""
+        manifest, arrays = read_artifact(path, mmap_mode=None)
+        if manifest.get('kind') != 'rolling_stats':
+            raise ValueError(f"{path} is not a rolling statistics directory")
+
+        stats = cls(arrays['tickers'].tolist(), manifest['windows'], manifest['risk_free_rate'],
+                    manifest.get('min_fraction', MIN_WINDOW_FRACTION))
+        for name in ('ring', 'counts', 'means', 'm2', 'last_prices'):
+            setattr(stats, name, arrays[name])
+        stats.head = manifest['head']
+        stats.updates_since_sync = manifest['updates_since_sync']
+        stats.last_date = None if manifest['last_date'] is None else np.datetime64(manifest['last_date'], 'D')
+        return stats
+
+def check_parity(history, days=20, gap_fraction=0.05, seed=0, windows=PRICE_FEATURE_WINDOWS,
+                 risk_free_rate=RISK_FREE_RATE):
+    """
+    Compare streamed statistics with compute_price_features on the same prices.
+
+    The last max(windows) + 1 + days days of the history are replayed through
+    RollingStats.update from an empty state, so the last `days` updates also
+    remove returns from full windows. A share of the closes is dropped at
+    random first, to exercise missing days, and the batch path sees the same
+    gaps.
+
+    Parameters:
+    history (PriceHistory): Memory-mapped price history
+    days (int): Updates made after the longest window is full
+    gap_fraction (float): Share of closes dropped
+    seed (int): Seed for choosing the dropped closes
+    windows (dict): Column suffix -> window length in trading days
+    risk_free_rate (float): Annual risk-free rate in percent
+
+    Returns:
+    dict: Column name -> largest absolute difference (inf where one side is NaN and the other is not)
+    """
+    dates, prices = history.last(max(windows.values()) + 1 + days)
+    prices = np.array(prices, dtype=np.float64)
+    prices[np.random.default_rng(seed).random(prices.shape) < gap_fraction] = np.nan
+
+    stats = RollingStats(history.tickers, windows, risk_free_rate)
+    for date, row in zip(dates, prices):
+        stats.update(date, row)
+    streamed = stats.features()
+    batch = compute_price_features(prices, risk_free_rate, windows)
+
+    differences = {}
+    for column, values in batch.items():
+        mismatched = np.isnan(values) != np.isnan(streamed[column])
+        both = ~np.isnan(values) & ~np.isnan(streamed[column])
+        difference = float(np.abs(values[both] - streamed[column][both]).max()) if both.any() else 0.0
+        differences[column] = np.inf if mismatched.any() else difference
+    return differences
+
+def main():
+    parser = argparse.ArgumentParser(description='Incremental return and risk statistics for daily closing prices')
+    parser.add_argument('--model', type=str, default='improved_stock_recommender', help='Model artifact directory')
+    subparsers = parser.add_subparsers(dest='command', help='Command to run')
+
+    seed_parser = subparsers.add_parser('seed', help='Build the statistics from price history')
+    seed_parser.add_argument('price_history', type=str, help='Price history directory or historical_prices.csv')
+
+    check_parser = subparsers.add_parser('check', help='Compare streamed statistics with the batch computation')
+    check_parser.add_argument('price_history', type=str, help='Price history directory or historical_prices.csv')
+    check_parser.add_argument('--days', type=int, default=20, help='Updates after the longest window is full')
+    check_parser.add_argument('--gaps', type=float, default=0.05, help='Share of closes dropped at random')
+    check_parser.add_argument('--tolerance', type=float, default=1e-3,
+                              help='Largest allowed difference (exits with status 1 above it)')
+
+    close_parser = subparsers.add_parser('close', help="Add a day's closing prices from a date,ticker,price CSV")
+    close_parser.add_argument('csv_path', type=str, help='Closing prices (one date)')
+    close_parser.add_argument('--price-history', type=str, default=None, help='Also append the day to this price history')
+    close_parser.add_argument('--apply', action='store_true', help="Write the new statistics into the model's stocks")
+
+    args = parser.parse_args()
+    state_path = rolling_stats_path(args.model)
+    start = time.perf_counter()
+
+    if args.command == 'seed':
+        from price_history import open_price_history
+        stats = RollingStats.from_history(open_price_history(args.price_history))
+        stats.save(state_path)
+        print(f"Seeded {len(stats.tickers)} tickers through {stats.last_date} in {time.perf_counter() - start:.2f}s")
+    elif args.command == 'check':
+        from price_history import open_price_history
+        differences = check_parity(open_price_history(args.price_history), args.days, args.gaps)
+        for column, difference in differences.items():
+            print(f"{column:>16}: {difference:.2e}")
+        if max(differences.values()) > args.tolerance:
+            print(f"Streamed statistics differ from the batch computation by more than {args.tolerance}")
+            raise SystemExit(1)
+        print(f"Streamed statistics match the batch computation within {args.tolerance}")
+    elif args.command == 'close':
+        if not is_artifact(state_path):
+            print(f"No rolling statistics at {state_path}; run the seed command first")
+            return
+        stats = RollingStats.load(state_path)
+        closes = pd.read_csv(args.csv_path, usecols=['date', 'ticker', 'price'])
+        if closes['date'].nunique() != 1:
+            raise ValueError("The closing prices CSV must hold exactly one date")
+        date = closes['date'].iloc[0]
+        prices = dict(zip(closes['ticker'], closes['price']))
+
+        update_start = time.perf_counter()
+        priced = stats.update(date, prices)
+        print(f"Updated {priced}/{len(stats.tickers)} tickers for {date} in {(time.perf_counter() - update_start) * 1000:.1f} ms")
+        stats.save(state_path)
+
+        if args.price_history:
+            from price_history import PriceHistory
+            history = PriceHistory(args.price_history)
+            history.append([date], {ticker: price for ticker, price in prices.items() if ticker in history.ticker_index})
+        if args.apply:
+            from improved_recommender import ImprovedStockRecommender
+            recommender = ImprovedStockRecommender()
+            recommender.load_model(args.model)
+            result = recommender.apply_rolling_stats(stats)
+            recommender.save_model(args.model)
+            print(f"Refreshed risk features of {result['upserted']} stocks in {args.model}")
+    else:
+        parser.print_help()
+
+if __name__ == "__main__":
+    main()
@@ -3,8 +3,15 @@ import argparse
 import os
 import sys
 import textwrap
+import time
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
 from improved_recommender import ImprovedStockRecommender
+from precompute_store import PrecomputedStore, precompute_results
+from recommender_runtime import EXPLANATION_MODES, SIMILARITY_MODES, to_json_safe
 import pandas as pd
+import numpy as np
 import json
 
 def format_explanation(explanation, width=70):
@@ -13,7 +20,8 @@ def format_explanation(explanation, width=70):
 
 class StockAdvisor:
     def __init__(self):
-        self.model_path = "improved_stock_recommender.pkl"
+        self.model_path = "improved_stock_recommender"
+        self.legacy_model_path = "improved_stock_recommender.pkl"
         self.recommender = None
     
     def load_model(self):
@@ -22,14 +30,26 @@ class StockAdvisor:
             print(f"Loading recommender model from {self.model_path}...")
             self.recommender = ImprovedStockRecommender()
             self.recommender.load_model(self.model_path)
+        elif os.path.exists(self.legacy_model_path):
+            print(f"Converting legacy model {self.legacy_model_path} to {self.model_path}...")
+            self.recommender = ImprovedStockRecommender()
+            self.recommender.load_model(self.legacy_model_path)
+            self.recommender.save_model(self.model_path)
+            self.recommender.load_model(self.model_path)
         else:
             print(f"Model not found at {self.model_path}. Training a new model...")
             self.train_model()
         
         return self.recommender
     
-    def train_model(self):
-        """Train the recommender model with the available data."""
+    def train_model(self, price_history_path=None):
+        """
+        Train the recommender model with the available data.
+        
+        Parameters:
+        price_history_path (str): Price history directory or historical_prices.csv to derive return
+            features from; without it the stocks_data.csv values are used as they are
+        """
         data_dir = "stock_recommender_data"
         stocks_data_path = os.path.join(data_dir, "stocks_data.csv")
         unique_portfolios_path = os.path.join(data_dir, "users_unique_portfolio.csv")
@@ -41,6 +61,10 @@ class StockAdvisor:
         if not os.path.exists(unique_portfolios_path):
             print(f"Error: User portfolio data not found at {unique_portfolios_path}")
             sys.exit(1)
+            
+        if price_history_path and not os.path.exists(price_history_path):
+            print(f"Error: Price history not found at {price_history_path}")
+            sys.exit(1)
         
         print("Initializing recommender system...")
         self.recommender = ImprovedStockRecommender()
@@ -50,11 +74,15 @@ class StockAdvisor:
         
         self.recommender.load_data(
             stocks_data_path=stocks_data_path,
-            unique_portfolios_path=unique_portfolios_path
+            unique_portfolios_path=unique_portfolios_path,
+            price_history_path=price_history_path
         )
         
         print("Preparing features...")
-        self.recommender.prepare_features()
+        coverage = self.recommender.prepare_features()
+        if coverage is not None and self.recommender.risk_factors is None:
+            print(f"Price history covers {coverage['volatility_1yr']*100:.0f}% of stocks; "
+                  "too few to build the risk model and correlation index")
         
         print(f"Saving trained model to {self.model_path}")
         self.recommender.save_model(self.model_path)
@@ -67,16 +95,17 @@ class StockAdvisor:
             self.load_model()
         
         try:
-            # Get the portfolio
-            user_portfolio = self.recommender.expand_user_portfolio(user_id)
+            # Resolve the portfolio once; every section below reuses its holdings and profile
+            context = self.recommender.portfolio_context(user_id)
             
             print(f"\n===== QUICK PORTFOLIO ANALYSIS FOR {user_id} =====\n")
             
             # Risk analysis - only show alerts if present
             print("RISK ASSESSMENT:")
             print("---------------")
+            risk_analysis = None
             try:
-                risk_analysis = self.recommender.analyze_portfolio_risks(user_id)
+                risk_analysis = self.recommender.analyze_portfolio_risks(user_id, context=context)
                 
                 if risk_analysis['alerts']:
                     print("⚠️ ALERTS:")
@@ -92,7 +121,8 @@ class StockAdvisor:
             print("RECOMMENDED STOCKS:")
             print("------------------")
             try:
-                recommendations = self.recommender.generate_recommendations(user_id, n=5, include_explanations=True)
+                recommendations = self.recommender.generate_recommendations(user_id, n=5, include_explanations=True,
+                                                                        context=context)
                 
                 for i, stock in enumerate(recommendations):
                     # Make sure all fields are properly converted
@@ -119,7 +149,6 @@ class StockAdvisor:
             
             # If there are sector concentration issues, show diversification recommendations
             try:
-                risk_analysis = self.recommender.analyze_portfolio_risks(user_id)
                 has_concentration = False
                 
                 if risk_analysis and 'alerts' in risk_analysis:
@@ -141,7 +170,8 @@ class StockAdvisor:
                     print("Consider adding these stocks from sectors not in your portfolio:\n")
                     
                     try:
-                        diversification_recs = self.recommender.generate_diversification_recommendations(user_id, n=3)
+                        diversification_recs = self.recommender.generate_diversification_recommendations(user_id, n=3,
+                                                                                                       context=context)
                         
                         if not diversification_recs:
                             print("Could not find suitable diversification recommendations.")
@@ -363,6 +393,322 @@ class StockAdvisor:
             print(f"Error exploring sector: {str(e)}")
             return False
 
+    def get_stock_details(self, ticker, count=3):
+        """Return the stock's key figures and its most similar stocks as a dict."""
+        if not self.recommender:
+            self.load_model()
+
+        if ticker not in self.recommender.stocks_data.index:
+            raise LookupError(f"Ticker '{ticker}' not found in the dataset")
+
+        stock_info = self.recommender.stocks_data.loc[ticker]
+        # Duplicate tickers return a frame, keep the first listing
+        if isinstance(stock_info, pd.DataFrame):
+            stock_info = stock_info.iloc[0]
+
+        details = {'ticker': ticker}
+        details.update(stock_info.to_dict())
+        details['similar_stocks'] = self.recommender.generate_recommendations(
+            ticker, n=count, include_explanations=False
+        )
+        return details
+
+    def get_sector_stocks(self, sector_name, count=5):
+        """Return the largest stocks of a sector by market cap as a dict."""
+        if not self.recommender:
+            self.load_model()
+
+        stocks_data = self.recommender.stocks_data
+        if sector_name not in set(stocks_data['sector'].unique()):
+            raise LookupError(f"Sector '{sector_name}' not found")
+
+        sector_stocks = stocks_data[stocks_data['sector'] == sector_name]
+        top_stocks = sector_stocks.sort_values('market_cap', ascending=False).head(count)
+
+        return {
+            'sector': sector_name,
+            'stock_count': len(sector_stocks),
+            'stocks': [
+                {
+                    'ticker': ticker,
+                    'company_name': stock['company_name'],
+                    'market_cap': stock['market_cap'],
+                    'price': stock['price'],
+                    'esg_score': stock['esg_score']
+                }
+                for ticker, stock in top_stocks.iterrows()
+            ]
+        }
+
+    def precompute(self, store_path, n=3, diversify_n=3, explanations='text', workers=None):
+        """
+        Precompute results for every user into a SQLite store that serve() can read.
+
+        Parameters:
+        store_path (str): SQLite file to write
+        n (int): Recommendations per user
+        diversify_n (int): Diversification recommendations per user
+        explanations (str): Explanation mode ('text', 'ids' or 'off')
+        workers (int): Worker processes (defaults to the CPU count)
+
+        Returns:
+        dict: Metadata stored with the results
+        """
+        if not os.path.exists(self.model_path):
+            # Converts a legacy pickle, or trains a model, into the artifact the workers load
+            self.load_model()
+        return precompute_results(self.model_path, store_path, n=n, diversify_n=diversify_n,
+                                  explanations=explanations, workers=workers)
+
+    def risk_report(self, output_path, block_size=100000):
+        """
+        Write every user's portfolio volatility and largest risk contributor to a CSV.
+
+        Parameters:
+        output_path (str): CSV file to write
+        block_size (int): Portfolios evaluated at a time
+
+        Returns:
+        pd.DataFrame: The report (empty if the model has no risk model)
+        """
+        if not self.recommender:
+            self.load_model()
+        if self.recommender.risk_factors is None:
+            print("The model has no risk model; retrain it with price history to add one")
+            return pd.DataFrame()
+        report = self.recommender.portfolio_risk_batch(block_size=block_size)
+        report.to_csv(output_path, index=False, float_format='%.4f')
+        return report
+
+    def serve(self, host="127.0.0.1", port=8765, socket_path=None, cache_mb=64, cache_ttl=None,
+              precomputed_path=None):
+        """
+        Load the model once and answer queries over HTTP until interrupted.
+
+        Parameters:
+        host (str): Interface to bind the TCP listener to
+        port (int): TCP port to listen on
+        socket_path (str): Listen on this Unix socket instead of TCP when given
+        cache_mb (int): Memory cap of the result cache in MB (0 disables it)
+        cache_ttl (float): Seconds a cached result stays valid (None keeps it until evicted)
+        precomputed_path (str): Store from precompute() to answer user queries from when given
+        """
+        if not self.recommender:
+            self.load_model()
+        if cache_mb > 0:
+            self.recommender.enable_cache(max_bytes=cache_mb << 20, ttl=cache_ttl)
+
+        precomputed = None
+        if precomputed_path:
+            precomputed = PrecomputedStore(precomputed_path)
+            if precomputed.metadata['model_version'] != self.recommender.model_version:
+                print(f"Note: {precomputed_path} was computed by model {precomputed.metadata['model_version']}, "
+                      f"serving model is {self.recommender.model_version}", flush=True)
+
+        if socket_path:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            server = ThreadingUnixHTTPServer(socket_path, RecommenderRequestHandler)
+            address = f"unix:{socket_path}"
+        else:
+            server = ThreadingHTTPServer((host, port), RecommenderRequestHandler)
+            address = f"http://{host}:{server.server_address[1]}"
+
+        server.advisor = self
+        server.precomputed = precomputed
+        print(f"Stock Advisor serving on {address}", flush=True)
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if precomputed is not None:
+                precomputed.close()
+            if socket_path and os.path.exists(socket_path):
+                os.remove(socket_path)
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """HTTP server bound to a Unix domain socket."""
+    daemon_threads = True
+
+class RecommenderRequestHandler(BaseHTTPRequestHandler):
+    """
+    JSON endpoints backed by the StockAdvisor attached to the server:
+
+      GET /health
+      GET /recommend/<user_id or ticker>?n=3&explanations=text
+      GET /risk/<user_id>
+      GET /diversify/<user_id>?n=3&explanations=text
+      GET /similar/<ticker>?count=5&explanations=text
+      GET /stock/<ticker>
+      GET /sector/<sector_name>?count=5
+
+    With a precomputed store attached, user queries whose options match the
+    store are answered straight from its rows.
+    """
+    # HTTP/1.1 keeps connections open so callers can pool them
+    protocol_version = "HTTP/1.1"
+
+    def address_string(self):
+        # Unix socket peers have no (host, port) address
+        if isinstance(self.client_address, tuple) and self.client_address:
+            return str(self.client_address[0])
+        return "unix"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = parse_qs(url.query)
+        parts = [unquote(part) for part in url.path.split('/') if part]
+
+        try:
+            status, payload = 200, self.dispatch(parts, params)
+        except LookupError as e:
+            status, payload = 404, {'error': str(e)}
+        except ValueError as e:
+            status, payload = 400, {'error': str(e)}
+        except Exception as e:
+            status, payload = 500, {'error': str(e)}
+
+        self.send_json(status, payload)
+
+    def dispatch(self, parts, params):
+        """Route a request path to the matching advisor or recommender call."""
+        advisor = self.server.advisor
+        recommender = advisor.recommender
+
+        if parts == ['health']:
+            health = {'status': 'ok', 'model_version': recommender.model_version}
+            if recommender.result_cache is not None:
+                health['cache'] = recommender.result_cache.stats()
+            if self.server.precomputed is not None:
+                health['precomputed'] = self.server.precomputed.metadata
+            if recommender.correlation_index is not None:
+                # Share of stocks the correlation and blend similarities can reach
+                health['correlation_index'] = recommender.correlation_index
+            return health
+        if len(parts) != 2:
+            raise LookupError(f"Unknown endpoint: {self.path}")
+
+        command, target = parts
+
+        if command in ('recommend', 'risk', 'diversify'):
+            stored = self.precomputed_result(command, target, params)
+            if stored is not None:
+                return stored
+
+        if command == 'recommend':
+            if target not in recommender.ticker_index:
+                self.require_user(target)
+            return recommender.generate_recommendations(
+                target,
+                n=self.int_param(params, 'n', 3),
+                include_explanations=self.explanation_param(params),
+                **self.similarity_params(params)
+            )
+        if command == 'risk':
+            self.require_user(target)
+            return recommender.analyze_portfolio_risks(target)
+        if command == 'diversify':
+            self.require_user(target)
+            return recommender.generate_diversification_recommendations(
+                target, n=self.int_param(params, 'n', 3), include_explanations=self.explanation_param(params)
+            )
+        if command == 'similar':
+            if target not in recommender.ticker_index:
+                raise LookupError(f"Ticker '{target}' not found in the dataset")
+            return recommender.generate_recommendations(
+                target, n=self.int_param(params, 'count', 5), include_explanations=self.explanation_param(params),
+                **self.similarity_params(params)
+            )
+        if command == 'stock':
+            return advisor.get_stock_details(target)
+        if command == 'sector':
+            return advisor.get_sector_stocks(target, count=self.int_param(params, 'count', 5))
+
+        raise LookupError(f"Unknown endpoint: {self.path}")
+
+    def precomputed_result(self, command, target, params):
+        """Stored JSON for a user query, or None when it has to be computed."""
+        store = self.server.precomputed
+        if store is None:
+            return None
+        n = self.int_param(params, 'n', 3)
+        # The store holds fundamentals-based recommendations only
+        if command == 'recommend' and self.similarity_params(params)['similarity'] != 'fundamentals':
+            return None
+        if not store.matches(command, n, self.explanation_param(params)):
+            return None
+        return store.get(target, command)
+
+    def require_user(self, user_id):
+        """Raise LookupError when the user has no portfolio in the model (a store lookup, no DataFrame)."""
+        store = self.server.advisor.recommender.portfolio_store
+        if store is None:
+            raise LookupError("No unique portfolios data loaded")
+        if user_id not in store:
+            raise LookupError(f"User {user_id} not found in unique portfolios data")
+
+    @staticmethod
+    def int_param(params, name, default):
+        """Read a non-negative integer query parameter."""
+        values = params.get(name)
+        if not values:
+            return default
+        try:
+            value = int(values[0])
+        except ValueError:
+            raise ValueError(f"Query parameter '{name}' must be an integer")
+        if value < 0:
+            raise ValueError(f"Query parameter '{name}' must not be negative")
+        return value
+
+    @staticmethod
+    def similarity_params(params):
+        """
+        Read the similarity and weight query parameters.
+
+        similarity is fundamentals (the default), correlation or blend; weight is
+        the correlation share of a blend (default 0.5).
+        """
+        similarity = params.get('similarity', ['fundamentals'])[0]
+        if similarity not in SIMILARITY_MODES:
+            raise ValueError("Query parameter 'similarity' must be one of fundamentals, correlation, blend")
+        try:
+            weight = float(params.get('weight', ['0.5'])[0])
+        except ValueError:
+            raise ValueError("Query parameter 'weight' must be a number")
+        return {'similarity': similarity, 'correlation_weight': weight}
+
+    @staticmethod
+    def explanation_param(params):
+        """
+        Read the explanations query parameter.
+
+        text (or 1, the default) returns explanation text, ids only the fragment ids
+        and off (or 0) no explanation, which saves work for high-volume callers.
+        """
+        values = params.get('explanations')
+        if not values:
+            return 'text'
+        value = {'1': 'text', '0': 'off'}.get(values[0], values[0])
+        if value not in EXPLANATION_MODES:
+            raise ValueError("Query parameter 'explanations' must be one of text, ids, off (or 1/0)")
+        return value
+
+    def send_json(self, status, payload):
+        # Precomputed results arrive already encoded
+        if isinstance(payload, bytes):
+            body = payload
+        else:
+            body = json.dumps(to_json_safe(payload)).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
 def main():
     
     parser = argparse.ArgumentParser(
@@ -375,6 +721,9 @@ def main():
           python stock_advisor.py similar AAPL --count 3  # Find 3 stocks similar to AAPL
           python stock_advisor.py sector Technology     # Explore the Technology sector
           python stock_advisor.py train                 # Train or retrain the model
+          python stock_advisor.py train --price-history stock_recommender_data/historical_prices.csv
+          python stock_advisor.py serve --port 8765     # Serve JSON queries over HTTP
+          python stock_advisor.py precompute            # Precompute results for every user
         ''')
     )
     
@@ -400,7 +749,33 @@ def main():
     
     # Training command
     train_parser = subparsers.add_parser('train', help='Train or retrain the model')
-    
+    train_parser.add_argument('--price-history', type=str, default=None,
+                              help='Price history directory or CSV to derive return and risk features from')
+
+    # Long-running server command
+    serve_parser = subparsers.add_parser('serve', help='Load the model once and serve JSON queries over HTTP')
+    serve_parser.add_argument('--host', type=str, default='127.0.0.1', help='Interface to listen on')
+    serve_parser.add_argument('--port', '-p', type=int, default=8765, help='TCP port to listen on')
+    serve_parser.add_argument('--socket', type=str, default=None, help='Listen on a Unix socket path instead of TCP')
+    serve_parser.add_argument('--cache-mb', type=int, default=64, help='Memory cap of the result cache in MB (0 disables it)')
+    serve_parser.add_argument('--cache-ttl', type=float, default=None, help='Seconds a cached result stays valid')
+    serve_parser.add_argument('--precomputed', type=str, default=None,
+                              help='Answer user queries from a store written by the precompute command')
+
+    # Offline precompute command
+    precompute_parser = subparsers.add_parser('precompute', help='Precompute results for every user into a SQLite store')
+    precompute_parser.add_argument('--output', '-o', type=str, default='precomputed_results.sqlite', help='Store to write')
+    precompute_parser.add_argument('--n', type=int, default=3, help='Recommendations per user')
+    precompute_parser.add_argument('--diversify-n', type=int, default=3, help='Diversification recommendations per user')
+    precompute_parser.add_argument('--explanations', choices=EXPLANATION_MODES, default='text',
+                                   help='Explanation text, fragment ids only, or none')
+    precompute_parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: CPU count)')
+
+    # Portfolio volatility for every user
+    risk_report_parser = subparsers.add_parser('risk-report', help="Write every user's portfolio volatility to a CSV")
+    risk_report_parser.add_argument('--output', '-o', type=str, default='portfolio_risk.csv', help='CSV file to write')
+    risk_report_parser.add_argument('--block-size', type=int, default=100000, help='Portfolios evaluated at a time')
+
     args = parser.parse_args()
     
     # Initialize the advisor
@@ -415,22 +790,21 @@ def main():
     elif args.command == 'sector':
         advisor.explore_sector(args.sector_name, args.count)
     elif args.command == 'train':
-        advisor.train_model()
+        advisor.train_model(price_history_path=args.price_history)
         print("Training complete. Model is ready to use.")
-        
-    user_id = sys.argv[1] if len(sys.argv) > 1 else None
-    if not user_id:
-        print(json.dumps({'error': 'User ID is required'}))
-        return
-
-    recommender = ImprovedStockRecommender()
-    recommender.load_model("improved_stock_recommender.pkl")
-
-    try:
-        recommendations = recommender.generate_recommendations(user_id, n=3, include_explanations=True)
-        print(json.dumps(recommendations))
-    except Exception as e:
-        print(json.dumps({'error': str(e)}))    
+    elif args.command == 'serve':
+        advisor.serve(host=args.host, port=args.port, socket_path=args.socket,
+                      cache_mb=args.cache_mb, cache_ttl=args.cache_ttl, precomputed_path=args.precomputed)
+    elif args.command == 'precompute':
+        start = time.perf_counter()
+        metadata = advisor.precompute(args.output, n=args.n, diversify_n=args.diversify_n,
+                                      explanations=args.explanations, workers=args.workers)
+        print(f"Wrote {metadata['users']} users to {args.output} in {time.perf_counter() - start:.1f}s")
+    elif args.command == 'risk-report':
+        start = time.perf_counter()
+        report = advisor.risk_report(args.output, block_size=args.block_size)
+        if len(report):
+            print(f"Wrote {len(report)} users to {args.output} in {time.perf_counter() - start:.1f}s")
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -12,7 +12,7 @@ def main():
     data_dir = "stock_recommender_data"
     stocks_data_path = os.path.join(data_dir, "stocks_data.csv")
     unique_portfolios_path = os.path.join(data_dir, "users_unique_portfolio.csv")
-    model_path = "improved_stock_recommender.pkl"
+    model_path = "improved_stock_recommender"
     
     print("Initializing improved recommender system...")
     recommender = ImprovedStockRecommender()
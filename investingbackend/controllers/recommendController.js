@@ -1,20 +1,56 @@
-import {exec} from "child_process"
+import http from "http"
+
+// The recommender runs as a long-lived `stock_advisor.py serve` process, so the
+// model is loaded once instead of on every request.
+const RECOMMENDER_URL = process.env.RECOMMENDER_URL || "http://127.0.0.1:8765";
+const RECOMMENDER_SOCKET = process.env.RECOMMENDER_SOCKET;
+// A stalled or killed recommender fails the request instead of hanging it
+const RECOMMENDER_TIMEOUT_MS = Number(process.env.RECOMMENDER_TIMEOUT_MS) || 10000;
+
+// Keep-alive agent so requests reuse pooled connections to the recommender
+const agent = new http.Agent({ keepAlive: true, maxSockets: 16 });
+
+const requestOptions = (path) => {
+    if (RECOMMENDER_SOCKET) {
+        return { socketPath: RECOMMENDER_SOCKET, path, agent };
+    }
+    const url = new URL(path, RECOMMENDER_URL);
+    return { hostname: url.hostname, port: url.port, path: url.pathname + url.search, agent };
+}
 
 export const recommend = (req,res)=>{
-    const userId = req.params.userId;
+    const userId = encodeURIComponent(req.params.userId);
 
-    exec(`python3 python-ai/stock_advisor.py ${userId}`, (error, stdout, stderr) => {
-      if (error) {
-        console.error(`Error: ${stderr}`);
-        return res.status(500).json({ error: "Python script failed to execute." });
-      }
-  
-      try {
-        const result = JSON.parse(stdout);
-        res.json(result);
-      } catch (parseError) {
-        console.error("JSON Parse Error:", parseError);
-        res.status(500).json({ error: "Invalid response from Python script." });
+    // Error, timeout and a broken response can all fire; only the first one answers
+    const unavailable = (message) => {
+      console.error(`Error: ${message}`);
+      if (!res.headersSent) {
+        res.status(503).json({ error: "Recommender service is unavailable." });
       }
+    };
+
+    const request = http.get(requestOptions(`/recommend/${userId}?n=3`), (response) => {
+      let body = "";
+      response.setEncoding("utf8");
+      response.on("data", (chunk) => { body += chunk; });
+      response.on("error", (error) => unavailable(error.message));
+      response.on("end", () => {
+        if (res.headersSent) {
+          return;
+        }
+        try {
+          const result = JSON.parse(body);
+          res.status(response.statusCode).json(result);
+        } catch (parseError) {
+          console.error("JSON Parse Error:", parseError);
+          res.status(500).json({ error: "Invalid response from recommender service." });
+        }
+      });
+    });
+
+    request.setTimeout(RECOMMENDER_TIMEOUT_MS, () => {
+      request.destroy(new Error(`Recommender did not answer within ${RECOMMENDER_TIMEOUT_MS} ms`));
     });
-}   
\ No newline at end of file
+
+    request.on("error", (error) => unavailable(error.message));
+}